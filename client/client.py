@@ -5,22 +5,32 @@ import sys
 import os
 import json
 import socket
+import ssl
 import threading
 import time
 import base64
-import struct
 import random
 import string
+import queue
+import itertools
+import html
 from datetime import datetime
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
                            QTextEdit, QTextBrowser, QLineEdit, QPushButton, QLabel, QListWidget,
                            QSplitter, QFileDialog, QMessageBox, QInputDialog, QMenu, QDialog, QSpinBox,
                            QMenuBar, QAction)
-from PyQt5.QtGui import QColor, QTextCursor, QPixmap, QIcon, QFont, QTextDocument
-from PyQt5.QtCore import Qt, QSize, pyqtSignal, QThread, QBuffer, QIODevice, QUrl
+from PyQt5.QtGui import QColor, QTextCursor, QPixmap, QIcon, QFont, QTextDocument, QDesktopServices, QPainter
+from PyQt5.QtCore import Qt, QSize, pyqtSignal, QThread, QBuffer, QIODevice, QUrl, QEvent
 
 # 导入配置管理器
 from config_manager import ConfigManager
+# 导入图片缓存
+from image_cache import ImageCache
+# 导入图片预检
+from image_probe import prepare_image, image_extension, VALID_EXTENSIONS, MAX_IMAGE_DIMENSION, ImageProbeError
+# 导入与服务器共用的协议和传输模块（位于仓库根目录的 common 包中）
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import protocol, transport
 
 # 确保存储目录存在
 for dir_path in ['chat_files/text', 'chat_files/images']:
@@ -33,17 +43,70 @@ class ChatClient(QThread):
     connection_success = pyqtSignal()
     banned_signal = pyqtSignal(str)
     server_shutdown_signal = pyqtSignal(str)
+    upload_progress = pyqtSignal(str, int, int)  # (原始文件名, 已发送字节数, 总字节数)
+    reconnecting = pyqtSignal(int, float)  # (第几次重连, 本次等待秒数)
+    reconnected = pyqtSignal(bool)  # 是否恢复了原会话
+    messages_missed = pyqtSignal(int)  # 根据消息序号发现的未收到消息条数
     
     # 定义客户端版本
     CLIENT_VERSION = "v1.0.2a"
+    # 客户端支持的扩展能力，在发送昵称时告知服务器
+    CAPABILITIES = ['file_dedup', 'file_preview', 'resume', 'direct', 'server_ping']
     
-    def __init__(self, host, port, username):
+    # 发送队列优先级：数值越小越先发送，文字消息可以插队到排队中的文件之前
+    PRIORITY_CONTROL = 0
+    PRIORITY_TEXT = 1
+    PRIORITY_FILE = 2
+    # 文件分块发送的大小，每块单独受socket超时限制并汇报一次进度
+    SEND_CHUNK_SIZE = 64 * 1024
+    # 主动断开时等待写线程发完当前帧和断开通知的最长时间（秒）
+    DISCONNECT_FLUSH_TIMEOUT = 5.0
+    # 服务器转发的消息在客户端消息之外还带有发送者、序号等字段，接收上限在 max_message_bytes 之上留出的余量
+    FRAME_SIZE_HEADROOM = 64 * 1024
+    
+    # 连接意外断开后的自动重连：指数退避加全随机抖动，避免服务器重启后所有客户端同时涌入
+    RECONNECT_BASE_DELAY = 1.0
+    RECONNECT_MAX_DELAY = 30.0
+    MAX_RECONNECT_ATTEMPTS = 10
+    
+    # TLS上下文和会话按进程缓存：会话只能在创建它的上下文中恢复，
+    # 重连（包括重新创建 ChatClient）时凭上次的会话票据恢复会话，不需要完整握手
+    _tls_contexts = {}  # CA文件 -> SSLContext
+    _tls_sessions = {}  # (主机, 端口, CA文件) -> SSLSession
+    
+    def __init__(self, host, port, username, tls_ca_file=None):
         super().__init__()
+        # tls:// 或 ssl:// 开头的地址使用TLS连接
+        self.use_tls = host.strip().lower().startswith(('tls://', 'ssl://'))
+        self.tls_ca_file = tls_ca_file or None  # 为空时使用系统的受信任证书
         # 解析可能包含URL格式的主机地址
         self.host, self.port = self._parse_host_address(host, port)
         self.username = username
         self.client_socket = None
         self.connected = False
+        # 发送队列和写线程：所有发送都在写线程中完成，界面线程只负责入队
+        self.outbound_queue = queue.PriorityQueue()
+        self.outbound_counter = itertools.count()  # 同优先级内保持先后顺序
+        self.writer_thread = None
+        self.closing = False
+        # 本次连接中确认服务器持有的文件哈希，上传这些文件时只需发送哈希
+        self.known_server_hashes = set()
+        # 只发送了哈希的文件，服务器请求时需要重新上传：哈希 -> (文件路径, 消息)
+        self.pending_uploads = {}
+        # 自动重连相关状态
+        self.session_token = None  # 服务器分配的会话令牌，重连时用于恢复会话
+        self.last_seq = None  # 收到的最后一条带序号消息的序号，用于去重、发现遗漏，重连时服务器据此补发错过的消息
+        self.server_epoch = None  # 服务器的运行标识，服务器重启后序号重新计数
+        self.room = None  # 当前所在房间，重连后回到该房间
+        self.direct_counter = itertools.count(1)  # 私聊消息的本地编号，用于对应服务器的送达回执
+        self.resumed = False  # 最近一次连接是否恢复了原会话
+        self.reconnecting_now = False  # 正在重连期间，发送的消息先排队
+        self.fatal_error = False  # 服务器明确拒绝（昵称被占用、版本不符、封禁），不再重连
+        self.restart_window = None  # 服务器更新重启时给出的重连时间窗口（秒），在窗口内随机选择时刻重连
+        self.stop_event = threading.Event()  # 用户主动断开时打断重连等待
+        self.writer_generation = 0  # 每次连接使用新的写线程，旧线程的停止标记不影响新线程
+        self.connection = None  # 当前连接的帧收发（transport.Connection），记录与服务器协商的压缩算法
+        self.max_message_bytes = None  # 服务器接受的单条文件消息大小上限，旧版服务器不提供
         
     def _parse_host_address(self, host, port):
         """解析主机地址，支持普通IP/域名或URL格式
@@ -79,54 +142,52 @@ class ChatClient(QThread):
                 pass
         return host, port
         
-    def receive_all(self, sock, n):
-        # 接收指定长度的数据
-        data = b''
-        while len(data) < n:
-            packet = sock.recv(n - len(data))
-            if not packet:
-                return None
-            data += packet
-        return data
+    def _tls_context(self):
+        context = self._tls_contexts.get(self.tls_ca_file)
+        if context is None:
+            context = ssl.create_default_context(cafile=self.tls_ca_file)
+            context.minimum_version = ssl.TLSVersion.TLSv1_2
+            self._tls_contexts[self.tls_ca_file] = context
+        return context
+    
+    def _wrap_tls(self, sock):
+        """在已连接的socket上完成TLS握手，有上次连接的会话时尝试恢复"""
+        session = self._tls_sessions.get((self.host, self.port, self.tls_ca_file))
+        # 关闭Nagle算法，避免握手后的第一次写入等待服务器的延迟确认
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        tls_socket = self._tls_context().wrap_socket(sock, server_hostname=self.host, session=session)
+        print(f"TLS握手完成: {tls_socket.version()}{'（恢复会话）' if tls_socket.session_reused else ''}")
+        return tls_socket
         
     def connect_to_server(self):
+        self.connection = None
         try:
             self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             # 设置连接超时为10秒
             self.client_socket.settimeout(10.0)
             self.client_socket.connect((self.host, self.port))
+            if self.use_tls:
+                # 握手同样受10秒超时限制
+                self.client_socket = self._wrap_tls(self.client_socket)
             # 连接成功后设置接收超时为30秒
             self.client_socket.settimeout(30.0)
+            self.connection = transport.Connection(self.client_socket)
             
-            # 发送版本信息，使用base64加密版本号
+            # 发送 hello：版本信息（base64加密版本号）、支持的压缩算法和昵称信息合并在一条消息中，
+            # 新版服务器直接回复 connected，一次往返完成握手
             encrypted_version = base64.b64encode(self.CLIENT_VERSION.encode('utf-8')).decode('utf-8')
-            version_data = json.dumps({'version': encrypted_version})
-            version_bytes = version_data.encode('utf-8')
+            hello_message = self._hello(version=encrypted_version, compression=transport.supported_codecs())
+            hello_data = json.dumps(hello_message)
+            hello_bytes = hello_data.encode('utf-8')
             
-            # 发送4字节长度前缀 + 版本信息内容
-            length_header = struct.pack('!I', len(version_bytes))
-            self.client_socket.sendall(length_header + version_bytes)
-            print(f"已发送版本信息: {version_data} ({len(version_bytes)} bytes)")
+            # 握手消息在协商压缩之前发送，不压缩
+            self.connection.send_payload(hello_bytes, compressible=False)
+            print(f"已发送握手信息: {hello_data} ({len(hello_bytes)} bytes)")
             
-            # 等待服务器版本验证响应 - 先接收4字节的消息头
-            header_data = self.receive_all(self.client_socket, 4)
-            if not header_data:
-                self.connection_error.emit("服务器未响应版本验证")
-                self.client_socket.close()
-                return False
-                
-            # 解析消息长度
-            try:
-                msg_len = struct.unpack('!I', header_data)[0]
-            except:
-                self.connection_error.emit("版本验证消息格式错误")
-                self.client_socket.close()
-                return False
-                
-            # 接收完整的消息内容
-            version_response_data = self.receive_all(self.client_socket, msg_len)
+            # 等待服务器响应
+            version_response_data = self.connection.read_payload()
             if not version_response_data:
-                self.connection_error.emit("服务器未响应版本验证")
+                self._connect_failed("服务器未响应版本验证")
                 self.client_socket.close()
                 return False
                 
@@ -134,7 +195,7 @@ class ChatClient(QThread):
             try:
                 version_response = json.loads(version_response_data.decode('utf-8'))
             except json.JSONDecodeError:
-                self.connection_error.emit("版本验证响应不是有效的JSON格式")
+                self._connect_failed("版本验证响应不是有效的JSON格式")
                 self.client_socket.close()
                 return False
             
@@ -146,95 +207,199 @@ class ChatClient(QThread):
                     version_info = ', '.join(supported_versions)
                 else:
                     version_info = '未知版本'
+                self.fatal_error = True
                 self.version_mismatch.emit(version_info)
                 self.client_socket.close()
                 return False
-            elif version_response.get('type') != 'version_accepted':
-                # 版本验证失败，不是预期的响应
-                self.connection_error.emit(f"版本验证失败: {version_response}")
-                self.client_socket.close()
-                return False
-            
-            # 版本验证通过后，发送昵称
-            username_data = json.dumps({'username': self.username})
-            username_bytes = username_data.encode('utf-8')
-            
-            # 发送4字节长度前缀 + 用户名信息内容
-            length_header = struct.pack('!I', len(username_bytes))
-            self.client_socket.sendall(length_header + username_bytes)
-            print(f"已发送用户名信息: {username_data} ({len(username_bytes)} bytes)")
-            
-            # 等待服务器响应 - 先接收4字节的消息头
-            header_data = self.receive_all(self.client_socket, 4)
-            if not header_data:
-                self.connection_error.emit("服务器未响应")
-                self.client_socket.close()
-                return False
+            elif version_response.get('type') == 'version_accepted':
+                # 旧版服务器不认识 hello，只把它当作版本信息处理：按两步握手继续发送昵称
+                if version_response.get('compression') in transport.CODECS:
+                    self.connection.codec = version_response['compression']
                 
-            # 解析消息长度
-            msg_len = struct.unpack('!I', header_data)[0]
-            
-            # 接收完整的消息内容
-            msg_data = self.receive_all(self.client_socket, msg_len)
-            if not msg_data:
-                self.connection_error.emit("服务器未响应")
-                self.client_socket.close()
-                return False
+                # 旧版服务器的昵称消息没有 type 字段
+                login_fields = self._hello()
+                del login_fields['type']
+                username_data = json.dumps(login_fields)
+                username_bytes = username_data.encode('utf-8')
                 
-            # 解码并解析JSON
-            message = json.loads(msg_data.decode('utf-8'))
+                # 旧版服务器按未压缩的消息读取昵称信息
+                self.connection.send_payload(username_bytes, compressible=False)
+                print(f"已发送用户名信息: {username_data} ({len(username_bytes)} bytes)")
+                
+                # 等待服务器响应（协商压缩后的消息可能经过压缩）
+                msg_data = self.connection.read_payload()
+                if not msg_data:
+                    self._connect_failed("服务器未响应")
+                    self.client_socket.close()
+                    return False
+                    
+                # 解码并解析JSON
+                message = json.loads(msg_data.decode('utf-8'))
+            else:
+                # 新版服务器对 hello 的回复（connected、昵称错误或封禁）
+                message = version_response
             print(f"收到服务器响应: {message}")
             
             # 检查响应类型
             if message.get('type') == 'error':
-                # 昵称重复错误
+                # 昵称重复错误（重连时说明会话已过期且昵称被他人占用）
+                self.fatal_error = True
                 self.connection_error.emit(message.get('content', '连接错误'))
                 self.client_socket.close()
                 return False
             elif message.get('type') == 'banned':
                 # IP被封禁
+                self.fatal_error = True
                 self.banned_signal.emit(json.dumps(message))
                 self.client_socket.close()
                 return False
             elif message.get('type') == 'connected':
                 # 连接成功
                 print(f"连接成功确认，设置connected=True")
+                # hello 握手时压缩算法随 connected 一起协商
+                if message.get('compression') in transport.CODECS:
+                    self.connection.codec = message['compression']
+                self.max_message_bytes = message.get('max_message_bytes')
+                if isinstance(self.max_message_bytes, int):
+                    # 接收上限与服务器一致，不再为超过服务器上限的帧分配内存；旧版服务器不提供时保持默认值
+                    self.connection.max_frame_size = self.max_message_bytes + self.FRAME_SIZE_HEADROOM
+                # 保存会话令牌，连接意外断开后凭此恢复会话
+                self.session_token = message.get('session_token')
+                self.resumed = bool(message.get('resumed'))
+                if message.get('server_epoch') != self.server_epoch:
+                    # 服务器已重启（或首次连接），之前的序号不再有效
+                    self.server_epoch = message.get('server_epoch')
+                    self.last_seq = None
+                if message.get('room') != self.room:
+                    # 消息序号按房间计数，换了房间之前的序号不再有效
+                    self.room = message.get('room')
+                    self.last_seq = None
+                if self.use_tls:
+                    # TLS 1.3 的会话票据在握手之后才下发，收到服务器响应后再保存
+                    self._tls_sessions[(self.host, self.port, self.tls_ca_file)] = self.client_socket.session
                 self.connected = True
                 return True
             else:
                 # 未知响应
-                self.connection_error.emit(f"未知的服务器响应: {message}")
+                self._connect_failed(f"未知的服务器响应: {message}")
                 self.client_socket.close()
                 return False
         except socket.timeout:
-            self.connection_error.emit("连接超时，请检查网络连接和服务器状态")
+            self._connect_failed("连接超时，请检查网络连接和服务器状态")
+            return False
+        except ssl.SSLCertVerificationError as e:
+            # 证书不受信任，重连也不会成功
+            self.fatal_error = True
+            self.connection_error.emit(f"服务器证书验证失败: {e.verify_message}，请检查配置文件中的 tls_ca_file")
+            return False
+        except ssl.SSLError as e:
+            self._connect_failed(f"TLS握手失败: {e}")
             return False
         except ConnectionRefusedError:
-            self.connection_error.emit("连接被拒绝，请检查服务器地址和端口是否正确")
+            self._connect_failed("连接被拒绝，请检查服务器地址和端口是否正确")
             return False
         except socket.gaierror:
-            self.connection_error.emit("无法解析服务器地址，请检查网络连接")
+            self._connect_failed("无法解析服务器地址，请检查网络连接")
             return False
         except Exception as e:
-            self.connection_error.emit(f"连接服务器失败: {e}")
+            self._connect_failed(f"连接服务器失败: {e}")
             return False
     
+    def _hello(self, **fields):
+        """hello 消息：昵称和客户端能力；重连时带上会话令牌、最后收到的消息序号和所在房间以恢复原会话"""
+        if self.session_token:
+            fields['resume_token'] = self.session_token
+        if self.last_seq is not None:
+            fields['last_seq'] = self.last_seq
+            fields['server_epoch'] = self.server_epoch
+        if self.room:
+            fields['room'] = self.room
+        return protocol.Hello(self.username, capabilities=self.CAPABILITIES, **fields).to_dict()
+    
+    def _connect_failed(self, error_message):
+        """连接失败（可重试的错误）：首次连接时提示用户，自动重连期间只记录日志"""
+        if self.reconnecting_now:
+            print(f"重连失败: {error_message}")
+        else:
+            self.connection_error.emit(error_message)
+    
     def run(self):
         if not self.connect_to_server():
             return
         
-        # 连接成功，发送信号
+        # 连接成功后发送信号
         self.connection_success.emit()
-            
+        
+        while True:
+            self._start_writer()
+            should_reconnect = self._receive_loop()
+            self._stop_writer()
+            if not should_reconnect or self.closing:
+                break
+            if not self._reconnect():
+                break
+    
+    def _start_writer(self):
+        """为当前连接启动写线程"""
+        self.writer_generation += 1
+        self.writer_thread = threading.Thread(target=self._writer_loop, args=(self.writer_generation,),
+                                              daemon=True, name="ChatClient-writer")
+        self.writer_thread.start()
+    
+    def _stop_writer(self):
+        """通知当前写线程退出；队列中尚未发送的消息保留到重连后发送"""
+        self.outbound_queue.put((-1, next(self.outbound_counter), None, self.writer_generation))
+        if self.writer_thread is not None:
+            self.writer_thread.join(timeout=1.0)
+    
+    def _reconnect(self):
+        """连接意外断开后按指数退避自动重连，返回是否重连成功"""
+        self.reconnecting_now = True
+        try:
+            for attempt in range(self.MAX_RECONNECT_ATTEMPTS):
+                # 全随机抖动：在 [0, 退避上限] 内随机等待
+                delay = random.uniform(0, min(self.RECONNECT_MAX_DELAY, self.RECONNECT_BASE_DELAY * 2 ** attempt))
+                if attempt == 0 and self.restart_window:
+                    # 服务器更新：在服务器给出的时间窗口内分散重连，新进程已在等待
+                    delay = random.uniform(0, self.restart_window)
+                    self.restart_window = None
+                print(f"连接已断开，{delay:.1f} 秒后进行第 {attempt + 1} 次重连")
+                self.reconnecting.emit(attempt + 1, delay)
+                if self.stop_event.wait(delay) or self.closing:
+                    return False
+                if self.connect_to_server():
+                    print(f"重连成功，{'已恢复原会话' if self.resumed else '已作为新会话加入'}")
+                    self.reconnected.emit(self.resumed)
+                    return True
+                if self.fatal_error or self.closing:
+                    return False
+        finally:
+            self.reconnecting_now = False
+        self.connection_error.emit("与服务器的连接已断开，多次重连失败")
+        return False
+    
+    def _receive_loop(self):
+        """接收并分发服务器消息，返回连接断开后是否应该自动重连"""
+        should_reconnect = True
+        idle_timeouts = 0
         try:
             while self.connected:
-                header_data = self.receive_all(self.client_socket, 4)
-                if not header_data:
-                    break
-                    
-                msg_len = struct.unpack('!I', header_data)[0]
-                data = self.receive_all(self.client_socket, msg_len)
-                
+                try:
+                    data = self.connection.read_payload()
+                except socket.timeout:
+                    # 长时间没有收到任何数据：先发送心跳探测，再次超时则认为连接已失效
+                    idle_timeouts += 1
+                    if idle_timeouts >= 2:
+                        print("服务器长时间无响应，连接已失效")
+                        break
+                    self.send_frame(protocol.Heartbeat().to_dict())
+                    continue
+                except transport.FrameTooLarge as e:
+                    # 消息体已被读出并丢弃，连接可以继续使用；带序号的消息会在下一条消息时报告为遗漏
+                    print(f"丢弃服务器发来的超大消息: {e}")
+                    idle_timeouts = 0
+                    continue
+                idle_timeouts = 0
                 if not data:
                     break
                     
@@ -243,25 +408,68 @@ class ChatClient(QThread):
                 # 检查是否收到封禁消息
                 if message.get('type') == 'banned':
                     self.banned_signal.emit(json.dumps(message))
+                    should_reconnect = False
                     self.connected = False
                     break
                 
+                # 服务器正在更新（由新进程接管）：连接随后关闭，稍后重连即可恢复会话
+                if message.get('type') == 'server_restart':
+                    print(f"服务器正在更新: {message.get('content')}")
+                    self.restart_window = message.get('reconnect_within', 0) / 1000
+                    break
+                
                 # 检查是否收到服务器关闭消息
                 if message.get('type') == 'server_shutdown':
                     self.server_shutdown_signal.emit(json.dumps(message))
+                    should_reconnect = False
                     self.connected = False
                     break
                 
+                # 心跳回复只用于保持连接活跃
+                if message.get('type') == 'pong':
+                    continue
+                
+                # 服务器发来的心跳：原样带回时间戳，服务器据此计算往返时间
+                if message.get('type') == 'heartbeat':
+                    self.send_frame(protocol.Pong(message.get('timestamp')).to_dict())
+                    continue
+                
+                # 切换了房间，之后的消息序号从新房间开始计算
+                if message.get('type') == 'room_joined':
+                    self.room = message.get('room')
+                    self.last_seq = None
+                
+                # 按服务器分配的序号去重并检查遗漏（序号按房间递增）
+                seq = message.get('seq')
+                if isinstance(seq, int):
+                    if self.last_seq is not None:
+                        if seq <= self.last_seq:
+                            print(f"忽略重复的消息: {message.get('id')}")
+                            continue
+                        if seq > self.last_seq + 1:
+                            self.messages_missed.emit(seq - self.last_seq - 1)
+                    self.last_seq = seq
+                
+                # 服务器缓存中没有我们只发送了哈希的文件，重新上传完整数据
+                if message.get('type') == 'file_want':
+                    self._resend_file(message.get('file_hash'))
+                    continue
+                
+                # 记录服务器持有的文件内容，之后重复发送时可以只发送哈希
+                if message.get('type') in ('file', 'file_announce', 'file_data', 'direct', 'direct_ack') and message.get('file_hash'):
+                    self.known_server_hashes.add(message['file_hash'])
+                    # 服务器已广播该文件，说明不需要重新上传
+                    self.pending_uploads.pop(message['file_hash'], None)
+                
                 self.message_received.emit(message)
                 
+        except OSError as e:
+            # 网络错误（含远程主机强迫关闭连接等）：主动断开时属于预期情况，否则交给自动重连处理
+            print(f"连接中断: {e}")
         except Exception as e:
-            # 忽略已知的连接错误类型
-            error_str = str(e)
-            # 这些是正常关闭时可能出现的错误，不需要显示给用户
-            if not self.connected or "远程主机强迫关闭了一个现有的连接" in error_str or "[WinError 10053]" in error_str:
-                pass  # 这是预期的断开连接，不显示错误
-            else:
-                self.connection_error.emit(f"接收消息错误: {e}")
+            # 协议数据错误，重连也无法恢复
+            self.connection_error.emit(f"接收消息错误: {e}")
+            should_reconnect = False
         finally:
             if self.connected:  # 只有在未正常断开的情况下才设置为False
                 self.connected = False
@@ -270,99 +478,212 @@ class ChatClient(QThread):
                     self.client_socket.close()
                 except:
                     pass
-    
-    def recv_all(self, n):
-        data = b''
-        while len(data) < n:
-            packet = self.client_socket.recv(n - len(data))
-            if not packet:
-                return None
-            data += packet
-        return data
+        return should_reconnect and not self.closing
     
     def send_message(self, message_type, content):
-        if not self.connected:
+        if not self.connected and not self.reconnecting_now:
             self.connection_error.emit("未连接到服务器")
             return False
             
         try:
-            message = {
-                'type': message_type,
-                'content': content
-            }
+            message = protocol.CLIENT_MESSAGES[message_type](content=content).to_dict()
             
             msg_json = json.dumps(message)
             msg_bytes = msg_json.encode('utf-8')
-            header = struct.pack('!I', len(msg_bytes))
             
-            self.client_socket.sendall(header + msg_bytes)
+            self._enqueue(msg_bytes, self.PRIORITY_TEXT)
             return True
         except Exception as e:
             self.connection_error.emit(f"发送消息错误: {e}")
             return False
     
-    def send_file(self, file_path, file_type):
-        if not self.connected:
+    def send_direct(self, to, content):
+        """发送私聊文字消息，返回本地编号（服务器的送达回执中会带上），失败时返回None"""
+        client_msg_id = str(next(self.direct_counter))
+        message = protocol.Direct(to=to, content=content, client_msg_id=client_msg_id)
+        if self.send_frame(message.to_dict(), self.PRIORITY_TEXT):
+            return client_msg_id
+        return None
+    
+    def send_file(self, prepared, file_type, to=None):
+        """发送已通过预检的文件，prepared 为 image_probe.prepare_image 的返回值；指定 to 时作为私聊发送"""
+        if not self.connected and not self.reconnecting_now:
             self.connection_error.emit("未连接到服务器")
             return False
             
         try:
-            with open(file_path, 'rb') as f:
-                file_data = f.read()
-                
-            # 获取原始文件名和扩展名
-            original_file_name = os.path.basename(file_path)
-            file_name_only, file_ext = os.path.splitext(original_file_name)
+            file_hash = prepared['file_hash']
+            original_file_name = prepared['original_file_name']
             
             # 生成混淆文件名（时间戳+随机字符串+原始扩展名）
             timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
             random_str = ''.join(random.choices(string.ascii_letters + string.digits, k=8))
-            obfuscated_file_name = f"{timestamp}_{random_str}{file_ext}"
+            obfuscated_file_name = f"{timestamp}_{random_str}{prepared['file_ext']}"
             
-            file_data_b64 = base64.b64encode(file_data).decode('utf-8')
-            
-            message = {
-                'type': 'file',
+            fields = {
                 'file_type': file_type,
                 'file_name': obfuscated_file_name,
                 'original_file_name': original_file_name,  # 保留原始文件名用于显示
-                'file_data': file_data_b64
+                'file_hash': file_hash,  # 内容哈希，接收方据此去重
+                'width': prepared['width'],
+                'height': prepared['height']
             }
+            if to:
+                message = protocol.Direct(to=to, client_msg_id=str(next(self.direct_counter)), **fields).to_dict()
+            else:
+                message = protocol.File(**fields).to_dict()
+            
+            if file_hash in self.known_server_hashes:
+                # 服务器已有该内容，只发送哈希；若服务器已淘汰会通过 file_want 请求重新上传
+                self.pending_uploads[file_hash] = (prepared['file_path'], dict(message))
+            else:
+                message['file_data'] = base64.b64encode(prepared['data']).decode('utf-8')
             
             msg_json = json.dumps(message)
             msg_bytes = msg_json.encode('utf-8')
-            header = struct.pack('!I', len(msg_bytes))
             
-            self.client_socket.sendall(header + msg_bytes)
+            # 文件排在文字消息之后发送，并分块汇报上传进度
+            self._enqueue(msg_bytes, self.PRIORITY_FILE, original_file_name)
             return True
         except Exception as e:
             self.connection_error.emit(f"发送文件错误: {e}")
             return False
     
+    def _resend_file(self, file_hash):
+        """服务器缓存中没有该文件时，重新上传完整数据"""
+        self.known_server_hashes.discard(file_hash)
+        pending = self.pending_uploads.pop(file_hash, None)
+        if not pending:
+            return
+        file_path, message = pending
+        try:
+            with open(file_path, 'rb') as f:
+                message['file_data'] = base64.b64encode(f.read()).decode('utf-8')
+            self.send_frame(message, self.PRIORITY_FILE, message.get('original_file_name'))
+        except Exception as e:
+            print(f"重新上传文件失败: {e}")
+    
+    def join_room(self, room):
+        """请求进入指定房间，同一时间只在一个房间中"""
+        return self.send_frame(protocol.RoomJoin(room).to_dict(), self.PRIORITY_TEXT)
+    
+    def leave_room(self):
+        """离开当前房间，回到大厅"""
+        return self.send_frame(protocol.RoomLeave().to_dict(), self.PRIORITY_TEXT)
+    
+    def request_file(self, file_id):
+        """向服务器请求本地缓存中没有的文件内容"""
+        return self.send_frame(protocol.FileGet(file_id).to_dict())
+    
+    def send_frame(self, message, priority=PRIORITY_CONTROL, upload_name=None):
+        """将一条完整的协议消息放入发送队列（重连期间也会排队，连接恢复后发送）"""
+        if not self.connected and not self.reconnecting_now:
+            return False
+        try:
+            msg_bytes = json.dumps(message).encode('utf-8')
+            self._enqueue(msg_bytes, priority, upload_name)
+            return True
+        except Exception as e:
+            print(f"发送消息失败: {e}")
+            return False
+    
+    def _enqueue(self, payload, priority, upload_name=None):
+        """将消息体（JSON字节串）放入发送队列；upload_name 不为空时写线程会汇报该帧的发送进度
+        
+        长度前缀和压缩在写线程发送时才加上，重连后使用新连接协商的压缩算法
+        """
+        self.outbound_queue.put((priority, next(self.outbound_counter), payload, upload_name))
+    
+    def _writer_loop(self, generation):
+        """写线程：按优先级取出队列中的帧并发送"""
+        while True:
+            item = self.outbound_queue.get()
+            _, _, payload, upload_name = item
+            if payload is None:
+                # 停止标记；之前连接遗留的停止标记直接丢弃
+                if upload_name is None or upload_name == generation:
+                    break
+                continue
+            try:
+                if upload_name is None:
+                    self.connection.send_payload(payload)
+                    continue
+                # 文件数据（base64编码的图片）压缩收益很小，不压缩
+                frame = self.connection.encode(payload, compressible=False)
+                # 大帧分块发送，每块单独计算超时，并汇报进度
+                view = memoryview(frame)
+                total = len(frame)
+                last_reported = 0
+                # 正在断开连接时也要发完整帧：残缺的帧会让服务器把断开通知当作帧的内容读取
+                for offset in range(0, total, self.SEND_CHUNK_SIZE):
+                    chunk = view[offset:offset + self.SEND_CHUNK_SIZE]
+                    self.client_socket.sendall(chunk)
+                    sent = offset + len(chunk)
+                    if sent == total or sent - last_reported >= total // 20:
+                        self.upload_progress.emit(upload_name, sent, total)
+                        last_reported = sent
+            except Exception as e:
+                if self.closing:
+                    return
+                # 发送失败说明连接已断开：整帧放回队列等重连后重发，并关闭socket让接收线程进入重连流程
+                print(f"发送消息失败，等待重连后重发: {e}")
+                self.outbound_queue.put(item)
+                try:
+                    self.client_socket.shutdown(socket.SHUT_RDWR)
+                except Exception:
+                    pass
+                return
+    
     def disconnect(self):
+        # 停止自动重连
+        self.stop_event.set()
         # 发送断开连接通知给服务器
         try:
             if self.connected and self.client_socket:
-                # 创建一个断开连接的消息
-                disconnect_message = {
-                    'type': 'disconnect',
-                    'username': self.username
-                }
-                msg_json = json.dumps(disconnect_message)
-                msg_bytes = msg_json.encode('utf-8')
-                header = struct.pack('!I', len(msg_bytes))
-                # 尝试发送断开连接消息，但不关心是否成功
-                try:
-                    self.client_socket.sendall(header + msg_bytes)
-                    # 给服务器一点时间处理消息
-                    time.sleep(0.1)
-                except:
-                    pass
+                # 断开连接的消息优先于队列中尚未发送的文件
+                self.send_frame(protocol.Disconnect(self.username).to_dict(), -1)
+                self.closing = True
+                self.outbound_queue.put((-1, next(self.outbound_counter), None, None))
+                # 写线程发完正在发送的帧后发送断开通知再退出；上传很慢时最多等待 DISCONNECT_FLUSH_TIMEOUT 秒
+                if self.writer_thread is not None:
+                    self.writer_thread.join(timeout=self.DISCONNECT_FLUSH_TIMEOUT)
+                    if self.writer_thread.is_alive():
+                        print("正在发送的文件未能及时发完，直接关闭连接")
+                # 给服务器一点时间处理消息
+                time.sleep(0.1)
                 # 关闭套接字
                 self.client_socket.close()
         finally:
+            self.closing = True
             self.connected = False
 
+class FileSendWorker(QThread):
+    """在后台线程中一次性读取并验证图片，然后把读入的数据直接交给发送流程"""
+    finished_sending = pyqtSignal(dict, bool)
+    validation_failed = pyqtSignal(str)
+    
+    def __init__(self, client, file_path, file_type, to=None):
+        super().__init__()
+        self.client = client
+        self.file_path = file_path
+        self.file_type = file_type
+        self.to = to  # 私聊接收者，为None时发送到当前房间
+    
+    def run(self):
+        try:
+            prepared = prepare_image(self.file_path)
+        except (ImageProbeError, OSError) as e:
+            self.validation_failed.emit(str(e))
+            return
+        print(f"文件验证通过: {prepared['format']} 格式 {prepared['width']}x{prepared['height']}")
+        limit = self.client.max_message_bytes
+        # base64 编码后约为原大小的4/3，另加少量消息字段
+        if limit and (len(prepared['data']) + 2) // 3 * 4 + 1024 > limit:
+            self.validation_failed.emit(f"文件过大: 服务器只接受不超过 {limit / (1024 * 1024):.1f}MB 的消息")
+            return
+        success = self.client.send_file(prepared, self.file_type, self.to)
+        self.finished_sending.emit(prepared, success)
+
 class ServerInfoDialog(QDialog):
     """服务器信息输入对话框"""
     def __init__(self, parent=None):
@@ -391,7 +712,7 @@ class ServerInfoDialog(QDialog):
         host_layout.addWidget(self.host_input)
         
         # 提示标签
-        hint_label = QLabel("支持格式：IP地址:端口 或 域名:端口，如不指定端口则默认为7995")
+        hint_label = QLabel("支持格式：IP地址:端口 或 域名:端口，如不指定端口则默认为7995；使用TLS连接时在地址前加 tls://")
         hint_label.setStyleSheet("color: #999999; font-size: 12px;")
         hint_label.setWordWrap(True)
         
@@ -508,6 +829,10 @@ class ChatWindow(QMainWindow):
         # 初始化配置管理器
         self.config_manager = ConfigManager()
         
+        # 初始化图片缓存（按内容哈希去重存储）
+        base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        self.image_cache = ImageCache(os.path.join(base_dir, 'chat_files', 'images'))
+        
         # 初始化UI
         self.init_ui()
         
@@ -523,6 +848,19 @@ class ChatWindow(QMainWindow):
         self.server_host = None
         self.server_port = None
         
+        # 已显示占位图、等待服务器发送内容的文件哈希
+        self.pending_files = set()
+        # 窗口最小化期间推迟请求的文件哈希，窗口恢复后再请求
+        self.deferred_fetches = []
+        # 正在后台读取和发送文件的线程
+        self.file_workers = []
+        # 用户点击预览图后等待下载、下载完成后用系统查看器打开的原图哈希
+        self.pending_full_views = set()
+        # 已显示占位图、等待服务器生成预览（file_preview 消息）的原图哈希
+        self.pending_previews = set()
+        # 正在显示服务器补发的历史消息，这些消息之前已保存过或不需要保存到本地
+        self.replaying_history = False
+        
         # 设置初始窗口标题
         self.setWindowTitle("intPlatinum - 连接中...")
         
@@ -573,13 +911,18 @@ class ChatWindow(QMainWindow):
     def try_connect_to_server(self):
         """尝试连接到服务器，启动异步连接"""
         try:
-            self.client = ChatClient(self.server_host, self.server_port, self.username)
+            self.client = ChatClient(self.server_host, self.server_port, self.username,
+                                     tls_ca_file=self.config_manager.get_tls_ca_file())
             self.client.message_received.connect(self.handle_message)
             self.client.connection_error.connect(self.handle_connection_error)
             self.client.version_mismatch.connect(self.show_version_error)
             self.client.connection_success.connect(self.handle_connection_success)
             self.client.banned_signal.connect(self.handle_banned)
             self.client.server_shutdown_signal.connect(self.handle_server_shutdown)
+            self.client.upload_progress.connect(self.handle_upload_progress)
+            self.client.reconnecting.connect(self.handle_reconnecting)
+            self.client.reconnected.connect(self.handle_reconnected)
+            self.client.messages_missed.connect(self.handle_messages_missed)
             
             # 启动连接线程，避免阻塞主线程
             self.client.start()
@@ -601,10 +944,46 @@ class ChatWindow(QMainWindow):
     def handle_connection_success(self):
         """处理连接成功"""
         # 连接成功
-        self.setWindowTitle(f"intPlatinum - {self.username}")
+        self.update_window_title()
         # 保存当前配置
         self.config_manager.save_config(self.server_host, self.server_port, self.username)
         
+    def handle_reconnecting(self, attempt, delay):
+        """连接意外断开，客户端正在自动重连"""
+        if attempt == 1:
+            self.display_system_message("与服务器的连接已断开，正在尝试重新连接...")
+            self.update_window_title("(重连中...)")
+        self.statusBar().showMessage(f"连接已断开，{delay:.0f} 秒后进行第 {attempt} 次重连...")
+        
+    def handle_reconnected(self, resumed):
+        """自动重连成功"""
+        self.update_window_title()
+        self.statusBar().showMessage("已重新连接到服务器", 3000)
+        if resumed:
+            self.display_system_message("已重新连接到服务器")
+        else:
+            self.display_system_message("已重新连接到服务器（原会话已过期，断开期间的消息无法显示）")
+        # 断开前还在等待的预览不会再送达，改为获取原图
+        pending_previews, self.pending_previews = self.pending_previews, set()
+        for file_hash in pending_previews:
+            self.fetch_pending_file(file_hash)
+        
+    def update_window_title(self, status=None):
+        """在窗口标题中显示昵称、所在房间和连接状态"""
+        title = f"intPlatinum - {self.username}"
+        if self.client is not None and self.client.room:
+            title += f" #{self.client.room}"
+        if status:
+            title += f" {status}"
+        self.setWindowTitle(title)
+        
+    def handle_messages_missed(self, count):
+        """根据消息序号发现有消息没有收到"""
+        if self.replaying_history:
+            # 补发历史消息时已经提示过更早的消息无法获取
+            return
+        self.display_system_message(f"有 {count} 条消息未能收到")
+        
     def ask_retry_connection(self):
         """询问用户是否重试连接"""
         error_msg = getattr(self, 'connection_error_message', '连接失败')
@@ -677,6 +1056,9 @@ class ChatWindow(QMainWindow):
         
         # 为用户列表添加点击事件
         self.user_list.itemClicked.connect(self.show_user_info)
+        # 右键菜单：私聊
+        self.user_list.setContextMenuPolicy(Qt.CustomContextMenu)
+        self.user_list.customContextMenuRequested.connect(self.show_user_menu)
         
         left_layout.addLayout(top_bar_layout)
         left_layout.addWidget(self.user_list)
@@ -688,7 +1070,9 @@ class ChatWindow(QMainWindow):
         # 聊天显示区域
         self.chat_display = QTextBrowser()
         self.chat_display.setReadOnly(True)
-        self.chat_display.setOpenExternalLinks(True)  # 允许打开外部链接
+        # 链接由 handle_anchor_clicked 统一处理（外部链接和预览图的原图链接）
+        self.chat_display.setOpenLinks(False)
+        self.chat_display.anchorClicked.connect(self.handle_anchor_clicked)
         
         # 输入区域
         input_panel = QWidget()
@@ -720,6 +1104,9 @@ class ChatWindow(QMainWindow):
         main_layout.addWidget(splitter)
         self.setCentralWidget(main_widget)
         
+        # 状态栏用于显示图片上传进度
+        self.statusBar().setStyleSheet("color: #cccccc;")
+        
         # 应用暗黑模式样式
         self.apply_dark_mode()
         
@@ -922,6 +1309,10 @@ class ChatWindow(QMainWindow):
         message = self.message_input.text().strip()
         if not message:
             return
+        if len(message) > protocol.MAX_TEXT_LENGTH:
+            # 服务器会丢弃超过长度上限的消息
+            self.display_system_message(f"消息过长，最多 {protocol.MAX_TEXT_LENGTH} 个字符")
+            return
         
         # 获取当前时间
         current_time = time.time()
@@ -944,6 +1335,30 @@ class ChatWindow(QMainWindow):
             msg_box.exec_()
             return
         
+        # 私聊命令：/w <用户名> <内容>
+        if message.startswith('/w '):
+            parts = message.split(None, 2)
+            if len(parts) < 3:
+                self.display_system_message("用法: /w <用户名> <消息内容>")
+                return
+            _, to, content = parts
+            if self.client.send_direct(to, content):
+                self.message_input.clear()
+                self.last_message_time = time.time()
+                self.display_text_message(self.username, content, direct_to=to)
+                self.save_text_message(self.direct_label(self.username, to), content)
+            return
+        
+        # 房间命令：/join <房间名> 进入房间，/leave 回到大厅
+        if message.startswith('/join ') or message == '/leave':
+            if message == '/leave':
+                sent = self.client.leave_room()
+            else:
+                sent = self.client.join_room(message[len('/join '):].strip())
+            if sent:
+                self.message_input.clear()
+            return
+        
         if self.client.send_message('text', message):
             self.message_input.clear()
             # 更新上次发送消息的时间
@@ -952,119 +1367,51 @@ class ChatWindow(QMainWindow):
             # 保存到本地
             self.save_text_message(self.username, message)
     
-    def is_valid_image_file(self, file_path):
-        """验证文件是否为有效的图片文件（多重验证机制）"""
-        try:
-            # 1. 检查文件大小限制（最大10MB）
-            file_size = os.path.getsize(file_path)
-            max_size = 10 * 1024 * 1024  # 10MB
-            if file_size > max_size:
-                print(f"文件过大: {file_size} bytes > {max_size} bytes")
-                return False
-            
-            # 2. 检查文件头魔数
-            with open(file_path, 'rb') as f:
-                header = f.read(32)  # 读取前32字节用于更准确的检查
-                
-            # 支持的图片格式及其魔数
-            valid_formats = {
-                'PNG': b'\x89PNG\r\n\x1a\n',
-                'JPEG': b'\xff\xd8\xff',
-                'GIF87a': b'GIF87a',
-                'GIF89a': b'GIF89a',
-                'BMP': b'BM',
-                'WEBP': b'RIFF'
-            }
-            
-            detected_format = None
-            for format_name, magic in valid_formats.items():
-                if header.startswith(magic):
-                    if format_name == 'WEBP' and b'WEBP' not in header[:16]:
-                        continue
-                    detected_format = format_name
-                    break
-            
-            if not detected_format:
-                print("未检测到有效的图片文件头")
-                return False
-            
-            # 3. 使用PIL库验证图片完整性
-            try:
-                from PIL import Image
-                with Image.open(file_path) as img:
-                    # 验证图片可以正常加载
-                    img.verify()
-                    
-                # 重新打开图片进行格式验证（verify后图片对象会被关闭）
-                with Image.open(file_path) as img:
-                    # 检查图片格式是否与文件头一致
-                    pil_format = img.format
-                    if pil_format not in ['PNG', 'JPEG', 'GIF', 'BMP', 'WEBP']:
-                        print(f"不支持的图片格式: {pil_format}")
-                        return False
-                    
-                    # 检查图片尺寸是否合理（防止恶意构造的超大尺寸图片）
-                    width, height = img.size
-                    max_dimension = 8192  # 最大8K分辨率
-                    if width > max_dimension or height > max_dimension:
-                        print(f"图片尺寸过大: {width}x{height}")
-                        return False
-                        
-            except ImportError:
-                print("警告: 未安装PIL库，跳过深度验证")
-                # 如果没有PIL库，只进行基础的文件头检查
-                pass
-            except Exception as pil_error:
-                print(f"PIL验证失败: {pil_error}")
-                return False
-            
-            # 4. 检查文件扩展名与内容的一致性
-            file_ext = os.path.splitext(file_path)[1].lower()
-            valid_extensions = ['.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp']
-            if file_ext not in valid_extensions:
-                print(f"不支持的文件扩展名: {file_ext}")
-                return False
-            
-            print(f"文件验证通过: {detected_format} 格式")
-            return True
-            
-        except Exception as e:
-            print(f"文件验证错误: {e}")
-            return False
-    
-    def send_file(self, file_type):
-        """发送文件（图片）功能"""
+    def send_file(self, file_type, to=None):
+        """发送文件（图片）功能，指定 to 时私聊发送给该用户"""
         if file_type == 'images':
             file_path, _ = QFileDialog.getOpenFileName(self, "选择图片", "", "图片文件 (*.png *.jpg *.jpeg *.gif *.bmp *.webp)")
 
         if not file_path:
             return
             
-        # 验证文件是否为真正的图片文件
-        if file_type == 'images' and not self.is_valid_image_file(file_path):
-            QMessageBox.warning(self, "文件验证失败", 
-                              "文件验证失败！请确保：\n"
-                              "• 文件是有效的图片格式（PNG、JPEG、GIF、BMP、WebP）\n"
-                              "• 文件大小不超过10MB\n"
-                              "• 图片尺寸不超过8192x8192像素\n"
-                              "• 文件扩展名与实际内容一致")
-            return
-            
-        # 获取原始文件名
-        original_file_name = os.path.basename(file_path)
-            
-        try:
-            if self.client.send_file(file_path, file_type):
-                # 发送成功后保存文件到本地并显示
-                self.save_file(self.username, file_path, file_type)
-                # 使用原始文件名显示
-                self.display_file_message(self.username, file_type, original_file_name, original_file_name)
-            else:
-                # 文件发送失败
-                self.chat_display.append(f"[发送图片失败: {original_file_name}]")
-        except Exception as e:
-            print(f"发送文件时发生错误: {e}")
-            self.chat_display.append(f"[发送图片时发生错误: {original_file_name}]")
+        # 在后台线程中一次性读取、验证并发送文件，避免大文件阻塞界面
+        worker = FileSendWorker(self.client, file_path, file_type, to)
+        worker.validation_failed.connect(self.handle_file_validation_failed)
+        worker.finished_sending.connect(lambda prepared, success: self.handle_file_sent(prepared, file_type, success, to))
+        worker.finished.connect(lambda: self.file_workers.remove(worker))
+        self.file_workers.append(worker)
+        worker.start()
+    
+    def handle_upload_progress(self, file_name, sent, total):
+        """在状态栏显示图片上传进度"""
+        if sent >= total:
+            self.statusBar().showMessage(f"图片已上传: {file_name}", 3000)
+        else:
+            percent = int(sent * 100 / total) if total else 100
+            self.statusBar().showMessage(f"正在上传 {file_name}: {percent}%")
+    
+    def handle_file_validation_failed(self, reason):
+        """文件预检失败时提示用户具体原因（大小上限取决于服务器，已包含在原因中）"""
+        print(f"文件验证失败: {reason}")
+        QMessageBox.warning(self, "文件验证失败", 
+                          f"文件验证失败: {reason}\n\n"
+                          "请确保：\n"
+                          "• 文件是有效的图片格式（PNG、JPEG、GIF、BMP、WebP）\n"
+                          f"• 图片尺寸不超过{MAX_IMAGE_DIMENSION}x{MAX_IMAGE_DIMENSION}像素\n"
+                          "• 文件扩展名与实际内容一致")
+    
+    def handle_file_sent(self, prepared, file_type, success, to=None):
+        """文件发送完成后保存到本地缓存并显示"""
+        original_file_name = prepared['original_file_name']
+        if success:
+            sender = self.direct_label(self.username, to) if to else self.username
+            file_hash = self.save_file(sender, prepared, file_type)
+            # 使用原始文件名显示
+            self.display_file_message(sender, file_type, original_file_name, original_file_name, file_hash=file_hash)
+        else:
+            # 文件发送失败
+            self.chat_display.append(f"[发送图片失败: {original_file_name}]")
                      
     def display_file_from_path(self, sender, file_path):
         """从指定路径直接显示文件"""
@@ -1103,8 +1450,8 @@ class ChatWindow(QMainWindow):
             
             self.display_text_message(sender, content, timestamp)
             
-            # 保存到本地（如果不是自己发送的）
-            if sender != self.username:
+            # 保存到本地（如果不是自己发送的，补发的历史消息不重复保存）
+            if sender != self.username and not self.replaying_history:
                 self.save_text_message(sender, content)
                 
         elif msg_type == 'file':
@@ -1113,13 +1460,90 @@ class ChatWindow(QMainWindow):
             file_name = message.get('file_name')
             original_file_name = message.get('original_file_name', file_name)  # 如果没有原始文件名，使用混淆后的文件名
             file_data_b64 = message.get('file_data')
+            file_hash = message.get('file_hash')
             timestamp = message.get('timestamp')
             
             # 对于发送者自己的消息，我们已经在发送时立即显示了，所以这里不需要再显示
             # 只需要处理接收的文件
             if sender != self.username:
                 # 保存并显示接收的文件，传入原始文件名用于显示
-                self.save_received_file(sender, file_type, file_name, original_file_name, file_data_b64)
+                self.save_received_file(sender, file_type, file_name, original_file_name, file_data_b64, file_hash)
+                
+        elif msg_type == 'file_announce':
+            # 服务器只通告了文件元数据，本地缓存中没有时才请求文件内容
+            sender = message.get('sender')
+            file_hash = message.get('file_hash')
+            if sender != self.username and file_hash:
+                if self.image_cache.has(file_hash):
+                    self.save_received_file(sender, message.get('file_type'), message.get('file_name'),
+                                            message.get('original_file_name', message.get('file_name')), None, file_hash)
+                elif message.get('preview_data'):
+                    # 服务器附带了缩略图，先显示缩略图，原图在点击时再获取
+                    self.display_preview_message(message)
+                elif message.get('preview_pending'):
+                    # 预览正在生成：先显示可点击的占位图，预览由之后的 file_preview 消息送达
+                    file_name = message.get('file_name')
+                    original_file_name = message.get('original_file_name', file_name)
+                    self.log_file_message(sender, original_file_name)
+                    self.display_file_message(sender, message.get('file_type'), file_name, original_file_name,
+                                              message.get('timestamp'), file_hash=file_hash, full_link=file_hash,
+                                              pending=True)
+                    self.pending_previews.add(file_hash)
+                else:
+                    # 先在消息位置显示占位图，文件内容在需要显示时再向服务器获取
+                    file_name = message.get('file_name')
+                    original_file_name = message.get('original_file_name', file_name)
+                    self.log_file_message(sender, original_file_name)
+                    self.display_file_message(sender, message.get('file_type'), file_name, original_file_name,
+                                              message.get('timestamp'), file_hash=file_hash, pending=True)
+                    self.fetch_pending_file(file_hash)
+                    
+        elif msg_type == 'file_preview':
+            # 服务器生成的预览到达；没有预览数据（生成失败或超时）时改为获取原图
+            file_hash = message.get('file_id')
+            if file_hash not in self.pending_previews:
+                return
+            self.pending_previews.discard(file_hash)
+            if message.get('preview_data'):
+                try:
+                    preview_data = base64.b64decode(message['preview_data'])
+                    preview_hash = self.image_cache.put(preview_data, image_extension(preview_data))
+                except Exception as e:
+                    print(f"预览图无效: {e}")
+                else:
+                    self.fill_pending_image(file_hash, source_hash=preview_hash)
+                    return
+            self.fetch_pending_file(file_hash)
+                
+        elif msg_type == 'file_data':
+            # 请求的文件内容到达，存入缓存后替换占位图
+            file_hash = message.get('file_id') or message.get('file_hash')
+            pending = file_hash in self.pending_files
+            full_view = file_hash in self.pending_full_views
+            self.pending_files.discard(file_hash)
+            self.pending_full_views.discard(file_hash)
+            if not self.image_cache.has(file_hash):
+                try:
+                    file_data = base64.b64decode(message.get('file_data', ''))
+                    # 扩展名按实际内容确定：对方提供的文件名不可信，缓存的原图会交给系统程序打开
+                    self.image_cache.put(file_data, image_extension(file_data))
+                except Exception as e:
+                    print(f"文件数据无效: {e}")
+                    if pending:
+                        self.fill_pending_image(file_hash, self.make_placeholder_pixmap("图片无法显示"))
+                    return
+            if pending:
+                self.fill_pending_image(file_hash)
+            if full_view:
+                self.open_cached_image(file_hash)
+                
+        elif msg_type == 'file_unavailable':
+            # 服务器缓存中的文件已过期或被淘汰
+            file_hash = message.get('file_id') or message.get('file_hash')
+            self.pending_full_views.discard(file_hash)
+            if file_hash in self.pending_files:
+                self.pending_files.discard(file_hash)
+                self.fill_pending_image(file_hash, self.make_placeholder_pixmap("图片已过期"))
                 
         elif msg_type == 'system':
             content = message.get('content')
@@ -1131,6 +1555,52 @@ class ChatWindow(QMainWindow):
             users = message.get('users', [])
             self.update_user_list(users)
             
+        elif msg_type == 'direct':
+            sender = message.get('sender')
+            label = self.direct_label(sender, self.username)
+            if 'file_type' in message:
+                # 私聊文件与群发文件的显示流程相同，只是发送者显示为私聊
+                file_message = dict(message, sender=label, type='file' if message.get('file_data') else 'file_announce')
+                self.handle_message(file_message)
+            else:
+                self.display_text_message(sender, message.get('content', ''), message.get('timestamp'),
+                                          direct_to=self.username)
+                self.save_text_message(label, message.get('content', ''))
+                
+        elif msg_type == 'direct_ack':
+            status = message.get('status')
+            to = message.get('to')
+            if status == 'offline':
+                self.display_system_message(f"{to} 不在线，私聊消息未送达")
+            elif status == 'unsupported':
+                self.display_system_message(f"{to} 的客户端版本不支持私聊，消息未送达")
+            elif status == 'invalid':
+                self.display_system_message("不能给自己发送私聊消息")
+                
+        elif msg_type == 'room_joined':
+            self.user_list.clear()
+            self.update_window_title()
+            self.display_system_message(f"已进入房间 #{message.get('room')}")
+            
+        elif msg_type == 'room_error':
+            self.display_system_message(message.get('content', '无法进入房间'))
+            
+        elif msg_type == 'history':
+            # 服务器开始补发最近的消息
+            self.replaying_history = True
+            count = message.get('count', 0)
+            if message.get('resumed'):
+                notice = f"以下是断开期间错过的 {count} 条消息"
+            else:
+                notice = f"以下是最近的 {count} 条消息"
+            if message.get('truncated'):
+                notice += "（更早的消息已无法获取）"
+            self.display_system_message(notice)
+            
+        elif msg_type == 'history_end':
+            self.replaying_history = False
+            self.display_system_message("以上为历史消息")
+            
         elif msg_type == 'popup_message':
             content = message.get('content')
             self.show_popup_message(content)
@@ -1139,7 +1609,11 @@ class ChatWindow(QMainWindow):
             content = message.get('content')
             self.show_popup_announcement(content)
     
-    def display_text_message(self, sender, content, timestamp=None):
+    def direct_label(self, sender, to):
+        """私聊消息显示的发送者标签"""
+        return f"{sender} → {to} (私聊)"
+    
+    def display_text_message(self, sender, content, timestamp=None, direct_to=None):
         cursor = self.chat_display.textCursor()
         cursor.movePosition(QTextCursor.End)
         self.chat_display.setTextCursor(cursor)
@@ -1150,8 +1624,9 @@ class ChatWindow(QMainWindow):
         # 设置发送者名称颜色
         sender_color = "#90EE90" if sender == self.username else "#ADD8E6"
         
-        # 构建HTML消息内容，使用普通文本显示用户名
-        html_message = f'<font color="{sender_color}"><b>{sender}</b> [{time_str}]:<br></font>'
+        # 构建HTML消息内容，使用普通文本显示用户名；私聊消息同时显示接收者
+        sender_label = self.direct_label(sender, direct_to) if direct_to else sender
+        html_message = f'<font color="{sender_color}"><b>{sender_label}</b> [{time_str}]:<br></font>'
         html_message += f'<font color="#FFFFFF">{content.replace("<", "&lt;").replace(">", "&gt;")}</font><br><br>'
         
         # 插入HTML消息
@@ -1160,7 +1635,104 @@ class ChatWindow(QMainWindow):
         # 滚动到底部
         self.chat_display.verticalScrollBar().setValue(self.chat_display.verticalScrollBar().maximum())
     
-    def display_file_message(self, sender, file_type, file_name, original_file_name=None, timestamp=None):
+    def display_preview_message(self, message):
+        """显示服务器生成的缩略图，点击后获取并打开原图"""
+        sender = message.get('sender')
+        file_name = message.get('file_name')
+        original_file_name = message.get('original_file_name', file_name)
+        try:
+            preview_data = base64.b64decode(message['preview_data'])
+            preview_hash = self.image_cache.put(preview_data, image_extension(preview_data))
+        except Exception as e:
+            print(f"预览图无效: {e}")
+            return
+        
+        self.log_file_message(sender, original_file_name)
+        # 链接中只有原图的哈希，原图的扩展名在下载后按内容确定
+        self.display_file_message(sender, message.get('file_type'), file_name, original_file_name,
+                                  message.get('timestamp'), file_hash=preview_hash, full_link=message.get('file_hash'))
+    
+    def handle_anchor_clicked(self, url):
+        """处理聊天区域中的链接点击"""
+        if url.scheme() == 'intplatinum-file':
+            # 预览图链接（原图的哈希）：原图已在缓存中则直接打开，否则向服务器请求
+            file_hash = url.path()
+            if self.image_cache.has(file_hash):
+                self.open_cached_image(file_hash)
+            elif file_hash not in self.pending_full_views:
+                self.pending_full_views.add(file_hash)
+                if file_hash not in self.pending_files:
+                    self.fetch_file(file_hash)
+        else:
+            QDesktopServices.openUrl(url)
+    
+    def fetch_pending_file(self, file_hash):
+        """获取已显示占位图的文件内容，到达后替换占位图"""
+        if file_hash not in self.pending_files:
+            self.pending_files.add(file_hash)
+            self.fetch_file(file_hash)
+    
+    def fetch_file(self, file_hash):
+        """请求文件内容；窗口最小化或隐藏时推迟到窗口恢复后再请求，避免下载不会被看到的图片"""
+        if self.isMinimized() or not self.isVisible():
+            if file_hash not in self.deferred_fetches:
+                self.deferred_fetches.append(file_hash)
+        elif self.client is not None:
+            self.client.request_file(file_hash)
+    
+    def changeEvent(self, event):
+        """窗口从最小化恢复时，请求推迟的文件"""
+        super().changeEvent(event)
+        if event.type() == QEvent.WindowStateChange and not self.isMinimized() and self.deferred_fetches:
+            deferred, self.deferred_fetches = self.deferred_fetches, []
+            for file_hash in deferred:
+                self.fetch_file(file_hash)
+    
+    def make_placeholder_pixmap(self, text):
+        """生成带提示文字的占位图"""
+        pixmap = QPixmap(240, 60)
+        pixmap.fill(QColor(60, 60, 60))
+        painter = QPainter(pixmap)
+        painter.setPen(QColor(200, 200, 200))
+        painter.drawText(pixmap.rect(), Qt.AlignCenter, text)
+        painter.end()
+        return pixmap
+    
+    def fill_pending_image(self, file_hash, pixmap=None, source_hash=None):
+        """用到达的图片（或指定的占位图）替换聊天记录中的占位图，source_hash 为显示的图片（如预览图）的哈希"""
+        if pixmap is None:
+            file_path = self.image_cache.get_path(source_hash or file_hash)
+            pixmap = QPixmap(file_path) if file_path else QPixmap()
+            if pixmap.isNull():
+                pixmap = self.make_placeholder_pixmap("图片无法显示")
+            else:
+                # 限制图片最大宽度为聊天窗口的80%
+                max_width = int(self.chat_display.width() * 0.8)
+                if pixmap.width() > max_width:
+                    pixmap = pixmap.scaledToWidth(max_width, Qt.SmoothTransformation)
+        document = self.chat_display.document()
+        document.addResource(QTextDocument.ImageResource, QUrl(f"intplatinum-image:{file_hash}"), pixmap)
+        # 资源替换后需要重新排版，图片尺寸才会更新
+        document.markContentsDirty(0, document.characterCount())
+    
+    def log_file_message(self, sender, file_name):
+        """记录收到的文件消息到文本日志"""
+        try:
+            base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+            log_path = os.path.join(base_dir, 'chat_files', 'text', f"{datetime.now().strftime('%Y%m%d')}.txt")
+            with open(log_path, 'a', encoding='utf-8') as f:
+                time_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                f.write(f"[{time_str}] {sender} 发送了图片: {file_name}\n")
+        except Exception as e:
+            print(f"保存文本消息错误: {e}")
+    
+    def open_cached_image(self, file_hash):
+        """用系统图片查看器打开缓存中的原图（只打开图片扩展名的文件）"""
+        file_path = self.image_cache.get_path(file_hash)
+        if file_path and os.path.splitext(file_path)[1].lower() in VALID_EXTENSIONS:
+            QDesktopServices.openUrl(QUrl.fromLocalFile(os.path.abspath(file_path)))
+    
+    def display_file_message(self, sender, file_type, file_name, original_file_name=None, timestamp=None, file_hash=None, full_link=None, pending=False):
         cursor = self.chat_display.textCursor()
         cursor.movePosition(QTextCursor.End)
         self.chat_display.setTextCursor(cursor)
@@ -1178,19 +1750,17 @@ class ChatWindow(QMainWindow):
         self.chat_display.setTextColor(QColor(218, 112, 214))
         self.chat_display.setFontWeight(QFont.Normal)
         
-        base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
         file_type_str = "图片"
         
         # 使用原始文件名显示，如果没有则使用混淆后的文件名
         display_file_name = original_file_name if original_file_name else file_name
         
         if file_type == "images":
-            # 显示图片
-            file_path = os.path.join(base_dir, 'chat_files', file_type, file_name)
+            # 通过缓存索引查找图片，不在缓存中时返回None
+            file_path = self.image_cache.get_path(file_hash)
             print(f"尝试显示图片: {file_path}")
             
-            # 先检查文件是否存在
-            if os.path.exists(file_path):
+            if file_path:
                 self.chat_display.insertPlainText(f"[发送了{file_type_str}: {display_file_name}]\n")
                 
                 try:
@@ -1209,17 +1779,41 @@ class ChatWindow(QMainWindow):
                             QUrl.fromLocalFile(abs_path),
                             pixmap
                         )
-                        self.chat_display.textCursor().insertImage(QUrl.fromLocalFile(abs_path).toString())
-                        self.chat_display.insertPlainText("\n\n")
+                        if full_link:
+                            # 缩略图：用链接包裹图片，点击后获取原图
+                            self.chat_display.insertHtml(
+                                f'<a href="intplatinum-file:{html.escape(full_link)}">'
+                                f'<img src="{html.escape(QUrl.fromLocalFile(abs_path).toString())}"></a>'
+                            )
+                            self.chat_display.insertPlainText("\n[点击图片查看原图]\n\n")
+                        else:
+                            self.chat_display.textCursor().insertImage(QUrl.fromLocalFile(abs_path).toString())
+                            self.chat_display.insertPlainText("\n\n")
                     else:
                         print(f"图片加载失败: {file_path}")
                         self.chat_display.insertPlainText("[图片无法显示]\n\n")
                 except Exception as e:
                     print(f"图片显示错误: {e}")
                     self.chat_display.insertPlainText("[图片无法显示]\n\n")
+            elif pending:
+                # 图片内容尚未获取，先插入占位图，内容到达后由 fill_pending_image 替换
+                self.chat_display.insertPlainText(f"[发送了{file_type_str}: {display_file_name}]\n")
+                image_url = QUrl(f"intplatinum-image:{file_hash}")
+                document = self.chat_display.document()
+                if document.resource(QTextDocument.ImageResource, image_url) is None:
+                    document.addResource(QTextDocument.ImageResource, image_url, self.make_placeholder_pixmap("图片加载中..."))
+                if full_link:
+                    # 等待预览的占位图同样可以点击查看原图
+                    self.chat_display.insertHtml(
+                        f'<a href="intplatinum-file:{html.escape(full_link)}"><img src="{html.escape(image_url.toString())}"></a>'
+                    )
+                    self.chat_display.insertPlainText("\n[点击图片查看原图]\n\n")
+                else:
+                    self.chat_display.textCursor().insertImage(image_url.toString())
+                    self.chat_display.insertPlainText("\n\n")
             else:
-                print(f"文件不存在: {file_path}")
-                self.chat_display.insertPlainText(f"[发送了{file_type_str}: {file_name}]\n\n")
+                print(f"图片不在缓存中: {file_hash}")
+                self.chat_display.insertPlainText(f"[发送了{file_type_str}: {display_file_name}]\n\n")
 
         
         # 滚动到底部
@@ -1244,6 +1838,29 @@ class ChatWindow(QMainWindow):
     
 
     
+    def show_user_menu(self, pos):
+        """用户列表右键菜单：私聊文字或图片"""
+        item = self.user_list.itemAt(pos)
+        if item is None or item.text() == self.username:
+            return
+        username = item.text()
+        menu = QMenu(self)
+        menu.setStyleSheet("""
+            QMenu { background-color: #3c3c3c; color: #ffffff; border: 1px solid #555555; border-radius: 5px; }
+            QMenu::item { padding: 8px 20px; }
+            QMenu::item:hover { background-color: #4c4c4c; }
+        """)
+        text_action = menu.addAction("私聊")
+        text_action.triggered.connect(lambda: self.start_direct_message(username))
+        image_action = menu.addAction("私聊发送图片")
+        image_action.triggered.connect(lambda: self.send_file('images', username))
+        menu.exec_(self.user_list.mapToGlobal(pos))
+    
+    def start_direct_message(self, username):
+        """在输入框中填入私聊命令"""
+        self.message_input.setText(f"/w {username} ")
+        self.message_input.setFocus()
+    
     def show_user_info(self, item):
         """显示用户信息（从用户列表点击）"""
         username = item.text()
@@ -1283,15 +1900,14 @@ class ChatWindow(QMainWindow):
         except Exception as e:
             print(f"保存文本消息错误: {e}")
     
-    def save_file(self, sender, file_path, file_type):
+    def save_file(self, sender, prepared, file_type):
+        """将发送的图片存入缓存，返回内容哈希，失败时返回None"""
         try:
             base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-            file_name = os.path.basename(file_path)
-            dest_path = os.path.join(base_dir, 'chat_files', file_type, file_name)
+            file_name = prepared['original_file_name']
             
-            # 复制文件
-            with open(file_path, 'rb') as src_file, open(dest_path, 'wb') as dest_file:
-                dest_file.write(src_file.read())
+            # 直接使用预检时读入的数据存入内容寻址缓存，重复的图片只保存一份
+            file_hash = self.image_cache.put(prepared['data'], prepared['file_ext'])
                 
             # 记录到文本日志
             log_path = os.path.join(base_dir, 'chat_files', 'text', f"{datetime.now().strftime('%Y%m%d')}.txt")
@@ -1299,18 +1915,20 @@ class ChatWindow(QMainWindow):
                 time_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
                 file_type_str = "图片"
                 f.write(f"[{time_str}] {sender} 发送了{file_type_str}: {file_name}\n")
+            return file_hash
         except Exception as e:
             print(f"保存文件错误: {e}")
+            return None
     
-    def save_received_file(self, sender, file_type, file_name, original_file_name, file_data_b64):
+    def save_received_file(self, sender, file_type, file_name, original_file_name, file_data_b64, file_hash=None):
         try:
             base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-            dest_path = os.path.join(base_dir, 'chat_files', file_type, file_name)
             
-            # 解码并保存文件
-            file_data = base64.b64decode(file_data_b64)
-            with open(dest_path, 'wb') as f:
-                f.write(file_data)
+            # 缓存中已有相同内容时跳过解码和写盘
+            if not self.image_cache.has(file_hash):
+                file_data = base64.b64decode(file_data_b64)
+                # 扩展名按实际内容确定，不使用对方提供的文件名
+                file_hash = self.image_cache.put(file_data, image_extension(file_data))
                 
             # 记录到文本日志
             log_path = os.path.join(base_dir, 'chat_files', 'text', f"{datetime.now().strftime('%Y%m%d')}.txt")
@@ -1320,7 +1938,7 @@ class ChatWindow(QMainWindow):
                 f.write(f"[{time_str}] {sender} 发送了{file_type_str}: {original_file_name}\n")
                 
             # 显示接收到的文件消息，传入原始文件名用于显示
-            self.display_file_message(sender, file_type, file_name, original_file_name)
+            self.display_file_message(sender, file_type, file_name, original_file_name, file_hash=file_hash)
         except Exception as e:
             print(f"保存接收文件错误: {e}")
     
@@ -1524,6 +2142,8 @@ class ChatWindow(QMainWindow):
         if msg_box.exec_() == QMessageBox.Yes:
             if self.client is not None:
                 self.client.disconnect()
+            # 保存图片缓存的使用顺序
+            self.image_cache.flush()
             event.accept()
         else:
             event.ignore()
@@ -3,7 +3,7 @@
 
 a = Analysis(
     ['D:\\0\\intplatinum\\client\\client.py'],
-    pathex=[],
+    pathex=['D:\\0\\intplatinum'],
     binaries=[],
     datas=[],
     hiddenimports=[],
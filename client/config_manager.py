@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 """
 配置管理器模块
-负责保存和加载客户端配置信息，如服务器地址、端口和用户名
+负责保存和加载客户端配置信息，如服务器地址、端口、用户名和TLS的CA证书
 """
 import os
 import json
@@ -19,7 +19,8 @@ class ConfigManager:
         self.default_config = {
             'server_host': 'localhost',
             'server_port': 7995,
-            'username': ''
+            'username': '',
+            'tls_ca_file': ''
         }
         # 确保配置文件存在
         self._ensure_config_file_exists()
@@ -77,6 +78,20 @@ class ConfigManager:
         config = self._load_config()
         return config.get('username', self.default_config['username'])
     
+    def get_tls_ca_file(self):
+        """获取用于验证服务器证书的CA文件路径
+        
+        用于自签名证书的服务器；相对路径相对于配置文件所在目录
+        
+        Returns:
+            str: CA文件的绝对路径，如果没有配置则返回None（使用系统的受信任证书）
+        """
+        config = self._load_config()
+        ca_file = config.get('tls_ca_file') or ''
+        if not ca_file:
+            return None
+        return os.path.join(os.path.dirname(self.config_file), ca_file)
+    
     def save_config(self, server_host, server_port, username):
         """保存配置信息
         
@@ -88,9 +103,11 @@ class ConfigManager:
         Returns:
             bool: 保存是否成功
         """
-        config = {
+        # 保留手动编辑的其他配置项（如 tls_ca_file）
+        config = dict(self._load_config())
+        config.update({
             'server_host': server_host,
             'server_port': server_port,
             'username': username
-        }
+        })
         return self._save_config(config)
\ No newline at end of file
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+图片缓存模块
+按图片内容的哈希值存储收发的图片，相同内容只保存一份，
+并在总大小超过上限时按最近最少使用（LRU）顺序淘汰旧图片
+"""
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+from image_probe import VALID_EXTENSIONS
+
+
+class ImageCache:
+    """内容寻址的图片缓存，索引保存在缓存目录下的 index.json 中"""
+
+    # 默认缓存上限：256MB
+    DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+    INDEX_FILE_NAME = 'index.json'
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.index_file = os.path.join(cache_dir, self.INDEX_FILE_NAME)
+        # 哈希 -> {'ext': 扩展名, 'size': 字节数}，顺序即LRU顺序（末尾为最近使用）
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._dirty = False
+        self._lock = threading.Lock()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_index()
+
+    @staticmethod
+    def compute_hash(data):
+        """计算图片内容的哈希值（SHA-256 十六进制字符串）"""
+        return hashlib.sha256(data).hexdigest()
+
+    def _path_for(self, file_hash, ext):
+        return os.path.join(self.cache_dir, f"{file_hash}{ext}")
+
+    def _load_index(self):
+        """加载索引文件，丢弃磁盘上已不存在的条目"""
+        try:
+            if not os.path.exists(self.index_file):
+                return
+            with open(self.index_file, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+            for entry in entries:
+                file_hash = entry.get('hash')
+                ext = entry.get('ext', '')
+                if not file_hash or ext not in VALID_EXTENSIONS:
+                    # 不是图片扩展名的文件不能交给系统程序打开
+                    self._dirty = True
+                    continue
+                path = self._path_for(file_hash, ext)
+                if not os.path.exists(path):
+                    self._dirty = True
+                    continue
+                size = os.path.getsize(path)
+                self._entries[file_hash] = {'ext': ext, 'size': size}
+                self._total_bytes += size
+        except (json.JSONDecodeError, IOError, AttributeError) as e:
+            print(f"加载图片缓存索引失败: {e}")
+            self._entries.clear()
+            self._total_bytes = 0
+        # 上限可能在两次运行之间被调小
+        self._evict()
+
+    def _save_index(self):
+        """保存索引文件（先写临时文件再替换，避免写到一半时损坏）"""
+        entries = [{'hash': h, 'ext': e['ext'], 'size': e['size']} for h, e in self._entries.items()]
+        tmp_path = self.index_file + '.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(entries, f, ensure_ascii=False)
+            os.replace(tmp_path, self.index_file)
+            self._dirty = False
+        except Exception as e:
+            print(f"保存图片缓存索引失败: {e}")
+
+    def _evict(self):
+        """淘汰最久未使用的图片，直到总大小不超过上限"""
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            file_hash, entry = self._entries.popitem(last=False)
+            self._total_bytes -= entry['size']
+            self._dirty = True
+            try:
+                os.remove(self._path_for(file_hash, entry['ext']))
+            except OSError:
+                pass
+
+    def has(self, file_hash):
+        """检查缓存中是否已有该哈希的图片"""
+        with self._lock:
+            return bool(file_hash) and file_hash in self._entries
+
+    def get_path(self, file_hash):
+        """返回图片的本地路径并标记为最近使用，不存在时返回None"""
+        with self._lock:
+            entry = self._entries.get(file_hash) if file_hash else None
+            if entry is None:
+                return None
+            self._entries.move_to_end(file_hash)
+            self._dirty = True
+            return self._path_for(file_hash, entry['ext'])
+
+    def put(self, data, ext):
+        """存入图片数据，返回其哈希值；内容已存在时只更新使用顺序
+
+        ext 必须是 image_probe.VALID_EXTENSIONS 中的图片扩展名，否则抛出 ValueError。
+        """
+        file_hash = self.compute_hash(data)
+        ext = (ext or '').lower()
+        if ext not in VALID_EXTENSIONS:
+            raise ValueError(f"不支持的图片扩展名: {ext!r}")
+        with self._lock:
+            if file_hash in self._entries:
+                self._entries.move_to_end(file_hash)
+                self._dirty = True
+                return file_hash
+
+            path = self._path_for(file_hash, ext)
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+            self._entries[file_hash] = {'ext': ext, 'size': len(data)}
+            self._total_bytes += len(data)
+            self._evict()
+            self._save_index()
+        return file_hash
+
+    def flush(self):
+        """将使用顺序的变化写回索引文件"""
+        with self._lock:
+            if self._dirty:
+                self._save_index()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+图片预检模块
+一次性读取待发送的图片，根据文件头识别格式并解析尺寸（不解码像素），
+读取的数据直接交给发送流程使用，避免重复读盘
+"""
+import os
+import struct
+import hashlib
+
+# 发送图片的限制，与服务器和其他客户端保持一致
+MAX_IMAGE_BYTES = 10 * 1024 * 1024  # 10MB
+MAX_IMAGE_DIMENSION = 8192  # 最大8K分辨率
+VALID_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp']
+# 识别出的格式对应的扩展名，收到的图片按实际内容而不是对方提供的文件名保存
+FORMAT_EXTENSIONS = {'PNG': '.png', 'JPEG': '.jpg', 'GIF': '.gif', 'BMP': '.bmp', 'WEBP': '.webp'}
+
+
+class ImageProbeError(ValueError):
+    """图片预检失败"""
+
+
+def _png_size(data):
+    # IHDR 必须是第一个数据块，宽高位于文件头之后
+    if data[12:16] != b'IHDR':
+        raise ImageProbeError("PNG文件缺少IHDR数据块")
+    return struct.unpack('>II', data[16:24])
+
+
+def _gif_size(data):
+    return struct.unpack('<HH', data[6:10])
+
+
+def _bmp_size(data):
+    header_size = struct.unpack('<I', data[14:18])[0]
+    if header_size == 12:
+        # OS/2 BITMAPCOREHEADER 使用16位宽高
+        return struct.unpack('<HH', data[18:22])
+    width, height = struct.unpack('<ii', data[18:26])
+    # 高度为负数表示自上而下存储
+    return abs(width), abs(height)
+
+
+def _jpeg_size(data):
+    # 逐个跳过标记段，直到遇到帧头（SOFn）
+    offset = 2
+    length = len(data)
+    while offset + 9 <= length:
+        if data[offset] != 0xFF:
+            raise ImageProbeError("JPEG标记段格式错误")
+        marker = data[offset + 1]
+        if marker == 0xFF:
+            # 填充字节
+            offset += 1
+            continue
+        if marker in (0x01, 0xD8) or 0xD0 <= marker <= 0xD7:
+            # 没有长度字段的独立标记
+            offset += 2
+            continue
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack('>HH', data[offset + 5:offset + 9])
+            return width, height
+        segment_length = struct.unpack('>H', data[offset + 2:offset + 4])[0]
+        offset += 2 + segment_length
+    raise ImageProbeError("JPEG文件缺少帧头")
+
+
+def _webp_size(data):
+    chunk = data[12:16]
+    if chunk == b'VP8 ':
+        width, height = struct.unpack('<HH', data[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b'VP8L':
+        bits = struct.unpack('<I', data[21:25])[0]
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b'VP8X':
+        width = int.from_bytes(data[24:27], 'little') + 1
+        height = int.from_bytes(data[27:30], 'little') + 1
+        return width, height
+    raise ImageProbeError("无法识别的WebP数据块")
+
+
+def probe_image(data):
+    """根据文件头识别图片格式并读取尺寸，返回 (格式, 宽, 高)"""
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        image_format, size_reader = 'PNG', _png_size
+    elif data.startswith(b'\xff\xd8\xff'):
+        image_format, size_reader = 'JPEG', _jpeg_size
+    elif data.startswith(b'GIF87a') or data.startswith(b'GIF89a'):
+        image_format, size_reader = 'GIF', _gif_size
+    elif data.startswith(b'BM'):
+        image_format, size_reader = 'BMP', _bmp_size
+    elif data.startswith(b'RIFF') and data[8:12] == b'WEBP':
+        image_format, size_reader = 'WEBP', _webp_size
+    else:
+        raise ImageProbeError("未检测到有效的图片文件头")
+
+    try:
+        width, height = size_reader(data)
+    except struct.error:
+        raise ImageProbeError(f"{image_format}文件头不完整")
+    if width <= 0 or height <= 0:
+        raise ImageProbeError(f"图片尺寸无效: {width}x{height}")
+    return image_format, width, height
+
+
+def image_extension(data):
+    """根据文件头返回图片数据对应的扩展名，不是可识别的图片时抛出 ImageProbeError"""
+    return FORMAT_EXTENSIONS[probe_image(data)[0]]
+
+
+def prepare_image(file_path):
+    """读取并验证待发送的图片，返回包含数据、格式、尺寸和内容哈希的字典
+
+    验证失败时抛出 ImageProbeError
+    """
+    file_ext = os.path.splitext(file_path)[1].lower()
+    if file_ext not in VALID_EXTENSIONS:
+        raise ImageProbeError(f"不支持的文件扩展名: {file_ext}")
+
+    with open(file_path, 'rb') as f:
+        # 先检查文件大小，过大的文件不读入内存
+        file_size = os.fstat(f.fileno()).st_size
+        if file_size > MAX_IMAGE_BYTES:
+            raise ImageProbeError(f"文件过大: {file_size} bytes > {MAX_IMAGE_BYTES} bytes")
+        data = f.read(MAX_IMAGE_BYTES + 1)
+    if len(data) > MAX_IMAGE_BYTES:
+        raise ImageProbeError(f"文件过大: 超过 {MAX_IMAGE_BYTES} bytes")
+
+    image_format, width, height = probe_image(data)
+    if width > MAX_IMAGE_DIMENSION or height > MAX_IMAGE_DIMENSION:
+        raise ImageProbeError(f"图片尺寸过大: {width}x{height}")
+
+    return {
+        'data': data,
+        'format': image_format,
+        'width': width,
+        'height': height,
+        'file_hash': hashlib.sha256(data).hexdigest(),
+        'file_path': file_path,
+        'original_file_name': os.path.basename(file_path),
+        'file_ext': file_ext,
+    }
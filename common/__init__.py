@@ -0,0 +1,2 @@
+# -*- coding: utf-8 -*-
+"""客户端和服务器共用的协议模块（不依赖PyQt5）"""
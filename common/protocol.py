@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+协议消息模块
+客户端发给服务器的消息定义为带 __slots__ 的数据类，客户端用它们构造消息，服务器用 parse_client_message 解析收到的消息：
+只保留协议中定义的字段（未知字段被丢弃），字段类型不符或超过长度上限时拒绝整条消息。
+服务器转发消息时根据解析结果重新生成字典，客户端附带的其他内容不会被转发给别人。
+"""
+import types
+import typing
+from dataclasses import dataclass, fields
+
+# 文字消息的长度上限（字符数）。JSON默认把非ASCII字符转义为6个字节，
+# 这个长度的文字在最坏情况下也不会超过服务器对文字消息的 64KB 上限
+MAX_TEXT_LENGTH = 10000
+# 用户名、文件名、房间名、哈希等短字段的长度上限
+MAX_FIELD_LENGTH = 256
+# 图片宽高的上限（像素）
+MAX_DIMENSION = 65535
+# 列表字段（客户端能力、压缩算法）的元素个数上限，元素都是不超过 MAX_FIELD_LENGTH 的字符串
+MAX_LIST_LENGTH = 64
+
+# 消息类型名到消息类的映射，由 message_type 装饰器注册
+CLIENT_MESSAGES = {}
+
+
+class ProtocolError(ValueError):
+    """消息不符合协议"""
+
+
+class Message:
+    """协议消息的基类，子类由 message_type 装饰器生成为带 __slots__ 的数据类"""
+    __slots__ = ()
+    TYPE = None
+    LIMITS = {}  # 字段名到上限的映射：字符串为最大长度，列表为最多元素个数，整数为最大值
+    _spec = ()  # 解析时使用的字段说明：(字段名, 类型, 是否可省略, 上限)
+
+    def to_dict(self):
+        """转换为可以JSON序列化的字典，省略值为None的字段"""
+        message = {'type': self.TYPE}
+        for name, _, _, _ in self._spec:
+            value = getattr(self, name)
+            if value is not None:
+                message[name] = value
+        return message
+
+
+def message_type(name):
+    """把类注册为指定类型的消息，并转换为带 __slots__ 的数据类"""
+    def register(cls):
+        cls = dataclass(slots=True)(cls)
+        spec = []
+        for f in fields(cls):
+            field_type = f.type
+            optional = False
+            if isinstance(field_type, types.UnionType):
+                # 形如 str | None 的字段可以省略
+                args = [arg for arg in typing.get_args(field_type) if arg is not type(None)]
+                field_type = args[0]
+                optional = True
+            spec.append((f.name, field_type, optional, cls.LIMITS.get(f.name)))
+        cls.TYPE = name
+        cls._spec = tuple(spec)
+        CLIENT_MESSAGES[name] = cls
+        return cls
+    return register
+
+
+def parse_client_message(message):
+    """把客户端发来的JSON对象解析为消息对象
+
+    未知的消息类型返回None；缺少必需字段、字段类型不符或超过上限时抛出 ProtocolError。
+    """
+    if not isinstance(message, dict):
+        raise ProtocolError("消息必须是JSON对象")
+    cls = CLIENT_MESSAGES.get(message.get('type'))
+    if cls is None:
+        return None
+    # 字段按定义顺序传给构造函数，省略的可选字段为None（与默认值相同）
+    values = []
+    get = message.get
+    for name, field_type, optional, limit in cls._spec:
+        value = get(name)
+        if value is None:
+            if not optional:
+                raise ProtocolError(f"{cls.TYPE} 消息缺少字段 {name}")
+        elif type(value) is not field_type:
+            # 用 type() 比较，避免 True/False 被当作整数接受
+            raise ProtocolError(f"{cls.TYPE} 消息的字段 {name} 类型错误")
+        elif limit is not None:
+            if field_type is str or field_type is list:
+                if len(value) > limit:
+                    raise ProtocolError(f"{cls.TYPE} 消息的字段 {name} 过长（{len(value)} > {limit}）")
+                if field_type is list and not all(type(item) is str and len(item) <= MAX_FIELD_LENGTH for item in value):
+                    raise ProtocolError(f"{cls.TYPE} 消息的字段 {name} 的元素必须是字符串")
+            elif not 0 <= value <= limit:
+                raise ProtocolError(f"{cls.TYPE} 消息的字段 {name} 超出范围")
+        values.append(value)
+    return cls(*values)
+
+
+_FILE_LIMITS = {
+    'file_type': MAX_FIELD_LENGTH,
+    'file_name': MAX_FIELD_LENGTH,
+    'original_file_name': MAX_FIELD_LENGTH,
+    'file_hash': MAX_FIELD_LENGTH,
+    'width': MAX_DIMENSION,
+    'height': MAX_DIMENSION
+}
+
+
+@message_type('hello')
+class Hello(Message):
+    """握手消息：昵称、客户端能力和base64编码的版本号，重连时带上会话令牌、最后收到的消息序号和所在房间
+
+    旧版客户端在版本验证之后单独发送没有 type 字段的昵称消息，服务器同样按 hello 消息解析。
+    """
+    username: str
+    version: str | None = None
+    compression: list | None = None  # 支持的压缩算法，按客户端的偏好排列
+    capabilities: list | None = None
+    resume_token: str | None = None
+    last_seq: int | None = None
+    server_epoch: str | None = None
+    room: str | None = None
+
+    LIMITS = {
+        'username': MAX_FIELD_LENGTH,
+        'version': MAX_FIELD_LENGTH,
+        'compression': MAX_LIST_LENGTH,
+        'capabilities': MAX_LIST_LENGTH,
+        'resume_token': MAX_FIELD_LENGTH,
+        'last_seq': 2 ** 63 - 1,
+        'server_epoch': MAX_FIELD_LENGTH,
+        'room': MAX_FIELD_LENGTH
+    }
+
+
+@message_type('text')
+class Text(Message):
+    """发到当前房间的文字消息"""
+    content: str
+
+    LIMITS = {'content': MAX_TEXT_LENGTH}
+
+
+@message_type('file')
+class File(Message):
+    """发到当前房间的文件（图片），服务器已有该内容时只带哈希，不带 file_data"""
+    file_type: str
+    file_name: str | None = None
+    original_file_name: str | None = None
+    file_hash: str | None = None
+    file_data: str | None = None  # base64编码的文件内容，大小由消息的大小上限限制
+    width: int | None = None
+    height: int | None = None
+
+    LIMITS = _FILE_LIMITS
+
+
+@message_type('direct')
+class Direct(Message):
+    """私聊消息：文字（content）或文件（file_type 等字段，与 File 相同）"""
+    to: str
+    content: str | None = None
+    client_msg_id: str | None = None  # 客户端的本地编号，服务器在送达回执中带回
+    file_type: str | None = None
+    file_name: str | None = None
+    original_file_name: str | None = None
+    file_hash: str | None = None
+    file_data: str | None = None
+    width: int | None = None
+    height: int | None = None
+
+    LIMITS = dict(_FILE_LIMITS, to=MAX_FIELD_LENGTH, content=MAX_TEXT_LENGTH, client_msg_id=MAX_FIELD_LENGTH)
+
+
+@message_type('room_join')
+class RoomJoin(Message):
+    """进入房间（房间名的具体规则由服务器检查）"""
+    room: str
+
+    LIMITS = {'room': MAX_FIELD_LENGTH}
+
+
+@message_type('room_leave')
+class RoomLeave(Message):
+    """离开当前房间，回到大厅"""
+
+
+@message_type('file_get')
+class FileGet(Message):
+    """按文件ID请求文件内容"""
+    file_id: str
+
+    LIMITS = {'file_id': MAX_FIELD_LENGTH}
+
+
+@message_type('heartbeat')
+class Heartbeat(Message):
+    """客户端心跳，服务器回复 pong"""
+
+
+@message_type('pong')
+class Pong(Message):
+    """对服务器心跳的回复，原样带回心跳的时间戳"""
+    timestamp: int | None = None
+
+    LIMITS = {'timestamp': 2 ** 63 - 1}
+
+
+@message_type('disconnect')
+class Disconnect(Message):
+    """主动断开连接，服务器不保留会话"""
+    username: str | None = None
+
+    LIMITS = {'username': MAX_FIELD_LENGTH}
@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+消息帧传输模块
+客户端、服务器和测试工具共用的帧格式：4字节大端长度前缀 + 消息体（UTF-8编码的JSON）。
+长度前缀的最高位表示消息体经过压缩，压缩算法在握手时按连接协商，可用的算法登记在 CODECS 中。
+本模块只依赖标准库（zstandard 为可选依赖），不依赖PyQt5。
+"""
+import json
+import socket
+import struct
+import zlib
+
+# zstandard 为可选依赖，没有安装时只支持 zlib 压缩
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+HEADER = struct.Struct('!I')
+HEADER_SIZE = HEADER.size
+COMPRESSED_FLAG = 0x80000000
+LENGTH_MASK = COMPRESSED_FLAG - 1
+COMPRESS_THRESHOLD = 512  # 小于该字节数的消息不压缩
+MAX_DECOMPRESSED_SIZE = 32 * 1024 * 1024  # 解压后的大小上限，防止压缩炸弹
+DISCARD_CHUNK_SIZE = 64 * 1024
+
+
+class FrameTooLarge(ValueError):
+    """帧超过连接允许的大小上限（消息体已被读出并丢弃，连接可以继续使用）"""
+
+    def __init__(self, size, limit):
+        super().__init__(f"消息过大（{size} > {limit} bytes）")
+        self.size = size
+        self.limit = limit
+
+
+class Codec:
+    """一种压缩算法：compress(payload) 返回压缩后的字节串，
+    decompress(data, max_size) 解压失败或解压后超过 max_size 时抛出 ValueError"""
+    __slots__ = ('name', 'compress', 'decompress')
+
+    def __init__(self, name, compress, decompress):
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+
+
+# 算法名到 Codec 的映射，登记顺序即偏好顺序（协商时选择第一个双方都支持的算法）
+CODECS = {}
+
+
+def register_codec(name, compress, decompress, preferred=False):
+    """登记一种压缩算法，preferred 为True时排在已有算法之前"""
+    codec = Codec(name, compress, decompress)
+    if preferred:
+        others = {key: value for key, value in CODECS.items() if key != name}
+        CODECS.clear()
+        CODECS[name] = codec
+        CODECS.update(others)
+    else:
+        CODECS[name] = codec
+    return codec
+
+
+def supported_codecs():
+    """按偏好顺序返回本端支持的压缩算法名列表（握手时发给对方）"""
+    return list(CODECS)
+
+
+def choose_codec(offered):
+    """按本端的偏好顺序选择第一个对方也支持的压缩算法，没有时返回None"""
+    if not isinstance(offered, list):
+        return None
+    return next((name for name in CODECS if name in offered), None)
+
+
+def compress_payload(codec, payload):
+    """用指定算法压缩消息体"""
+    return CODECS[codec].compress(payload)
+
+
+def decompress_payload(codec, data, max_size=MAX_DECOMPRESSED_SIZE):
+    """解压消息体，算法未知或解压后超过大小上限时抛出 ValueError"""
+    entry = CODECS.get(codec)
+    if entry is None:
+        raise ValueError(f"未协商的压缩算法: {codec}")
+    return entry.decompress(data, max_size)
+
+
+def _zlib_decompress(data, max_size):
+    decompressor = zlib.decompressobj()
+    try:
+        payload = decompressor.decompress(data, max_size)
+    except zlib.error as e:
+        raise ValueError(f"zlib解压失败: {e}")
+    if decompressor.unconsumed_tail:
+        raise ValueError("解压后的消息过大")
+    return payload
+
+
+def _zstd_decompress(data, max_size):
+    try:
+        return zstandard.ZstdDecompressor().decompress(data, max_output_size=max_size)
+    except zstandard.ZstdError as e:
+        raise ValueError(f"zstd解压失败: {e}")
+
+
+if zstandard is not None:
+    register_codec('zstd', lambda payload: zstandard.ZstdCompressor(level=3).compress(payload), _zstd_decompress)
+register_codec('zlib', lambda payload: zlib.compress(payload, 6), _zlib_decompress)
+
+
+def pack_header(length, compressed=False):
+    """生成长度前缀"""
+    return HEADER.pack(length | COMPRESSED_FLAG if compressed else length)
+
+
+def unpack_header(header):
+    """解析长度前缀，返回 (消息体长度, 是否经过压缩)"""
+    value = HEADER.unpack(header)[0]
+    return value & LENGTH_MASK, bool(value & COMPRESSED_FLAG)
+
+
+def encode_frame(payload, codec=None, compressible=True):
+    """为消息体加上长度前缀，codec 不为None且消息值得压缩时压缩消息体"""
+    if codec is not None and compressible and len(payload) >= COMPRESS_THRESHOLD:
+        compressed = compress_payload(codec, payload)
+        if len(compressed) < len(payload):
+            return pack_header(len(compressed), True) + compressed
+    return HEADER.pack(len(payload)) + payload
+
+
+class Frame:
+    """编码好的一条消息（JSON字节串）
+
+    发送时按连接协商的压缩算法取出对应的帧，每种算法只压缩一次，
+    同一条广播发给很多连接时不会重复压缩。
+    """
+    __slots__ = ('payload', 'compressible', 'msg_type', '_frames')
+
+    def __init__(self, payload, compressible=True, msg_type=None):
+        self.payload = payload
+        self.msg_type = msg_type  # 消息类型，只用于统计
+        # 图片等已压缩的数据再压缩几乎没有收益，由调用方标记为不可压缩
+        self.compressible = compressible and len(payload) >= COMPRESS_THRESHOLD
+        self._frames = {}
+
+    @classmethod
+    def from_message(cls, message, compressible=True):
+        return cls(json.dumps(message).encode('utf-8'), compressible, message.get('type'))
+
+    def get(self, codec=None):
+        """返回带长度前缀的帧，codec 为None或消息不值得压缩时返回未压缩的帧"""
+        if not self.compressible:
+            codec = None
+        frame = self._frames.get(codec)
+        if frame is None:
+            if codec is not None:
+                frame = encode_frame(self.payload, codec)
+                if len(frame) == len(self.payload) + HEADER_SIZE:
+                    # 压缩没有收益，与未压缩的帧共用一份
+                    frame = self._frames.setdefault(None, frame)
+            else:
+                frame = encode_frame(self.payload)
+            self._frames[codec] = frame
+        return frame
+
+    def __len__(self):
+        return len(self.payload) + HEADER_SIZE
+
+
+def recv_exact(sock, n):
+    """接收恰好 n 字节，连接关闭时返回None，socket错误原样抛出
+
+    按长度一次分配缓冲区并用 recv_into 直接写入，避免逐段拼接时的重复复制；
+    调用方需先检查 n 不超过允许的大小上限。
+    """
+    data = bytearray(n)
+    view = memoryview(data)
+    received = 0
+    while received < n:
+        count = sock.recv_into(view[received:], n - received)
+        if not count:
+            return None
+        received += count
+    return data
+
+
+def discard_exact(sock, n):
+    """读出并丢弃 n 字节，只使用固定大小的缓冲区，返回连接是否仍然可用"""
+    scratch = bytearray(min(n, DISCARD_CHUNK_SIZE))
+    while n > 0:
+        try:
+            count = sock.recv_into(scratch, min(n, len(scratch)))
+        except OSError:
+            return False
+        if not count:
+            return False
+        n -= count
+    return True
+
+
+class Connection:
+    """按帧收发消息的连接：包装一个已连接的socket（可以是TLS socket），记录协商的压缩算法
+
+    发送方法不加锁，多个线程同时发送时由调用方保证一次只有一个线程写入。
+    """
+    __slots__ = ('sock', 'codec', 'max_frame_size')
+
+    def __init__(self, sock, codec=None, max_frame_size=MAX_DECOMPRESSED_SIZE):
+        self.sock = sock
+        self.codec = codec  # 协商的压缩算法，None 表示不压缩
+        self.max_frame_size = max_frame_size  # 接收时消息体（压缩前后）的大小上限
+
+    def encode(self, payload, compressible=True):
+        """按协商的压缩算法把消息体编码为帧"""
+        return encode_frame(payload, self.codec, compressible)
+
+    def send_payload(self, payload, compressible=True):
+        self.sock.sendall(self.encode(payload, compressible))
+
+    def send_message(self, message, compressible=True):
+        """把消息对象编码为JSON后发送"""
+        self.send_payload(json.dumps(message).encode('utf-8'), compressible)
+
+    def send_frame(self, frame):
+        """发送编码好的消息（Frame），返回写入的字节数"""
+        data = frame.get(self.codec)
+        self.sock.sendall(data)
+        return len(data)
+
+    def read_header(self):
+        """读取长度前缀，返回 (消息体长度, 是否经过压缩)，连接关闭时返回None"""
+        header = recv_exact(self.sock, HEADER_SIZE)
+        if header is None:
+            return None
+        return unpack_header(header)
+
+    def read_body(self, length, discard=True):
+        """读取 read_header 之后的消息体（未解压），连接关闭时返回None
+
+        消息体超过 max_frame_size 时不分配内存：discard 为True时读出并丢弃后抛出 FrameTooLarge，
+        连接无法继续使用时返回None；discard 为False时不读出直接抛出 FrameTooLarge，连接不能再使用。
+        """
+        if length > self.max_frame_size:
+            if discard and not discard_exact(self.sock, length):
+                return None
+            raise FrameTooLarge(length, self.max_frame_size)
+        return recv_exact(self.sock, length)
+
+    def read_frame(self, discard=True):
+        """读取一帧，返回 (未解压的消息体, 是否经过压缩)，连接关闭时返回None
+
+        消息体超过 max_frame_size 时的处理见 read_body。
+        """
+        header = self.read_header()
+        if header is None:
+            return None
+        length, compressed = header
+        data = self.read_body(length, discard)
+        if data is None:
+            return None
+        return data, compressed
+
+    def decompress(self, data):
+        """按协商的压缩算法解压消息体，解压后同样受 max_frame_size 限制"""
+        return decompress_payload(self.codec, data, self.max_frame_size)
+
+    def read_payload(self):
+        """读取一帧并在需要时解压，连接关闭时返回None"""
+        frame = self.read_frame()
+        if frame is None:
+            return None
+        data, compressed = frame
+        return self.decompress(data) if compressed else data
+
+    def read_message(self):
+        """读取一帧并解析JSON，连接关闭时返回None"""
+        data = self.read_payload()
+        if data is None:
+            return None
+        return json.loads(data)
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+intPlatinum 服务器管理工具
+通过服务器的控制套接字执行与服务器控制台相同的命令，适用于以守护进程方式运行的服务器和管理脚本。
+
+用法:
+    python admin_ctl.py users
+    python admin_ctl.py announce 服务器将在10分钟后维护
+    python admin_ctl.py -f bans.txt            # 每行一条命令，一次请求按顺序执行
+    echo "ban 10.0.0.8" | python admin_ctl.py -f -
+    python admin_ctl.py --json rooms           # 输出服务器返回的JSON结果
+
+所有命令都执行成功时退出码为0，有命令失败时为1，无法连接服务器时为2。
+"""
+import os
+import sys
+import json
+import socket
+import argparse
+
+# 与服务器的默认控制套接字路径一致
+DEFAULT_CONTROL_SOCKET = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'control.sock')
+
+
+def read_commands(path):
+    """从文件（'-' 表示标准输入）读取命令，忽略空行和 # 开头的注释"""
+    stream = sys.stdin if path == '-' else open(path, 'r', encoding='utf-8')
+    try:
+        return [line.strip() for line in stream if line.strip() and not line.lstrip().startswith('#')]
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+
+def send_commands(socket_path, commands, timeout=60):
+    """把命令作为一个批量请求发送给服务器，返回服务器的JSON回复"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        request = json.dumps({'commands': commands}, ensure_ascii=False).encode('utf-8') + b'\n'
+        sock.sendall(request)
+        with sock.makefile('rb') as reader:
+            line = reader.readline()
+    if not line:
+        raise ConnectionError('服务器没有回复')
+    return json.loads(line.decode('utf-8'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='通过控制套接字管理 intPlatinum 服务器')
+    parser.add_argument('command', nargs='*', help="要执行的命令，例如 users 或 ban 10.0.0.8（输入 help 查看全部命令）")
+    parser.add_argument('--socket', '-s', type=str, default=DEFAULT_CONTROL_SOCKET,
+                        help='服务器控制套接字的路径 (默认: 服务器目录下的 control.sock)')
+    parser.add_argument('--file', '-f', type=str, default=None, help="从文件读取多条命令批量执行，'-' 表示标准输入")
+    parser.add_argument('--json', action='store_true', help='直接输出服务器返回的JSON')
+    parser.add_argument('--timeout', type=float, default=60, help='等待服务器回复的超时时间，单位秒 (默认: 60)')
+    args = parser.parse_args()
+
+    if not hasattr(socket, 'AF_UNIX'):
+        print('当前系统不支持Unix域套接字', file=sys.stderr)
+        return 2
+
+    commands = []
+    if args.command:
+        commands.append(' '.join(args.command))
+    if args.file:
+        commands.extend(read_commands(args.file))
+    if not commands:
+        parser.error('需要指定命令或 --file')
+
+    try:
+        response = send_commands(args.socket, commands, args.timeout)
+    except (OSError, ConnectionError, ValueError) as e:
+        print(f'无法连接服务器控制套接字 {args.socket}: {e}', file=sys.stderr)
+        return 2
+
+    if args.json:
+        print(json.dumps(response, ensure_ascii=False, indent=2))
+    elif 'error' in response:
+        print(response['error'], file=sys.stderr)
+    else:
+        for result in response['results']:
+            if len(commands) > 1:
+                print(f"> {result['command']}")
+            if result['output']:
+                print(result['output'])
+    return 0 if response.get('ok') else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
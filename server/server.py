@@ -7,29 +7,761 @@ import json
 import os
 import time
 import base64
+import binascii
+import hashlib
 import struct
 import argparse
 import sys
 import signal
 import atexit
+import io
+import secrets
+import ssl
+import bisect
+import contextlib
+import re
+import ipaddress
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 与客户端共用的协议和传输模块位于仓库根目录的 common 包中
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import protocol, transport
+
+# Pillow 为可选依赖，仅在启用图片预览时使用
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import fcntl
+    import termios
+except ImportError:
+    # Windows 没有这两个模块，无法查询发送缓冲区积压
+    fcntl = termios = None
+
+# 控制套接字的默认路径（与 admin_ctl.py 中的默认值一致）
+DEFAULT_CONTROL_SOCKET = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'control.sock')
+
+# 配置文件的默认路径，文件不存在时使用命令行参数和内置默认值
+DEFAULT_CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server_config.json')
+
+def _config_number(minimum, integer=False, maximum=None):
+    """生成数值配置项的校验函数"""
+    def validate(value):
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or (integer and not isinstance(value, int)):
+            raise ValueError(f"应为{'整数' if integer else '数字'}")
+        if value < minimum:
+            raise ValueError(f"不能小于 {minimum}")
+        if maximum is not None and value > maximum:
+            raise ValueError(f"不能大于 {maximum}")
+        return value
+    return validate
+
+def _config_versions(value):
+    if not isinstance(value, list) or not value or not all(isinstance(v, str) and v for v in value):
+        raise ValueError("应为非空的版本号字符串列表")
+    return list(value)
+
+def _config_choice(*choices):
+    def validate(value):
+        if value not in choices:
+            raise ValueError(f"应为 {' / '.join(choices)} 之一")
+        return value
+    return validate
+
+def _config_string(value):
+    if not isinstance(value, str) or not value:
+        raise ValueError("应为非空字符串")
+    return value
+
+# 配置文件中可以设置的项目及其校验函数；除 host 和 port 外都可以在运行时重新加载
+CONFIG_OPTIONS = {
+    'host': _config_string,
+    'port': _config_number(1, integer=True),
+    'supported_client_versions': _config_versions,
+    'max_message_mb': _config_number(1),
+    'rate_limit': _config_number(0),
+    'rate_limit_burst': _config_number(1, integer=True),
+    'log_level': _config_choice('debug', 'info'),
+    'session_resume_grace': _config_number(0),
+    'ping_interval': _config_number(1),
+    'tls_handshake_timeout': _config_number(1),
+    'file_cache_mb': _config_number(0),
+    'file_ttl': _config_number(0),
+    'history': _config_number(0, integer=True),
+    'history_mb': _config_number(0),
+    'preview_max_side': _config_number(16, integer=True),
+    'preview_quality': _config_number(1, integer=True, maximum=100),
+    'banned_ips_file': _config_string,
+}
+RESTART_ONLY_OPTIONS = ('host', 'port')
+
+def explicit_cli_options(parser, args=None):
+    """返回命令行中明确给出的、同时也是配置项的参数名，这些设置优先于配置文件"""
+    defaults = {action: action.default for action in parser._actions}
+    # 不填充默认值再解析一次，结果中只留下实际给出的参数
+    for action in defaults:
+        action.default = argparse.SUPPRESS
+    try:
+        given = vars(parser.parse_known_args(args)[0])
+    finally:
+        for action, default in defaults.items():
+            action.default = default
+    return {key for key in given if key in CONFIG_OPTIONS}
+
+def create_server_ssl_context(certfile, keyfile=None):
+    """创建服务器端TLS上下文
+    
+    整个进程共用一个上下文：OpenSSL 的会话缓存和会话票据都保存在上下文中，
+    客户端重连时可以恢复会话，省去完整握手的证书验证和密钥交换开销。
+    返回的上下文同样可以直接传给 asyncio.start_server(ssl=...)。
+    """
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certfile, keyfile)
+    # TLS 1.3 每次握手后只下发一张会话票据（默认两张），客户端每次只使用最新的一张
+    context.num_tickets = 1
+    return context
+
+def _escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape_label_value(value)}"' for name, value in pairs) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+class Counter:
+    """只增不减的计数器，可以带标签"""
+    kind = 'counter'
+    
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+    
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+    
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+    
+    def value(self, **labels):
+        """不指定标签时返回所有标签的合计"""
+        with self._lock:
+            if labels:
+                return self._values.get(self._key(labels), 0)
+            return sum(self._values.values())
+    
+    def items(self):
+        with self._lock:
+            return sorted(self._values.items())
+    
+    def samples(self):
+        for key, value in self.items():
+            yield self.name + _format_labels(self.labelnames, key), value
+
+class Gauge(Counter):
+    """可增可减的仪表；绑定 func 时在读取时调用它获取当前值"""
+    kind = 'gauge'
+    
+    def __init__(self, name, help_text, labelnames=(), func=None):
+        super().__init__(name, help_text, labelnames)
+        self.func = func
+    
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+    
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+    
+    def value(self, **labels):
+        if self.func is not None:
+            return self.func()
+        return super().value(**labels)
+    
+    def items(self):
+        if self.func is not None:
+            return [((), self.func())]
+        return super().items()
+
+class Histogram:
+    """累积分桶的直方图，用于耗时等分布（单位由调用方决定，耗时统一使用秒）"""
+    kind = 'histogram'
+    DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._values = {}  # 标签 -> [各桶计数（非累积）, 总和, 次数]
+        self._lock = threading.Lock()
+    
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+    
+    def items(self):
+        with self._lock:
+            return sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items())
+    
+    def summary(self, key=()):
+        """返回 (次数, 平均值)，没有数据时返回 (0, None)"""
+        for item_key, (_, total, count) in self.items():
+            if item_key == key and count:
+                return count, total / count
+        return 0, None
+    
+    def quantile(self, q, key=()):
+        """根据分桶估算分位数（返回所在桶的上界），没有数据时返回None"""
+        for item_key, (counts, _, count) in self.items():
+            if item_key != key or not count:
+                continue
+            target = q * count
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                if cumulative >= target:
+                    return bound
+        return None
+    
+    def samples(self):
+        for key, (counts, total, count) in self.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield self.name + '_bucket' + _format_labels(self.labelnames, key, [('le', _format_value(float(bound)))]), cumulative
+            yield self.name + '_sum' + _format_labels(self.labelnames, key), total
+            yield self.name + '_count' + _format_labels(self.labelnames, key), count
+
+class MetricsRegistry:
+    """进程内的指标注册表，按 Prometheus 文本格式导出"""
+    
+    def __init__(self, prefix='intplatinum_'):
+        self.prefix = prefix
+        self._metrics = []
+    
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+    
+    def counter(self, name, help_text, labelnames=()):
+        return self._register(Counter(self.prefix + name, help_text, labelnames))
+    
+    def gauge(self, name, help_text, labelnames=(), func=None):
+        return self._register(Gauge(self.prefix + name, help_text, labelnames, func))
+    
+    def histogram(self, name, help_text, labelnames=(), buckets=Histogram.DEFAULT_BUCKETS):
+        return self._register(Histogram(self.prefix + name, help_text, labelnames, buckets))
+    
+    def render(self):
+        """导出为 Prometheus 文本格式（0.0.4）"""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.help_text}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, value in metric.samples():
+                lines.append(f'{name} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+def _make_image_preview(image_bytes, max_side, quality):
+    """生成缩小的WebP预览图（在进程池中执行），失败时返回None"""
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            # 与客户端的尺寸限制保持一致，拒绝超大图片
+            if img.width > 8192 or img.height > 8192:
+                return None
+            # JPEG 可以在解码阶段直接按比例缩小，避免解码全尺寸像素
+            img.draft('RGB', (max_side, max_side))
+            img.thumbnail((max_side, max_side))
+            if img.mode not in ('RGB', 'RGBA'):
+                img = img.convert('RGBA')
+            output = io.BytesIO()
+            img.save(output, 'WEBP', quality=quality)
+            return output.getvalue()
+    except Exception:
+        return None
+
+class SamplingProfiler:
+    """采样分析器：在后台线程中定期抓取所有线程的调用栈，不需要重启服务器
+    
+    结果为折叠栈格式（每行一个从线程入口到当前函数、以分号分隔的调用栈和采样次数），
+    可以直接交给 flamegraph.pl、speedscope 或 inferno 生成火焰图。
+    同类线程（如所有客户端处理线程）合并在同一个根节点下。
+    """
+    
+    def __init__(self):
+        self.stacks = {}
+        self.samples = 0
+        self.output_path = None
+        self._thread = None
+        self._stop_event = threading.Event()
+    
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+    
+    def start(self, duration, interval, output_path, on_finish=None):
+        """开始采样 duration 秒，每 interval 秒一次；结束后写入 output_path 并调用 on_finish(profiler)"""
+        self.stacks = {}
+        self.samples = 0
+        self.output_path = output_path
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, args=(duration, interval, on_finish),
+                                        daemon=True, name='Profiler')
+        self._thread.start()
+    
+    def stop(self):
+        """提前结束采样（结果照常写入）"""
+        self._stop_event.set()
+    
+    @staticmethod
+    def _thread_group(name):
+        # Client-1.2.3.4:5678 -> Client，Thread-3 (worker) -> Thread (worker)
+        if name.startswith('Client-'):
+            return 'Client'
+        return re.sub(r'-\d+', '', name)
+    
+    def _run(self, duration, interval, on_finish):
+        me = threading.get_ident()
+        deadline = time.monotonic() + duration
+        while not self._stop_event.wait(interval) and time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(self._thread_group(names.get(ident, 'unknown')))
+                key = ';'.join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+        try:
+            os.makedirs(os.path.dirname(self.output_path), exist_ok=True)
+            with open(self.output_path, 'w', encoding='utf-8') as f:
+                for stack, count in sorted(self.stacks.items(), key=lambda item: -item[1]):
+                    f.write(f"{stack} {count}\n")
+        except OSError as e:
+            print(f"❌ 写入采样结果失败: {e}")
+            return
+        if on_finish is not None:
+            on_finish(self)
+    
+    def top_functions(self, limit=10):
+        """按位于栈顶的采样次数排序的函数（C函数不出现在栈中，阻塞在 recv 等调用上的时间计入调用它的函数）"""
+        leaf_counts = {}
+        for stack, count in self.stacks.items():
+            leaf = stack.rsplit(';', 1)[-1]
+            leaf_counts[leaf] = leaf_counts.get(leaf, 0) + count
+        return sorted(leaf_counts.items(), key=lambda item: -item[1])[:limit]
+
+class ThreadOutputRouter:
+    """替换 sys.stdout：正在捕获输出的线程写入各自的缓冲区，其他线程照常输出
+    
+    控制套接字执行命令时用它收集命令的输出，同时不会截获其他线程的日志
+    """
+    
+    def __init__(self, stream):
+        self.stream = stream
+        self._local = threading.local()
+    
+    @contextlib.contextmanager
+    def capture(self):
+        buffer = io.StringIO()
+        self._local.buffer = buffer
+        try:
+            yield buffer
+        finally:
+            self._local.buffer = None
+    
+    def write(self, text):
+        buffer = getattr(self._local, 'buffer', None)
+        if buffer is not None:
+            return buffer.write(text)
+        return self.stream.write(text)
+    
+    def flush(self):
+        self.stream.flush()
+    
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+def socket_unsent_bytes(sock):
+    """内核发送缓冲区中对方尚未确认的字节数（Linux 的 SIOCOUTQ），不支持时返回None"""
+    if fcntl is None or not hasattr(termios, 'TIOCOUTQ'):
+        return None
+    try:
+        return struct.unpack('i', fcntl.ioctl(sock.fileno(), termios.TIOCOUTQ, b'\0\0\0\0'))[0]
+    except (OSError, ValueError):
+        return None
+
+LOOPBACK_NETWORKS = {4: ipaddress.ip_network('127.0.0.0/8'), 6: ipaddress.ip_network('::1/128')}
+
+class BanList:
+    """IP黑名单，条目可以是单个地址或CIDR网段
+    
+    单个地址按字符串直接查找；网段按（IP版本, 前缀长度）分组存放网络地址，
+    查询时每组只做一次掩码和集合查找，耗时与网段数量无关
+    """
+    
+    def __init__(self, entries=()):
+        self.addresses = set()
+        self.networks = {}  # (IP版本, 前缀长度) -> 网络地址（整数）集合
+        for entry in entries:
+            self.add(entry)
+    
+    @staticmethod
+    def normalize(entry):
+        """返回条目的规范形式（地址，或 网络地址/前缀长度），格式错误时抛出 ValueError"""
+        entry = entry.strip()
+        if '/' not in entry:
+            return str(ipaddress.ip_address(entry))
+        network = ipaddress.ip_network(entry, strict=False)
+        if network.prefixlen == network.max_prefixlen:
+            return str(network.network_address)
+        return str(network)
+    
+    def _network_key(self, entry):
+        network = ipaddress.ip_network(entry)
+        return (network.version, network.prefixlen), int(network.network_address)
+    
+    def add(self, entry):
+        """添加条目，返回规范形式；已经存在时返回None"""
+        entry = self.normalize(entry)
+        if '/' not in entry:
+            if entry in self.addresses:
+                return None
+            self.addresses.add(entry)
+            return entry
+        group_key, value = self._network_key(entry)
+        group = self.networks.setdefault(group_key, set())
+        if value in group:
+            return None
+        group.add(value)
+        return entry
+    
+    def discard(self, entry):
+        """移除条目，返回规范形式；不存在时返回None"""
+        entry = self.normalize(entry)
+        if '/' not in entry:
+            if entry not in self.addresses:
+                return None
+            self.addresses.discard(entry)
+            return entry
+        group_key, value = self._network_key(entry)
+        group = self.networks.get(group_key)
+        if not group or value not in group:
+            return None
+        group.discard(value)
+        if not group:
+            del self.networks[group_key]
+        return entry
+    
+    def __contains__(self, ip):
+        if ip in self.addresses:
+            return True
+        if not self.networks:
+            return False
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return False
+        value = int(address)
+        # 复制一份再遍历，其他线程可能同时在修改黑名单
+        for (version, prefixlen), group in tuple(self.networks.items()):
+            if version == address.version:
+                host_bits = address.max_prefixlen - prefixlen
+                if (value >> host_bits) << host_bits in group:
+                    return True
+        return False
+    
+    def __len__(self):
+        return len(self.addresses) + sum(len(group) for group in self.networks.values())
+    
+    def __iter__(self):
+        yield from sorted(self.addresses)
+        for (version, prefixlen), group in sorted(self.networks.items()):
+            network_class = ipaddress.IPv4Network if version == 4 else ipaddress.IPv6Network
+            for value in sorted(group):
+                yield str(network_class((value, prefixlen)))
+
+class ConnectionStats:
+    """单个连接的收发统计，由处理线程和发送方直接累加（不加锁，并发发送时计数可能有极少量误差）"""
+    __slots__ = ('username', 'ip', 'connected_at', 'last_active', 'frames_in', 'bytes_in', 'frames_out', 'bytes_out',
+                 'send_started', 'rtt', 'ping_timestamp', 'ping_sent_at', 'tokens', 'tokens_at', 'rate_limited')
+    
+    def __init__(self, ip):
+        self.username = None
+        self.ip = ip
+        self.connected_at = time.monotonic()
+        self.last_active = self.connected_at  # 最后一次收到该客户端消息的时间
+        self.frames_in = 0
+        self.bytes_in = 0
+        self.frames_out = 0
+        self.bytes_out = 0
+        self.send_started = 0  # 正在进行的发送开始的时间，没有阻塞中的发送时为0
+        self.rtt = None  # 最近一次服务器心跳的往返时间（秒），客户端不支持时为None
+        self.ping_timestamp = None  # 尚未收到回复的服务器心跳的时间戳
+        self.ping_sent_at = 0
+        self.tokens = 0.0  # 限速令牌桶中剩余的令牌数，第一次检查时补满
+        self.tokens_at = 0.0
+        self.rate_limited = False  # 是否已经提醒过客户端发送过快
+
+class FileCache:
+    """按内容哈希缓存最近广播过的文件数据（base64字符串）
+    
+    超过容量时淘汰最久未使用的条目，超过存活时间（ttl秒）的条目视为已过期。
+    数据只保存在内存中，服务器关闭后不会留下任何文件。
+    """
+    
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=1800):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()  # 存储哈希到(base64数据, 过期时间)的映射，末尾为最近使用
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+    
+    @property
+    def total_bytes(self):
+        return self._total_bytes
+    
+    def get(self, file_hash):
+        """获取缓存的文件数据，不存在或已过期时返回None"""
+        if not file_hash:
+            return None
+        with self._lock:
+            entry = self._entries.get(file_hash)
+            if entry is None:
+                return None
+            file_data_b64, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[file_hash]
+                self._total_bytes -= len(file_data_b64)
+                return None
+            self._entries.move_to_end(file_hash)
+            return file_data_b64
+    
+    def put(self, file_hash, file_data_b64):
+        """存入文件数据（重复存入会刷新过期时间），单个文件超过容量上限时不缓存"""
+        size = len(file_data_b64)
+        if size > self.max_bytes:
+            return
+        now = time.monotonic()
+        with self._lock:
+            old = self._entries.pop(file_hash, None)
+            if old is not None:
+                self._total_bytes -= len(old[0])
+            self._entries[file_hash] = (file_data_b64, now + self.ttl)
+            self._total_bytes += size
+            # 先清理已过期的条目，再按LRU顺序淘汰直到不超过容量
+            for key in [key for key, (_, expires_at) in self._entries.items() if expires_at < now]:
+                self._total_bytes -= len(self._entries.pop(key)[0])
+            while self._total_bytes > self.max_bytes:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._total_bytes -= len(evicted)
+    
+    def export(self):
+        """导出未过期的条目，返回 [哈希, base64数据, 剩余存活秒数] 列表，按最久未使用到最近使用排列"""
+        now = time.monotonic()
+        with self._lock:
+            return [[file_hash, file_data_b64, expires_at - now]
+                    for file_hash, (file_data_b64, expires_at) in self._entries.items() if expires_at > now]
+    
+    def restore(self, entries):
+        """导入 export() 导出的条目，保留原来的剩余存活时间"""
+        now = time.monotonic()
+        for file_hash, file_data_b64, ttl_left in entries:
+            self.put(file_hash, file_data_b64)
+            with self._lock:
+                if file_hash in self._entries:
+                    self._entries[file_hash] = (file_data_b64, now + min(ttl_left, self.ttl))
+
+class MessageHistory:
+    """最近广播的文字、系统消息和文件通告的环形缓冲区，供新加入或重连的客户端补看
+    
+    消息以编码好的帧（transport.Frame）保存，补发时直接写入socket，不需要重新序列化或重新压缩。
+    同时受条数和总字节数限制，只保存在内存中，不会写入磁盘。
+    """
+    
+    def __init__(self, max_count=100, max_bytes=1024 * 1024):
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self._frames = deque()  # 存储(序号, 帧)，按序号递增
+        self._total_bytes = 0
+        self._evicted_seq = 0  # 已被淘汰的最新一条消息的序号
+        self._lock = threading.Lock()
+    
+    def append(self, seq, frame):
+        """存入已分配序号并编码好的帧（transport.Frame），序号必须递增"""
+        with self._lock:
+            self._frames.append((seq, frame))
+            self._total_bytes += len(frame)
+            while self._frames and (len(self._frames) > self.max_count or self._total_bytes > self.max_bytes):
+                evicted_seq, evicted = self._frames.popleft()
+                self._total_bytes -= len(evicted)
+                self._evicted_seq = evicted_seq
+    
+    def since(self, last_seq=None):
+        """返回序号大于 last_seq 的帧（transport.Frame）列表，以及缓冲区是否已丢失了其中一部分消息"""
+        with self._lock:
+            if last_seq is None:
+                return [frame for _, frame in self._frames], False
+            frames = [frame for seq, frame in self._frames if seq > last_seq]
+            return frames, self._evicted_seq > last_seq
+    
+    def export(self):
+        """导出缓冲区内容（可以JSON序列化），用于把消息记录交给新的服务器进程"""
+        with self._lock:
+            return {
+                'evicted_seq': self._evicted_seq,
+                'frames': [[seq, frame.payload.decode('utf-8'), frame.compressible, frame.msg_type]
+                           for seq, frame in self._frames]
+            }
+    
+    def restore(self, state):
+        """导入 export() 导出的内容"""
+        for seq, payload, compressible, msg_type in state['frames']:
+            self.append(seq, transport.Frame(payload.encode('utf-8'), compressible, msg_type))
+        with self._lock:
+            self._evicted_seq = max(self._evicted_seq, state['evicted_seq'])
+
+class DispatchRejected(Exception):
+    """服务器已移交给新进程，移交期间等待的客户端消息不再处理"""
 
 class ChatServer:
     # 定义服务器支持的客户端版本列表
     SUPPORTED_CLIENT_VERSIONS = ["v1.0.2a","v1.0.1a-mv"]
     SERVER_VERSION = "v1.0.2a"  # 服务器版本
     
-    def __init__(self, host='0.0.0.0', port=7995):
+    # 图片预览参数：最长边像素、WebP质量、需要生成预览的最小原图大小
+    PREVIEW_MAX_SIDE = 480
+    PREVIEW_QUALITY = 75
+    PREVIEW_MIN_BYTES = 128 * 1024
+    PREVIEW_TIMEOUT = 10  # 预览超过该秒数仍未生成时不再等待，通知客户端改为按需获取原图
+    
+    # 连接意外断开后保留会话（昵称）的时间，客户端在此期间可凭会话令牌恢复
+    SESSION_RESUME_GRACE = 60
+    
+    # 房间：用户连接后默认进入大厅，同一时间只在一个房间中，消息只发给同一房间的用户
+    DEFAULT_ROOM = 'lobby'
+    MAX_ROOM_NAME_LENGTH = 32
+    
+    # TLS握手的超时时间，避免只建立TCP连接不握手的客户端一直占用处理线程
+    TLS_HANDSHAKE_TIMEOUT = 10
+    
+    # 服务器向声明了 server_ping 能力的客户端发送心跳的间隔（秒），用于测量往返时间
+    PING_INTERVAL = 15
+    
+    # 受发送频率限制的消息类型（由用户操作产生的消息），心跳等控制消息不受限制
+    RATE_LIMITED_TYPES = ('text', 'file', 'direct', 'room_join', 'room_leave')
+    
+    # 零停机重启时客户端在该时间（秒）内随机选择时刻重新连接，避免所有客户端同时重连
+    RESTART_RECONNECT_WINDOW = 5
+    # 移交时等待正在分发的消息完成、等待新进程确认接管的时间上限（秒），超时则取消移交继续运行
+    HANDOFF_TIMEOUT = 5
+    # 接管时接受的状态大小上限，防止按对方发来的长度分配过大的内存
+    HANDOFF_MAX_STATE_BYTES = 1024 * 1024 * 1024
+    
+    # 消息大小上限：登录前的握手消息和文件以外的消息都很小，只有文件和私聊（可能带图片）使用 max_message_bytes
+    HANDSHAKE_MAX_BYTES = 64 * 1024
+    SMALL_MESSAGE_MAX_BYTES = 64 * 1024
+    LARGE_MESSAGE_TYPES = ('file', 'direct')
+    
+    def __init__(self, host='0.0.0.0', port=7995, file_cache_mb=64, file_ttl=1800, enable_previews=False, preview_workers=2,
+                 history_size=0, history_mb=1, certfile=None, keyfile=None, metrics_host='127.0.0.1', metrics_port=None,
+                 control_socket=None, config_file=None, takeover=None, cli_options=()):
         self.host = host
         self.port = port
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # TLS（可选）：指定证书后所有连接都必须使用TLS，握手在各连接的处理线程中进行
+        self.ssl_context = create_server_ssl_context(certfile, keyfile) if certfile else None
         self.clients = {}  # 存储用户名到套接字的映射
         self.user_ips = {}  # 存储用户名到IP地址的映射
-        self.banned_ips = set()  # 存储被禁止的IP地址
+        self.client_capabilities = {}  # 存储用户名到客户端能力集合的映射
+        self.connections = {}  # 存储socket到 transport.Connection 的映射，Connection 记录协商的压缩算法和接收大小上限
+        self.connection_stats = {}  # 存储socket到连接统计（ConnectionStats）的映射
+        self.sessions = {}  # 存储会话令牌到用户名的映射（包括在线和等待恢复的会话）
+        self.suspended_sessions = {}  # 存储意外断开、等待恢复的用户名到会话信息的映射
+        self.file_cache = FileCache(file_cache_mb * 1024 * 1024, file_ttl)  # 最近广播文件的内容缓存，客户端通过 file_get 按需获取
+        # 聊天消息的序号和ID在广播时统一分配；每次启动的运行标识不同，客户端据此判断序号是否连续
+        self.server_epoch = secrets.token_hex(4)
+        self._seq = 0  # 全局计数，用于生成消息ID
+        self.room_seqs = {}  # 存储房间名到该房间最新消息序号的映射，序号按房间递增
+        # 时间戳基于单调时钟换算，系统时间被调整时也不会倒退
+        self._clock_offset = time.time() - time.monotonic()
+        # 最近消息记录（可选）：新加入或重连的客户端可以看到所在房间最近的文字、系统消息和文件通告
+        self.history_size = history_size
+        self.history_bytes = history_mb * 1024 * 1024
+        self.room_histories = {}  # 存储房间名到该房间消息记录的映射
+        # 房间成员（包括等待恢复会话的用户），房间没有成员时自动删除（大厅除外）
+        self.rooms = {self.DEFAULT_ROOM: set()}  # 存储房间名到成员用户名集合的映射
+        self.user_rooms = {}  # 存储用户名到所在房间名的映射
+        
+        # 图片预览（可选，需要Pillow）：在进程池中生成，结果按原图哈希缓存
+        if enable_previews and Image is None:
+            print("⚠️  未安装Pillow，图片预览功能已禁用")
+        self.previews_enabled = enable_previews and Image is not None
+        self.preview_workers = preview_workers
+        self.preview_executor = None
+        self.preview_executor_lock = threading.Lock()
+        self.preview_cache = FileCache(16 * 1024 * 1024, file_ttl)
+        self.banned_ips = BanList()  # 被禁止的IP地址和网段
         # 使用绝对路径确保跨平台兼容性
         self.banned_ips_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'banned_ips.json')
         self.clients_lock = threading.Lock()
         
+        # 以下设置可以写在配置文件中，并能通过 reload 命令或 SIGHUP 在运行时重新加载
+        # 类属性中的同名大写常量只是默认值，运行时使用这里的实例属性
+        self.supported_client_versions = list(self.SUPPORTED_CLIENT_VERSIONS)
+        self.session_resume_grace = self.SESSION_RESUME_GRACE
+        self.ping_interval = self.PING_INTERVAL
+        self.tls_handshake_timeout = self.TLS_HANDSHAKE_TIMEOUT
+        self.preview_max_side = self.PREVIEW_MAX_SIDE
+        self.preview_quality = self.PREVIEW_QUALITY
+        self.max_message_bytes = 32 * 1024 * 1024  # 单条文件或私聊消息的大小上限（压缩和解压后都不能超过），超过时丢弃
+        self.rate_limit = 0  # 每个连接每秒允许发送的消息数，0表示不限制
+        self.rate_limit_burst = 20  # 允许短时间内连续发送的消息数
+        self.log_level = 'debug'  # debug 输出每条消息和每个连接的处理日志，info 只输出重要事件
+        self.config_file = config_file
+        self.config_lock = threading.Lock()  # 防止同时进行两次重新加载
+        # 命令行参数和内置默认值，配置文件中删除某一项后恢复为这里的值
+        self._config_defaults = self._current_config()
+        self.cli_options = frozenset(cli_options)  # 命令行中明确给出的配置项，配置文件中的值不会覆盖它们
+        if config_file:
+            try:
+                if self._apply_config(self._read_config(), initial=True):
+                    print(f"✅ 已加载配置文件: {config_file}")
+            except (OSError, ValueError) as e:
+                print(f"❌ 加载配置文件失败，使用默认配置: {e}")
+        
         # 加载黑名单
         self._load_banned_ips()
         self.advertise_thread = None  # 广告线程
@@ -40,94 +772,823 @@ class ChatServer:
         # 服务器端命令输入线程
         self.command_thread = None
         self.command_running = False
+        
+        # 控制套接字（可选，仅限Unix）：本机的管理脚本通过它执行与控制台相同的命令
+        self.control_socket_path = control_socket
+        self.control_socket = None
+        
+        # 零停机重启：新进程通过旧进程的控制套接字接管监听套接字和会话状态
+        self.takeover_path = takeover  # 要接管的旧进程的控制套接字路径
+        self.accept_lock = threading.Lock()  # 移交期间暂停接受新连接
+        self.handing_off = False  # 正在把监听套接字移交给新进程
+        self.handed_off = False  # 已移交完成，剩余的连接只需关闭，不再广播离开消息
+        # 移交期间暂停分发客户端消息和所有广播，导出的状态之后不再有消息被分配序号或写入消息记录
+        self.dispatch_cond = threading.Condition()
+        self.dispatch_paused = False
+        self.dispatch_count = 0  # 正在分发的消息和正在进行的广播数
+        self.dispatch_parked = 0  # 在移交期间等待的客户端消息数
+        self._dispatch_depth = threading.local()  # 当前线程是否已在分发中（分发客户端消息时会再进行广播）
+        
+        # 运行指标：供 stats 命令查看，指定 metrics_port 时同时通过HTTP以 Prometheus 格式导出
+        self.started_at = time.monotonic()
+        self._init_metrics()
+        self.metrics_host = metrics_host
+        self.metrics_port = metrics_port
+        self.metrics_httpd = None
+        
+        # 分阶段计时（read/decode/dispatch/encode/fanout），默认关闭，关闭时每个阶段只多一次属性判断
+        self.stage_timing = False
+        self.profiler = SamplingProfiler()
+        self.profiles_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles')
+    
+    def _init_metrics(self):
+        """注册服务器的运行指标"""
+        m = self.metrics = MetricsRegistry()
+        m.gauge('uptime_seconds', '服务器已运行的秒数', func=lambda: round(time.monotonic() - self.started_at, 3))
+        m.gauge('connected_clients', '当前在线的客户端数', func=lambda: len(self.clients))
+        m.gauge('suspended_sessions', '意外断开、等待恢复的会话数', func=lambda: len(self.suspended_sessions))
+        m.gauge('rooms', '当前房间数', func=lambda: len(self.rooms))
+        m.gauge('banned_ips', '黑名单中的IP数', func=lambda: len(self.banned_ips))
+        m.gauge('file_cache_bytes', '文件内容缓存占用的字节数', func=lambda: self.file_cache.total_bytes)
+        self.metric_preview_queue = m.gauge('preview_queue_depth', '等待或正在生成的图片预览数')
+        self.metric_connections = m.counter('connections_total', '接受的TCP连接总数')
+        self.metric_handshake_failures = m.counter('handshake_failures_total', '握手失败次数', ['reason'])
+        self.metric_handshake_seconds = m.histogram('handshake_seconds', '从接受连接到发送 connected 的耗时')
+        self.metric_frames_in = m.counter('frames_received_total', '收到的消息数', ['type'])
+        self.metric_bytes_in = m.counter('bytes_received_total', '收到的消息字节数（含长度前缀）', ['type'])
+        self.metric_frames_out = m.counter('frames_sent_total', '发送的消息数', ['type'])
+        self.metric_bytes_out = m.counter('bytes_sent_total', '发送的消息字节数（含长度前缀，压缩后）', ['type'])
+        self.metric_send_failures = m.counter('send_failures_total', '发送失败的消息数', ['type'])
+        self.metric_lock_wait = m.histogram('clients_lock_wait_seconds', '广播等待客户端锁的时间（其他广播排队的程度）')
+        self.metric_broadcast_seconds = m.histogram('broadcast_seconds', '一次广播发送给所有接收者的耗时', ['kind'])
+        self.metric_broadcast_fanout = m.histogram('broadcast_recipients', '一次广播的接收者数', ['kind'],
+                                                   buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500))
+        self.metric_stage_seconds = m.histogram('stage_seconds', '消息处理各阶段的耗时（需用 timing on 开启）', ['stage'],
+                                                buckets=(0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001,
+                                                         0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0))
+        self.metric_rate_limited = m.counter('rate_limited_total', '因发送过快被丢弃的消息数', ['type'])
+        self.metric_oversized = m.counter('oversized_messages_total', '因超过大小上限被丢弃的消息数（未解析时类型为unknown）', ['type'])
+        self.metric_bans = m.counter('bans_total', '封禁IP的次数')
+        self.metric_ban_disconnects = m.counter('ban_disconnects_total', '因封禁而断开的用户数')
+    
+    def _stage_done(self, stage, started):
+        """记录一个处理阶段的耗时，返回当前时间作为下一阶段的开始（只在开启分阶段计时时调用）"""
+        now = time.perf_counter()
+        self.metric_stage_seconds.observe(now - started, stage=stage)
+        return now
+    
+    @contextlib.contextmanager
+    def _broadcast_lock(self, kind):
+        """获取客户端锁进行广播，记录等待锁的时间和广播耗时
+        
+        所有分配序号的广播都经过这里，移交给新进程期间先在 _dispatching 中等待。
+        """
+        with self._dispatching():
+            wait_started = time.perf_counter()
+            with self.clients_lock:
+                started = time.perf_counter()
+                self.metric_lock_wait.observe(started - wait_started)
+                try:
+                    yield
+                finally:
+                    self.metric_broadcast_seconds.observe(time.perf_counter() - started, kind=kind)
+    
+    @contextlib.contextmanager
+    def _dispatching(self, client_message=False):
+        """分发一条客户端消息或进行一次广播；移交期间在这里等待，移交失败后继续
+        
+        移交成功后，等待中的客户端消息（client_message 为True）抛出 DispatchRejected，由调用方通知发送者；
+        其他广播（会话过期、控制台公告等）继续等待直到进程退出，这些状态已由新进程接管。
+        同一线程中嵌套调用（分发客户端消息时进行的广播）不再等待。
+        """
+        depth = getattr(self._dispatch_depth, 'value', 0)
+        if depth == 0:
+            with self.dispatch_cond:
+                if self.dispatch_paused:
+                    self.dispatch_parked += client_message
+                    while self.dispatch_paused and not (client_message and self.handed_off):
+                        self.dispatch_cond.wait()
+                    self.dispatch_parked -= client_message
+                    self.dispatch_cond.notify_all()
+                    if self.handed_off:
+                        raise DispatchRejected()
+                self.dispatch_count += 1
+        self._dispatch_depth.value = depth + 1
+        try:
+            yield
+        finally:
+            self._dispatch_depth.value = depth
+            if depth == 0:
+                with self.dispatch_cond:
+                    self.dispatch_count -= 1
+                    self.dispatch_cond.notify_all()
+    
+    def _pause_dispatch(self, timeout):
+        """暂停分发客户端消息并等待正在分发的消息完成，超时时恢复分发并返回False"""
+        with self.dispatch_cond:
+            self.dispatch_paused = True
+            if self.dispatch_cond.wait_for(lambda: self.dispatch_count == 0, timeout):
+                return True
+        self._resume_dispatch()
+        return False
+    
+    def _resume_dispatch(self):
+        with self.dispatch_cond:
+            self.dispatch_paused = False
+            self.dispatch_cond.notify_all()
+    
+    def _ping_worker(self):
+        """定期向支持 server_ping 的客户端发送心跳，客户端回复 pong 时记录往返时间"""
+        while self.running:
+            time.sleep(self.ping_interval)
+            # 与广播一样持有客户端锁发送，避免与其他消息交错
+            with self.clients_lock:
+                for username, client_socket in list(self.clients.items()):
+                    stats = self.connection_stats.get(client_socket)
+                    if stats is None or 'server_ping' not in self.client_capabilities.get(username, ()):
+                        continue
+                    timestamp = self._now_ms()
+                    stats.ping_timestamp = timestamp
+                    stats.ping_sent_at = time.monotonic()
+                    try:
+                        self._send_frame(client_socket, transport.Frame.from_message({'type': 'heartbeat', 'timestamp': timestamp}))
+                    except Exception:
+                        pass
+    
+    def _start_control_server(self):
+        """在Unix域套接字上接受管理命令，套接字文件只有服务器所属用户可以访问"""
+        if not hasattr(socket, 'AF_UNIX'):
+            print("⚠️  当前系统不支持Unix域套接字，控制套接字未启用")
+            return
+        path = self.control_socket_path
+        if os.path.exists(path):
+            # 上次运行没有正常退出时会留下套接字文件；能连上说明另一个服务器正在使用
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+                print(f"⚠️  控制套接字 {path} 正被另一个服务器进程使用，控制套接字未启用")
+                return
+            except OSError:
+                os.unlink(path)
+            finally:
+                probe.close()
+        
+        control_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # 创建时就限制权限，避免 bind 和 chmod 之间被其他用户连接
+        old_umask = os.umask(0o177)
+        try:
+            control_socket.bind(path)
+        except OSError as e:
+            print(f"⚠️  控制套接字启动失败: {e}")
+            control_socket.close()
+            return
+        finally:
+            os.umask(old_umask)
+        control_socket.listen(16)
+        self.control_socket = control_socket
+        
+        if not isinstance(sys.stdout, ThreadOutputRouter):
+            # 没有控制台的环境（如 pythonw）中 sys.stdout 为 None
+            sys.stdout = ThreadOutputRouter(sys.stdout if sys.stdout is not None else open(os.devnull, 'w'))
+        threading.Thread(target=self._control_accept_loop, daemon=True, name='Control').start()
+        print(f"控制套接字: {path}")
+    
+    def _control_accept_loop(self):
+        while self.running:
+            try:
+                conn, _ = self.control_socket.accept()
+            except OSError:
+                break
+            threading.Thread(target=self._handle_control_connection, args=(conn,), daemon=True,
+                             name='Control-conn').start()
+    
+    def _handle_control_connection(self, conn):
+        """处理一个控制连接：每行一个请求，每个请求回复一行JSON
+        
+        请求可以是 JSON 对象 {"command": "users"} 或 {"commands": ["ban 1.2.3.4", "ban 5.6.7.8"]}，
+        也可以直接是一行命令文本；批量命令按顺序执行，全部完成后一起回复
+        """
+        with conn, conn.makefile('rb') as reader:
+            for line in reader:
+                line = line.decode('utf-8', errors='replace').strip()
+                if not line:
+                    continue
+                if line.startswith('{"handoff"'):
+                    # 新的服务器进程请求接管（见 _take_over），之后这个连接只用于移交
+                    self._hand_off(conn, reader)
+                    return
+                if line.startswith('{'):
+                    try:
+                        request = json.loads(line)
+                        commands = request['commands'] if 'commands' in request else [request['command']]
+                        if not all(isinstance(command, str) for command in commands):
+                            raise ValueError
+                    except (ValueError, KeyError, TypeError):
+                        response = {'ok': False, 'error': '请求格式错误，应为 {"command": "..."} 或 {"commands": [...]}'}
+                        commands = None
+                else:
+                    commands = [line]
+                if commands is not None:
+                    results = [self._run_control_command(command) for command in commands]
+                    response = {'ok': all(result['ok'] for result in results), 'results': results}
+                try:
+                    conn.sendall(json.dumps(response, ensure_ascii=False).encode('utf-8') + b'\n')
+                except OSError:
+                    break
+    
+    def _run_control_command(self, command):
+        """执行一条管理命令，返回包含执行结果、输出和（部分命令的）结构化数据的结果"""
+        with sys.stdout.capture() as buffer:
+            try:
+                ok = self._handle_server_command(command)
+            except Exception as e:
+                print(f"❌ 执行命令出错: {e}")
+                ok = False
+        output = buffer.getvalue().strip('\n')
+        result = {'command': command, 'ok': ok, 'output': output}
+        parts = command.split()
+        cmd = parts[0].lower() if parts else ''
+        if cmd == 'users':
+            with self.clients_lock:
+                result['data'] = [{'username': username, 'ip': self.user_ips.get(username),
+                                   'room': self.user_rooms.get(username, self.DEFAULT_ROOM)}
+                                  for username in self.clients]
+        elif cmd == 'rooms':
+            with self.clients_lock:
+                result['data'] = {room: len(members) for room, members in self.rooms.items()}
+        elif cmd == 'version':
+            result['data'] = {'server_version': self.SERVER_VERSION,
+                              'supported_client_versions': list(self.supported_client_versions)}
+        return result
+    
+    def _export_state(self):
+        """导出会话和消息状态，供接管的新进程恢复（调用方需持有客户端锁）
+        
+        只导出支持会话恢复的在线用户和等待恢复的会话；旧版客户端无法恢复会话，重新连接时作为新用户加入。
+        """
+        sessions = []
+        for token, username in self.sessions.items():
+            if username in self.suspended_sessions:
+                ip = self.suspended_sessions[username]['ip']
+            elif 'resume' in self.client_capabilities.get(username, ()):
+                ip = self.user_ips.get(username)
+            else:
+                continue
+            sessions.append({'username': username, 'token': token, 'ip': ip,
+                             'room': self.user_rooms.get(username, self.DEFAULT_ROOM)})
+        rooms = {self.DEFAULT_ROOM} | {session['room'] for session in sessions}
+        return {
+            'server_epoch': self.server_epoch,
+            'seq': self._seq,
+            'room_seqs': {room: seq for room, seq in self.room_seqs.items() if room in rooms},
+            'sessions': sessions,
+            'histories': {room: history.export() for room, history in self.room_histories.items() if room in rooms},
+            'files': self.file_cache.export()
+        }
+    
+    def _import_state(self, state):
+        """恢复旧进程导出的状态，返回恢复的会话数
+        
+        运行标识和序号保持不变，客户端已收到的序号仍然有效；
+        所有会话都作为等待恢复的会话，客户端重新连接后凭令牌恢复。
+        """
+        with self.clients_lock:
+            self.server_epoch = state['server_epoch']
+            self._seq = state['seq']
+            self.room_seqs.update(state['room_seqs'])
+            for session in state['sessions']:
+                username, token = session['username'], session['token']
+                self.sessions[token] = username
+                self._add_to_room(username, session['room'])
+                timer = threading.Timer(self.session_resume_grace, self._expire_session, args=(username, token))
+                timer.daemon = True
+                self.suspended_sessions[username] = {
+                    'token': token,
+                    'ip': session['ip'],
+                    'timer': timer
+                }
+                timer.start()
+            if self.history_size > 0:
+                for room, history_state in state['histories'].items():
+                    history = self.room_histories[room] = MessageHistory(self.history_size, self.history_bytes)
+                    history.restore(history_state)
+        self.file_cache.restore(state['files'])
+        return len(state['sessions'])
+    
+    def _take_over(self, path):
+        """通过旧进程的控制套接字接管其监听套接字和会话状态（零停机重启的新进程一侧），返回是否成功"""
+        if not hasattr(socket, 'recv_fds'):
+            print("❌ 当前系统不支持在进程间传递套接字，无法接管")
+            return False
+        print(f"正在通过 {path} 接管正在运行的服务器...")
+        listener = None
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+                conn.settimeout(60)
+                conn.connect(path)
+                conn.sendall(json.dumps({'handoff': self.SERVER_VERSION}).encode('utf-8') + b'\n')
+                # 监听套接字随8字节的状态长度一起发送，之后是JSON格式的状态
+                header, fds, _, _ = socket.recv_fds(conn, 8, 1)
+                if not fds:
+                    # 旧进程拒绝移交时回复一行错误信息
+                    with conn.makefile('rb') as reader:
+                        response = json.loads(header + reader.readline())
+                    print(f"❌ 旧进程拒绝移交: {response.get('error')}")
+                    return False
+                listener = socket.socket(fileno=fds[0])
+                if len(header) < 8:
+                    header += self.recv_all(conn, 8 - len(header)) or b''
+                state_size = struct.unpack('!Q', header)[0]
+                if state_size > self.HANDOFF_MAX_STATE_BYTES:
+                    raise ValueError(f'旧进程发送的状态过大（{state_size} bytes）')
+                payload = self.recv_all(conn, state_size)
+                if payload is None:
+                    raise ConnectionError('旧进程在发送状态时断开')
+                restored = self._import_state(json.loads(payload.decode('utf-8')))
+                conn.sendall(b'{"ok": true}\n')
+        except (OSError, ValueError, KeyError, TypeError, struct.error) as e:
+            print(f"❌ 接管失败: {e}")
+            if listener is not None:
+                listener.close()
+            return False
+        
+        self.server_socket.close()
+        self.server_socket = listener
+        self.host, self.port = listener.getsockname()[:2]
+        print(f"✅ 已接管监听套接字，恢复了 {restored} 个会话")
+        return True
+    
+    def _hand_off(self, conn, reader):
+        """把监听套接字和会话状态移交给接管的新进程（零停机重启的旧进程一侧）
+        
+        移交期间暂停接受连接、分发客户端消息和广播，导出状态后不再有消息被分配序号；新进程确认后
+        拒绝等待中的客户端消息并通知发送者，然后通知客户端在随机的时间重连，客户端凭会话令牌在新进程中
+        恢复会话，其他用户看不到离开和加入消息。
+        新进程没有在 HANDOFF_TIMEOUT 秒内确认时恢复分发，继续正常运行。
+        """
+        if self.handing_off or not self.running or not hasattr(socket, 'send_fds'):
+            self._refuse_handoff(conn, '服务器正在关闭或正在移交给其他进程')
+            return
+        self.handing_off = True
+        print("收到新进程的接管请求，正在移交监听套接字...")
+        if not self._pause_dispatch(self.HANDOFF_TIMEOUT):
+            print("❌ 正在分发的消息没有及时完成，取消移交")
+            self._refuse_handoff(conn, '正在分发的消息没有及时完成')
+            self.handing_off = False
+            return
+        # 等待当前的 accept 超时返回；此后到达的连接留在监听队列中，由新进程接受
+        with self.accept_lock:
+            # 新进程需要使用同样的指标端口和控制套接字路径
+            self._stop_control_endpoints()
+            try:
+                with self.clients_lock:
+                    payload = json.dumps(self._export_state()).encode('utf-8')
+                socket.send_fds(conn, [struct.pack('!Q', len(payload))], [self.server_socket.fileno()])
+                conn.sendall(payload)
+                # 等待确认时不持有客户端锁，其他连接的心跳、登录和控制台命令不受影响
+                conn.settimeout(self.HANDOFF_TIMEOUT)
+                ack = reader.readline()
+                accepted = bool(ack) and json.loads(ack).get('ok') is True
+            except (OSError, ValueError) as e:
+                print(f"❌ 移交失败: {e}")
+                accepted = False
+            
+            if accepted:
+                with self.clients_lock:
+                    self.handed_off = True
+                # 移交期间等待的客户端消息不再处理，先通知发送者（客户端收到 server_restart 后不再读取消息）
+                with self.dispatch_cond:
+                    self.dispatch_cond.notify_all()
+                    self.dispatch_cond.wait_for(lambda: self.dispatch_parked == 0, 1)
+                with self.clients_lock:
+                    restart_message = {
+                        'type': 'server_restart',
+                        'content': '服务器正在更新，即将自动重新连接',
+                        'reconnect_within': self.RESTART_RECONNECT_WINDOW * 1000
+                    }
+                    client_sockets = list(self.clients.values())
+                    for client_socket in client_sockets:
+                        self.send_message_to_client(client_socket, restart_message)
+            
+            if not accepted:
+                print("❌ 新进程没有确认接管，继续运行")
+                self.handing_off = False
+                self._resume_dispatch()
+                self._start_control_endpoints()
+                return
+        
+        print(f"✅ 已移交给新进程，已通知 {len(client_sockets)} 个在线用户重新连接")
+        # 给客户端时间接收消息，之后关闭连接并退出（会话已由新进程接管，不广播离开或关闭消息）
+        time.sleep(0.5)
+        for client_socket in client_sockets:
+            try:
+                client_socket.shutdown(socket.SHUT_RDWR)
+                client_socket.close()
+            except OSError:
+                pass
+        print("旧进程已退出")
+        sys.stdout.flush()
+        os._exit(0)
+    
+    def _refuse_handoff(self, conn, error):
+        """拒绝接管请求：回复一行错误信息（不附带监听套接字）"""
+        try:
+            conn.sendall(json.dumps({'ok': False, 'error': error}, ensure_ascii=False).encode('utf-8') + b'\n')
+        except OSError:
+            pass
+    
+    def _start_control_endpoints(self):
+        """启动已配置的指标接口和控制套接字"""
+        if self.metrics_port:
+            self._start_metrics_server()
+        if self.control_socket_path:
+            self._start_control_server()
+    
+    def _stop_control_endpoints(self):
+        """停止指标接口，关闭控制套接字并删除套接字文件"""
+        if self.metrics_httpd is not None:
+            self.metrics_httpd.shutdown()
+            self.metrics_httpd.server_close()
+            self.metrics_httpd = None
+        if self.control_socket is not None:
+            self.control_socket.close()
+            self.control_socket = None
+            try:
+                os.unlink(self.control_socket_path)
+            except OSError:
+                pass
+    
+    def _start_metrics_server(self):
+        """在后台线程中提供 /metrics HTTP接口（默认只监听本机）"""
+        registry = self.metrics
+        
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            
+            def log_message(self, format, *args):
+                # 抓取请求很频繁，不输出访问日志
+                pass
+        
+        try:
+            self.metrics_httpd = ThreadingHTTPServer((self.metrics_host, self.metrics_port), MetricsHandler)
+        except OSError as e:
+            print(f"⚠️  指标接口启动失败: {e}")
+            return
+        self.metrics_httpd.daemon_threads = True
+        threading.Thread(target=self.metrics_httpd.serve_forever, daemon=True, name='Metrics').start()
+        print(f"指标接口: http://{self.metrics_host}:{self.metrics_port}/metrics")
+    
+    def _current_config(self):
+        """当前生效的可配置项"""
+        mb = 1024 * 1024
+        return {
+            'host': self.host,
+            'port': self.port,
+            'supported_client_versions': list(self.supported_client_versions),
+            'max_message_mb': self.max_message_bytes / mb,
+            'rate_limit': self.rate_limit,
+            'rate_limit_burst': self.rate_limit_burst,
+            'log_level': self.log_level,
+            'session_resume_grace': self.session_resume_grace,
+            'ping_interval': self.ping_interval,
+            'tls_handshake_timeout': self.tls_handshake_timeout,
+            'file_cache_mb': self.file_cache.max_bytes / mb,
+            'file_ttl': self.file_cache.ttl,
+            'history': self.history_size,
+            'history_mb': self.history_bytes / mb,
+            'preview_max_side': self.preview_max_side,
+            'preview_quality': self.preview_quality,
+            'banned_ips_file': self.banned_ips_file,
+        }
+    
+    def _read_config(self):
+        """读取并校验配置文件，返回 {项目: 值}；有任何错误时抛出 ValueError，不会只应用一部分"""
+        if not os.path.exists(self.config_file):
+            return {}
+        with open(self.config_file, 'r', encoding='utf-8') as f:
+            try:
+                raw = json.load(f)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"JSON格式错误: {e}")
+        if not isinstance(raw, dict):
+            raise ValueError("配置文件应为JSON对象")
+        values = {}
+        for key, value in raw.items():
+            if key.startswith('_'):
+                # 下划线开头的项目用作注释
+                continue
+            validate = CONFIG_OPTIONS.get(key)
+            if validate is None:
+                raise ValueError(f"未知的配置项: {key}")
+            try:
+                values[key] = validate(value)
+            except ValueError as e:
+                raise ValueError(f"配置项 {key} 无效: {e}")
+        if 'banned_ips_file' in values:
+            # 相对路径相对于配置文件所在目录
+            values['banned_ips_file'] = os.path.join(os.path.dirname(os.path.abspath(self.config_file)),
+                                                     values['banned_ips_file'])
+        return values
+    
+    def _apply_config(self, values, initial=False):
+        """应用配置项（值已校验）；配置文件中没有的项目恢复为默认值，返回实际发生变化的项目
+        
+        命令行中明确给出的项目保持命令行的值，配置文件中的不同设置会被忽略并给出提示。
+        """
+        config = dict(self._config_defaults)
+        for key, value in values.items():
+            if key in self.cli_options:
+                if value != config[key]:
+                    print(f"⚠️  配置项 {key} 已由命令行参数指定，忽略配置文件中的值 "
+                          f"{json.dumps(value, ensure_ascii=False)}")
+                continue
+            config[key] = value
+        current = self._current_config()
+        changed = {key: value for key, value in config.items() if current[key] != value}
+        if not initial:
+            for key in RESTART_ONLY_OPTIONS:
+                if changed.pop(key, None) is not None:
+                    print(f"⚠️  配置项 {key} 需要重启服务器才能生效")
+        
+        mb = 1024 * 1024
+        # 持有客户端锁一次性切换，广播和握手不会看到只更新了一半的配置
+        with self.clients_lock:
+            if initial:
+                self.host = config['host']
+                self.port = config['port']
+            self.supported_client_versions = config['supported_client_versions']
+            self.max_message_bytes = int(config['max_message_mb'] * mb)
+            self.rate_limit = config['rate_limit']
+            self.rate_limit_burst = config['rate_limit_burst']
+            self.log_level = config['log_level']
+            self.session_resume_grace = config['session_resume_grace']
+            self.ping_interval = config['ping_interval']
+            self.tls_handshake_timeout = config['tls_handshake_timeout']
+            # 缓存和消息记录的容量缩小后，多出的条目在下一次写入时淘汰
+            self.file_cache.max_bytes = int(config['file_cache_mb'] * mb)
+            self.file_cache.ttl = config['file_ttl']
+            self.history_size = config['history']
+            self.history_bytes = int(config['history_mb'] * mb)
+            if self.history_size > 0:
+                for history in self.room_histories.values():
+                    history.max_count = self.history_size
+                    history.max_bytes = self.history_bytes
+            else:
+                self.room_histories.clear()
+            self.preview_max_side = config['preview_max_side']
+            self.preview_quality = config['preview_quality']
+            self.banned_ips_file = config['banned_ips_file']
+        return changed
+    
+    def reload_config(self):
+        """重新加载配置文件和黑名单，已有的连接不受影响；配置文件有错误时保持当前配置"""
+        if not self.config_file:
+            print("❌ 服务器启动时没有指定配置文件")
+            return False
+        with self.config_lock:
+            try:
+                values = self._read_config()
+            except (OSError, ValueError) as e:
+                print(f"❌ 配置文件无效，保持当前配置: {e}")
+                return False
+            changed = self._apply_config(values)
+            if changed:
+                for key, value in changed.items():
+                    print(f"✅ {key} = {json.dumps(value, ensure_ascii=False)}")
+            else:
+                print("✅ 配置没有变化")
+            return self._reload_banned_ips()
+    
+    def _reload_signal_handler(self, signum, frame):
+        # 在新线程中重新加载，避免在信号处理器中获取锁
+        print("\n收到信号 SIGHUP，正在重新加载配置...")
+        threading.Thread(target=self.reload_config, daemon=True).start()
+    
+    def _read_banned_ips(self):
+        """读取黑名单文件，返回 (BanList, 无效条目数)"""
+        with open(self.banned_ips_file, 'r', encoding='utf-8') as f:
+            banned_list = json.load(f)
+        banned_ips = BanList()
+        invalid = 0
+        for entry in banned_list:
+            try:
+                banned_ips.add(entry)
+            except (ValueError, AttributeError):
+                invalid += 1
+        return banned_ips, invalid
+    
+    def _reload_banned_ips(self):
+        """重新读取黑名单文件（可能被手动修改或换成了其他文件），并断开新增条目命中的用户，返回是否成功"""
+        if not os.path.exists(self.banned_ips_file):
+            if not self._save_banned_ips():
+                return False
+            print(f"✅ 已创建新的黑名单文件: {self.banned_ips_file}")
+            return True
+        try:
+            banned_ips, invalid = self._read_banned_ips()
+        except (OSError, ValueError) as e:
+            print(f"❌ 读取黑名单文件失败，保持当前黑名单: {e}")
+            return False
+        old_entries = set(self.banned_ips)
+        added = [entry for entry in banned_ips if entry not in old_entries]
+        removed = len(old_entries) - (len(banned_ips) - len(added))
+        self.banned_ips = banned_ips
+        print(f"✅ 已重新加载黑名单: {len(banned_ips)} 个地址或网段（新增 {len(added)}，移除 {removed}）")
+        if invalid:
+            print(f"⚠️  黑名单文件中有 {invalid} 个无效条目，已忽略")
+        if added:
+            targets = self._disconnect_banned(added)
+            if targets:
+                print(f"✅ 已断开 {len(targets)} 个用户的连接")
+        return True
+    
+    def _log_debug(self, text):
+        """只在 debug 日志级别下输出（每条消息、每个连接的处理过程）"""
+        if self.log_level == 'debug':
+            print(text)
+    
+    def _allow_message(self, stats, client_socket, msg_type):
+        """按令牌桶检查连接的发送频率，超过限制时丢弃消息并提醒客户端一次"""
+        now = time.monotonic()
+        stats.tokens = min(self.rate_limit_burst, stats.tokens + (now - stats.tokens_at) * self.rate_limit)
+        stats.tokens_at = now
+        if stats.tokens >= 1:
+            stats.tokens -= 1
+            stats.rate_limited = False
+            return True
+        self.metric_rate_limited.inc(type=msg_type)
+        if not stats.rate_limited:
+            stats.rate_limited = True
+            # 与广播共用锁，避免与广播数据交错写入同一个socket
+            with self.clients_lock:
+                self.send_message_to_client(client_socket, {
+                    'type': 'system',
+                    'content': '⚠️ 发送过于频繁，部分消息未被发送'
+                })
+        return False
+    
+    def _reject_oversized(self, username, client_socket, msg_type, size, limit):
+        """丢弃超过大小上限的消息并提醒发送者"""
+        def fmt_size(n):
+            return f"{n / (1024 * 1024):.1f}MB" if n >= 1024 * 1024 else f"{n / 1024:.0f}KB"
+        
+        print(f"用户 {username} 的消息过大（{size} bytes，上限 {limit} bytes），已丢弃")
+        self.metric_oversized.inc(type=msg_type)
+        with self.clients_lock:
+            self.send_message_to_client(client_socket, {
+                'type': 'system',
+                'content': f'⚠️ 消息过大（{fmt_size(size)}），服务器只接受不超过 {fmt_size(limit)} 的消息，未被发送'
+            })
     
     def _load_banned_ips(self):
         """从JSON文件加载黑名单"""
         try:
             if os.path.exists(self.banned_ips_file):
-                with open(self.banned_ips_file, 'r', encoding='utf-8') as f:
-                    banned_list = json.load(f)
-                    self.banned_ips = set(banned_list)
-                    print(f"✅ 已加载 {len(self.banned_ips)} 个被禁止的IP地址")
+                self.banned_ips, invalid = self._read_banned_ips()
+                print(f"✅ 已加载 {len(self.banned_ips)} 个被禁止的IP地址或网段")
+                if invalid:
+                    print(f"⚠️  黑名单文件中有 {invalid} 个无效条目，已忽略")
             else:
                 # 创建空的黑名单文件
                 self._save_banned_ips()
                 print("✅ 已创建新的黑名单文件")
         except Exception as e:
             print(f"❌ 加载黑名单文件失败: {e}")
-            self.banned_ips = set()
+            self.banned_ips = BanList()
     
     def _save_banned_ips(self):
-        """保存黑名单到JSON文件"""
+        """保存黑名单到JSON文件，返回是否成功"""
         try:
-            with open(self.banned_ips_file, 'w', encoding='utf-8') as f:
+            # 先写入临时文件再替换，写到一半时进程退出也不会损坏黑名单
+            temp_file = self.banned_ips_file + '.tmp'
+            with open(temp_file, 'w', encoding='utf-8') as f:
                 json.dump(list(self.banned_ips), f, ensure_ascii=False, indent=2)
+            os.replace(temp_file, self.banned_ips_file)
         except Exception as e:
             print(f"❌ 保存黑名单文件失败: {e}")
+            return False
+        return True
     
-    def validate_client_version(self, client_socket):
-        """验证客户端版本是否兼容"""
+    def _tls_handshake(self, client_socket, client_address):
+        """完成服务器端TLS握手，返回包装后的socket，失败时关闭连接并返回None"""
         try:
-            # 接收消息长度（4字节）
-            length_data = self.recv_all(client_socket, 4)
-            if not length_data:
-                return False, "无法接收消息长度"
-            
-            message_length = struct.unpack('!I', length_data)[0]
-            
-            # 接收版本信息消息内容
-            version_data = self.recv_all(client_socket, message_length)
-            if not version_data:
-                return False, "无法接收版本信息"
+            # 关闭Nagle算法：TLS 1.2 恢复会话时握手后的第一次写入会等待延迟确认（约40ms）
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client_socket.settimeout(self.tls_handshake_timeout)
+            tls_socket = self.ssl_context.wrap_socket(client_socket, server_side=True)
+            tls_socket.settimeout(None)
+        except (ssl.SSLError, OSError) as e:
+            print(f"客户端 {client_address} TLS握手失败: {e}")
+            self.metric_handshake_failures.inc(reason='tls')
+            try:
+                client_socket.close()
+            except Exception:
+                pass
+            return None
+        print(f"客户端 {client_address} TLS握手完成: {tls_socket.version()}"
+              f"{'（恢复会话）' if tls_socket.session_reused else ''}")
+        return tls_socket
+    
+    def _read_handshake(self, connection):
+        """读取一条握手消息并解析JSON，连接关闭时返回None
+        
+        握手消息不压缩；超过连接的大小上限（登录前为 HANDSHAKE_MAX_BYTES）时不读出消息体，
+        抛出 FrameTooLarge，连接不再使用。
+        """
+        header = connection.read_header()
+        if header is None:
+            return None
+        length, compressed = header
+        if compressed:
+            raise ValueError("握手消息不能压缩")
+        data = connection.read_body(length, discard=False)
+        if data is None:
+            return None
+        return json.loads(data.decode('utf-8'))
+    
+    def validate_client_version(self, connection):
+        """验证客户端版本是否兼容
+        
+        返回 (是否通过, 错误信息, hello消息)。新版客户端发送的 hello 消息中同时带有昵称等信息，
+        此时不单独回复 version_accepted，由调用方直接回复 connected；旧版客户端的 hello消息为None
+        """
+        client_socket = connection.sock
+        try:
+            try:
+                version_json = self._read_handshake(connection)
+            except transport.FrameTooLarge as e:
+                # 尚未通过验证，不为超大的消息分配内存
+                return False, f"版本信息消息过大（{e.size} bytes）", None
+            if version_json is None:
+                return False, "无法接收版本信息", None
             
-            version_json = json.loads(version_data.decode('utf-8'))
             encrypted_version = version_json.get('version')
+            is_hello = version_json.get('type') == 'hello'
             
             # 尝试解密base64编码的版本号
             try:
                 client_version = base64.b64decode(encrypted_version).decode('utf-8')
             except Exception as e:
                 print(f"版本号解密失败: {e}")
-                return False, "版本号格式错误，无法解密"
+                return False, "版本号格式错误，无法解密", None
             
             if not client_version:
                 # 未提供版本信息，视为版本不兼容
-                return False, "客户端未提供版本信息"
+                return False, "客户端未提供版本信息", None
                 
             # 检查版本是否兼容
-            if client_version in self.SUPPORTED_CLIENT_VERSIONS:
-                # 版本兼容，发送接受响应
+            if client_version in self.supported_client_versions:
+                if is_hello:
+                    self._log_debug(f"客户端版本验证成功: {client_version}（hello握手）")
+                    return True, None, version_json
+                # 版本兼容，发送接受响应；支持压缩的客户端在版本信息中列出了压缩算法
+                codec = transport.choose_codec(version_json.get('compression'))
                 success_message = {
                     'type': 'version_accepted',
-                    'content': f'版本验证通过 ({client_version})'
+                    'content': f'版本验证通过 ({client_version})',
+                    'compression': codec
                 }
                 if self.send_message_to_client(client_socket, success_message):
-                    print(f"客户端版本验证成功: {client_version}")
-                    return True, None
+                    self._log_debug(f"客户端版本验证成功: {client_version}")
+                    # 之后的消息都可以压缩（本条确认消息不压缩）
+                    connection.codec = codec
+                    return True, None, None
                 else:
                     print(f"发送版本接受消息失败，关闭连接")
-                    return False, "发送版本接受消息失败"
+                    return False, "发送版本接受消息失败", None
             else:
                 # 版本不兼容，发送不兼容响应
                 error_message = {
                     'type': 'version_mismatch',
-                    'content': f"客户端版本不兼容，支持的版本: {', '.join(self.SUPPORTED_CLIENT_VERSIONS)}",
-                    'supported_versions': self.SUPPORTED_CLIENT_VERSIONS
+                    'content': f"客户端版本不兼容，支持的版本: {', '.join(self.supported_client_versions)}",
+                    'supported_versions': self.supported_client_versions
                 }
                 self.send_message_to_client(client_socket, error_message)
-                return False, f"客户端版本不兼容，支持的版本: {', '.join(self.SUPPORTED_CLIENT_VERSIONS)}"
+                return False, f"客户端版本不兼容，支持的版本: {', '.join(self.supported_client_versions)}", None
         except ConnectionResetError as e:
             print(f"版本验证错误: 客户端重置连接 - {e}")
-            return False, f"客户端重置连接: {e}"
+            return False, f"客户端重置连接: {e}", None
         except socket.error as e:
             print(f"版本验证错误: Socket网络错误 - {e}")
-            return False, f"网络连接错误: {e}"
+            return False, f"网络连接错误: {e}", None
         except json.JSONDecodeError as e:
             print(f"版本验证错误: JSON解析失败 - {e}")
-            return False, f"版本信息格式错误: {e}"
+            return False, f"版本信息格式错误: {e}", None
+        except ValueError as e:
+            print(f"版本验证错误: {e}")
+            return False, f"版本信息格式错误: {e}", None
         except Exception as e:
             print(f"版本验证错误: 未知错误 - {e}")
-            return False, f"版本验证过程中发生错误: {e}"
+            return False, f"版本验证过程中发生错误: {e}", None
         
     def start(self):
         # 注册信号处理器
@@ -135,28 +1596,54 @@ class ChatServer:
         # SIGTERM在Windows上可能不可用
         if hasattr(signal, 'SIGTERM'):
             signal.signal(signal.SIGTERM, self._signal_handler)
+        # SIGHUP 只在Unix上可用
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, self._reload_signal_handler)
         atexit.register(self.graceful_shutdown)
         
         try:
-            self.server_socket.bind((self.host, self.port))
-            self.server_socket.listen(5)
-            print(f"服务器启动成功，监听 {self.host}:{self.port}")
+            if self.takeover_path:
+                # 零停机重启：使用旧进程的监听套接字，不重新绑定端口
+                if not self._take_over(self.takeover_path):
+                    # 还没有接受任何连接，直接以非零状态退出，便于部署脚本判断接管是否成功
+                    sys.stdout.flush()
+                    os._exit(1)
+            else:
+                self.server_socket.bind((self.host, self.port))
+                # 监听队列过短时大量客户端同时连接（如服务器重启后）会被丢弃SYN，只能等待约1秒后重传
+                self.server_socket.listen(socket.SOMAXCONN)
+            print(f"服务器启动成功，监听 {self.host}:{self.port}" + ("（TLS）" if self.ssl_context else ""))
             print("="*60)
             print("   输入 'help' 显示所有可用命令")
             print("   按下 Ctrl+C 或输入 'shutdown' 停止服务器")
             print("   服务器日志将在下方显示")
             print("="*60)
             
-            # 启动服务器端命令输入线程
+            threading.Thread(target=self._ping_worker, daemon=True, name='Ping').start()
+            
+            self._start_control_endpoints()
+            
+            # 启动服务器端命令输入线程（标准输入已关闭时不启动）
             self.command_running = True
-            self.command_thread = threading.Thread(target=self._command_input_worker, daemon=True)
-            self.command_thread.start()
+            if sys.stdin is not None and not sys.stdin.closed:
+                self.command_thread = threading.Thread(target=self._command_input_worker, daemon=True)
+                self.command_thread.start()
             
             while self.running:
+                if self.handing_off:
+                    # 监听套接字正在或已经移交给新进程
+                    time.sleep(0.1)
+                    continue
                 try:
-                    self.server_socket.settimeout(1.0)  # 设置超时以便检查running状态
-                    client_socket, client_address = self.server_socket.accept()
-                    print(f"新连接：{client_address} - Socket: {client_socket.fileno()}")
+                    with self.accept_lock:
+                        self.server_socket.settimeout(1.0)  # 设置超时以便检查running状态
+                        client_socket, client_address = self.server_socket.accept()
+                    self._log_debug(f"新连接：{client_address} - Socket: {client_socket.fileno()}")
+                    
+                    # 被封禁的IP在TLS握手和任何协议处理之前拒绝
+                    if client_address[0] in self.banned_ips:
+                        self._reject_banned(client_socket, client_address[0])
+                        continue
                     
                     # 为每个客户端连接创建独立的线程，避免阻塞主循环
                     client_thread = threading.Thread(
@@ -189,154 +1676,333 @@ class ChatServer:
         finally:
             self.graceful_shutdown()
     
+    def _reject_banned(self, client_socket, client_ip):
+        """拒绝被封禁IP的连接（在accept循环中调用，尚未进行TLS握手）
+        
+        未启用TLS时发送封禁通知（客户端收到后不再自动重连）；启用TLS时发送通知需要先完成握手，
+        封禁的意义正是避免这部分开销，因此直接关闭连接。
+        """
+        print(f"拒绝被禁止的IP {client_ip} 的连接")
+        self.metric_connections.inc()
+        self.metric_handshake_failures.inc(reason='banned')
+        
+        def close_socket():
+            # 安全关闭socket连接
+            try:
+                client_socket.shutdown(socket.SHUT_RDWR)
+            except Exception:
+                pass  # 忽略shutdown错误
+            
+            try:
+                client_socket.close()
+            except Exception:
+                pass  # 忽略close错误
+        
+        if self.ssl_context is not None:
+            close_socket()
+            return
+        
+        # 在独立的线程中发送通知，避免阻塞accept循环
+        def handle_banned_ip():
+            try:
+                banned_message = {
+                    "type": "banned",
+                    "content": "您的IP地址已被该服务器封禁",
+                    "timestamp": int(time.time())
+                }
+                self.send_message_to_client(client_socket, banned_message)
+                # 给客户端一点时间接收消息
+                time.sleep(0.05)
+            except Exception as e:
+                print(f"向被封禁IP {client_ip} 发送消息失败: {e}")
+            finally:
+                close_socket()
+                print(f"已关闭被封禁IP {client_ip} 的连接")
+        
+        threading.Thread(target=handle_banned_ip, daemon=True).start()
+    
     def handle_client(self, client_socket, client_address):
         username = None
+        session_token = None
+        explicit_disconnect = False
         client_ip = client_address[0]
-        print(f"开始处理客户端 {client_address} - Socket: {client_socket.fileno()}")
+        accepted_at = time.perf_counter()
+        self.metric_connections.inc()
+        self._log_debug(f"开始处理客户端 {client_address} - Socket: {client_socket.fileno()}")
         
-        # 检查IP是否被禁止
-        if client_ip in self.banned_ips:
-            print(f"拒绝被禁止的IP {client_ip} 的连接")
-            
-            # 在独立的线程中处理被封禁IP，避免影响主线程
-            def handle_banned_ip():
-                try:
-                    banned_message = {
-                        "type": "banned",
-                        "content": "您的IP地址已被该服务器封禁",
-                        "timestamp": int(time.time())
-                    }
-                    self.send_message_to_client(client_socket, banned_message)
-                    # 给客户端一点时间接收消息
-                    time.sleep(0.05)
-                except Exception as e:
-                    print(f"向被封禁IP {client_ip} 发送消息失败: {e}")
-                finally:
-                    # 安全关闭socket连接
-                    try:
-                        client_socket.shutdown(socket.SHUT_RDWR)
-                    except Exception:
-                        pass  # 忽略shutdown错误
-                    
-                    try:
-                        client_socket.close()
-                    except Exception:
-                        pass  # 忽略close错误
-                    
-                    print(f"已关闭被封禁IP {client_ip} 的连接")
-            
-            # 在独立线程中处理，避免阻塞
-            banned_thread = threading.Thread(target=handle_banned_ip, daemon=True)
-            banned_thread.start()
-            return
+        if self.ssl_context is not None:
+            # 在处理线程中完成TLS握手，慢速或恶意的客户端不会阻塞accept循环
+            client_socket = self._tls_handshake(client_socket, client_address)
+            if client_socket is None:
+                return
         
+        stats = self.connection_stats[client_socket] = ConnectionStats(client_ip)
+        # 登录前只接受很小的握手消息，登录后按 max_message_bytes 接收
+        connection = self.connections[client_socket] = transport.Connection(client_socket,
+                                                                               max_frame_size=self.HANDSHAKE_MAX_BYTES)
         try:
             # 先验证客户端版本
-            print(f"正在验证客户端 {client_address} 的版本...")
-            is_valid_version, version_error = self.validate_client_version(client_socket)
+            self._log_debug(f"正在验证客户端 {client_address} 的版本...")
+            is_valid_version, version_error, hello = self.validate_client_version(connection)
             if not is_valid_version:
                 print(f"客户端 {client_address} 版本验证失败: {version_error}")
+                self.metric_handshake_failures.inc(reason='version')
                 client_socket.close()
                 return
-            print(f"客户端 {client_address} 版本验证成功")
-                
-            # 版本验证通过后，接收昵称
-            # 接收消息长度（4字节）
-            length_data = self.recv_all(client_socket, 4)
-            if not length_data:
-                client_socket.close()
-                return
+            self._log_debug(f"客户端 {client_address} 版本验证成功")
             
-            message_length = struct.unpack('!I', length_data)[0]
+            if hello is not None:
+                # 新版客户端：昵称等信息和版本信息在同一条 hello 消息中，压缩算法随 connected 回复协商
+                username_json = hello
+            else:
+                # 旧版客户端：版本验证通过后，接收昵称
+                try:
+                    username_json = self._read_handshake(connection)
+                except (OSError, ValueError) as e:
+                    print(f"客户端 {client_address} 的昵称消息无效（{e}），关闭连接")
+                    username_json = None
+                if username_json is None:
+                    self.metric_handshake_failures.inc(reason='protocol')
+                    client_socket.close()
+                    return
             
-            # 接收用户名消息内容
-            username_data = self.recv_all(client_socket, message_length)
-            if not username_data:
+            try:
+                # 旧版客户端的昵称消息没有 type 字段，同样按 hello 消息解析
+                if isinstance(username_json, dict):
+                    username_json = dict(username_json, type='hello')
+                login = protocol.parse_client_message(username_json)
+            except protocol.ProtocolError as e:
+                print(f"客户端 {client_address} 的握手消息不符合协议: {e}")
+                self.metric_handshake_failures.inc(reason='protocol')
                 client_socket.close()
                 return
-            
-            username_json = json.loads(username_data.decode('utf-8'))
-            username = username_json.get('username')
+            username = login.username
+            codec = transport.choose_codec(login.compression) if hello is not None else None
+            # 新版客户端会在昵称消息中声明支持的能力（如 file_dedup），旧版客户端没有该字段
+            capabilities = login.capabilities or []
+            # 断线重连的客户端会带上之前的会话令牌，以及已收到的最后一条消息的序号
+            resume_token = login.resume_token
+            last_seq = login.last_seq
+            requested_room = self._normalize_room_name(login.room) or self.DEFAULT_ROOM
+            if login.server_epoch != self.server_epoch:
+                # 序号来自服务器的上一次运行，不能用于补发
+                last_seq = None
             
             if not username:
+                self.metric_handshake_failures.inc(reason='protocol')
                 client_socket.close()
                 return
+            stats.username = username
                 
             # 检查昵称是否已存在
+            resumed = False
+            stale_socket = None
             with self.clients_lock:
-                if username in self.clients:
-                    # 发送昵称重复错误消息给客户端
-                    error_message = {
-                        'type': 'error',
-                        'content': '该昵称已被使用，请选择其他昵称'
-                    }
-                    self.send_message_to_client(client_socket, error_message)
-                    client_socket.close()
-                    return
+                can_resume = bool(resume_token) and self.sessions.get(resume_token) == username
+                if username in self.clients or username in self.suspended_sessions:
+                    if not can_resume:
+                        # 发送昵称重复错误消息给客户端
+                        error_message = {
+                            'type': 'error',
+                            'content': '该昵称已被使用，请选择其他昵称'
+                        }
+                        self.metric_handshake_failures.inc(reason='nickname')
+                        self.send_message_to_client(client_socket, error_message)
+                        client_socket.close()
+                        return
+                    
+                    # 恢复会话：取消过期计时；若服务器尚未察觉旧连接断开，由新连接接管
+                    suspended = self.suspended_sessions.pop(username, None)
+                    if suspended:
+                        suspended['timer'].cancel()
+                    stale_socket = self.clients.get(username)
+                    resumed = True
+                
+                session_token = resume_token if resumed else secrets.token_urlsafe(24)
+                self.sessions[session_token] = username
+                
+                # 恢复的会话仍在原房间；新会话进入客户端请求的房间（断线重连时回到原来的房间）
+                if resumed and username in self.user_rooms:
+                    room = self.user_rooms[username]
+                else:
+                    room = requested_room
+                    self._add_to_room(username, room)
+                if room != requested_room:
+                    # 序号属于其他房间，不能用于补发
+                    last_seq = None
                     
                 # 添加到客户端列表和IP映射
                 self.clients[username] = client_socket
                 self.user_ips[username] = client_address[0]  # 保存用户IP地址
+                self.client_capabilities[username] = set(capabilities)
                 
-            # 发送连接成功确认消息
-            success_message = {
-                'type': 'connected',
-                'content': '连接成功'
-            }
-            if not self.send_message_to_client(client_socket, success_message):
+                # 连接成功确认和所在房间最近的消息记录（重连的客户端只补发断开期间错过的消息）在加入房间的同时发送，
+                # 之后的实时广播只会排在它们后面，不会插到确认之前或补发的记录中间
+                success_message = {
+                    'type': 'connected',
+                    'content': '连接成功',
+                    'session_token': session_token,
+                    'resumed': resumed,
+                    'server_epoch': self.server_epoch,
+                    'room': room,
+                    'max_message_bytes': self.max_message_bytes,
+                    'timestamp': self._now_ms()
+                }
+                if hello is not None:
+                    success_message['compression'] = codec
+                    # 之后的消息都可以压缩（connected 消息本身不压缩）
+                    connection.codec = codec
+                data = (transport.Frame.from_message(success_message).get() +
+                        self._history_frames(room, connection.codec, last_seq))
+                sent = self._send_encoded(client_socket, data, 'connected')
+                if not sent:
+                    del self.clients[username]
+                    self.user_ips.pop(username, None)
+                    self.client_capabilities.pop(username, None)
+                    self.sessions.pop(session_token, None)
+                    self._remove_from_room(username)
+            
+            if stale_socket is not None:
+                try:
+                    stale_socket.shutdown(socket.SHUT_RDWR)
+                    stale_socket.close()
+                except Exception:
+                    pass
+            
+            if not sent:
                 print(f"发送连接成功消息失败，关闭连接")
-                with self.clients_lock:
-                    if username in self.clients:
-                        del self.clients[username]
-                    if username in self.user_ips:
-                        del self.user_ips[username]
+                self.metric_handshake_failures.inc(reason='send')
                 client_socket.close()
+                if resumed:
+                    # 恢复失败时按正常离开处理，避免昵称一直被占用
+                    self.broadcast_system_message(f"{username} 离开了聊天室", room)
+                    self.send_user_list(room=room)
                 return
             
-            print(f"客户端 {username} 连接成功确认消息已发送")
+            self._log_debug(f"客户端 {username} 连接成功确认消息已发送")
+            self.metric_handshake_seconds.observe(time.perf_counter() - accepted_at)
             
-            # 广播新用户加入消息
-            self.broadcast_system_message(f"{username} 加入了聊天室")
-            
-            # 发送当前在线用户列表
-            self.send_user_list()
+            if resumed:
+                # 会话恢复：其他用户看到的在线状态没有变化，不再广播加入消息，只给该用户发送用户列表
+                print(f"用户 {username} 已恢复会话")
+                self.send_user_list(client_socket, room)
+            else:
+                # 向所在房间广播新用户加入消息
+                self.broadcast_system_message(f"{username} 加入了聊天室", room)
+                
+                # 发送当前房间的在线用户列表
+                self.send_user_list(room=room)
             
-            print(f"用户列表已发送给 {username}")
+            self._log_debug(f"用户列表已发送给 {username}")
             
             # 处理客户端消息
             while True:
                 try:
-                    header_data = client_socket.recv(4)
-                    if not header_data:
+                    header = connection.read_header()
+                    if header is None:
                         break
+                    # 从收到消息头开始计时，等待下一条消息的空闲时间不计入
+                    timing = self.stage_timing
+                    if timing:
+                        stage_started = time.perf_counter()
                         
-                    msg_len = struct.unpack('!I', header_data)[0]
-                    data = self.recv_all(client_socket, msg_len)
+                    msg_len, compressed = header
+                    # 大小上限可以随配置重新加载，每条消息读取前更新
+                    connection.max_frame_size = self.max_message_bytes
+                    try:
+                        data = connection.read_body(msg_len)
+                    except transport.FrameTooLarge as e:
+                        # 消息体已用固定大小的缓冲区读出并丢弃，连接继续使用
+                        self._reject_oversized(username, client_socket, 'unknown', e.size, e.limit)
+                        continue
                     
                     if not data:
                         break
+                    if timing:
+                        stage_started = self._stage_done('read', stage_started)
+                    
+                    if compressed:
+                        try:
+                            data = connection.decompress(data)
+                        except ValueError as e:
+                            print(f"用户 {username} 的消息解压失败，断开连接: {e}")
+                            break
                         
-                    message = json.loads(data.decode('utf-8'))
-                    msg_type = message.get('type')
+                    message = json.loads(data)
+                    msg_type = message.get('type') if isinstance(message, dict) else None
+                    if msg_type not in protocol.CLIENT_MESSAGES:
+                        # 未知类型的消息被忽略，统计时也不使用客户端提供的类型名
+                        msg_type = 'unknown'
+                    self.metric_frames_in.inc(type=msg_type)
+                    self.metric_bytes_in.inc(transport.HEADER_SIZE + msg_len, type=msg_type)
+                    stats.frames_in += 1
+                    stats.bytes_in += transport.HEADER_SIZE + msg_len
+                    stats.last_active = time.monotonic()
+                    if len(data) > self.SMALL_MESSAGE_MAX_BYTES and msg_type not in self.LARGE_MESSAGE_TYPES:
+                        self._reject_oversized(username, client_socket, msg_type, len(data), self.SMALL_MESSAGE_MAX_BYTES)
+                        continue
+                    # 只保留协议中定义的字段，字段类型不符或超过长度上限的消息被丢弃
+                    try:
+                        message = protocol.parse_client_message(message)
+                    except protocol.ProtocolError as e:
+                        print(f"用户 {username} 的消息不符合协议，已丢弃: {e}")
+                        continue
+                    if timing:
+                        stage_started = self._stage_done('decode', stage_started)
+                    if message is None:
+                        continue
+                    if self.rate_limit and msg_type in self.RATE_LIMITED_TYPES and \
+                            not self._allow_message(stats, client_socket, msg_type):
+                        continue
                     
-                    if msg_type == 'text':
-                        # 直接广播文本消息
-                        self.broadcast_message(message, username)
-                    elif msg_type == 'file':
-                        self.broadcast_file(message, username)
-                    elif msg_type == 'heartbeat':
-                        # 处理心跳包，发送pong响应
-                        pong_message = {
-                            'type': 'pong',
-                            'content': 'pong',
-                            'timestamp': int(time.time() * 1000)
-                        }
-                        self.send_message_to_client(client_socket, pong_message)
-                        print(f"收到来自 {username} 的心跳包，已回复pong")
-                    elif msg_type == 'disconnect':
-                        # 收到客户端主动断开连接的请求
-                        # 不需要做特别处理，让finally块处理断开逻辑
-                        break
+                    # 移交给新进程期间在这里等待，导出状态后不再分发消息
+                    with self._dispatching(client_message=True):
+                        if msg_type == 'text':
+                            # 直接广播文本消息
+                            self.broadcast_message(message, username)
+                        elif msg_type == 'file':
+                            self.broadcast_file(message, username)
+                        elif msg_type == 'direct':
+                            self.send_direct_message(username, client_socket, message)
+                        elif msg_type == 'room_join':
+                            self._change_room(username, client_socket, message.room)
+                        elif msg_type == 'room_leave':
+                            # 离开当前房间即回到大厅
+                            self._change_room(username, client_socket, self.DEFAULT_ROOM)
+                        elif msg_type == 'file_get':
+                            # 客户端需要显示该文件，按文件ID请求文件内容
+                            self._send_cached_file(client_socket, message.file_id)
+                        elif msg_type == 'heartbeat':
+                            # 处理心跳包，发送pong响应
+                            pong_message = {
+                                'type': 'pong',
+                                'content': 'pong',
+                                'timestamp': self._now_ms()
+                            }
+                            with self.clients_lock:
+                                self.send_message_to_client(client_socket, pong_message)
+                            self._log_debug(f"收到来自 {username} 的心跳包，已回复pong")
+                        elif msg_type == 'pong':
+                            # 客户端对服务器心跳的回复，原样带回心跳的时间戳
+                            if stats.ping_timestamp is not None and message.timestamp == stats.ping_timestamp:
+                                stats.rtt = time.monotonic() - stats.ping_sent_at
+                                stats.ping_timestamp = None
+                        elif msg_type == 'disconnect':
+                            # 收到客户端主动断开连接的请求，不保留会话
+                            # 其余断开逻辑由finally块处理
+                            explicit_disconnect = True
+                            break
+                        if timing:
+                            # 分发阶段包含广播的编码和发送
+                            self._stage_done('dispatch', stage_started)
+                except DispatchRejected:
+                    # 已移交给新进程，这条消息没有被处理，提醒发送者重连后重新发送
+                    with self.clients_lock:
+                        self.send_message_to_client(client_socket, {
+                            'type': 'system',
+                            'content': '⚠️ 服务器正在更新，这条消息未被处理，请在重新连接后重新发送'
+                        })
+                    break
                 except (ConnectionResetError, socket.error, OSError) as e:
                     # 客户端连接异常，正常断开
                     print(f"客户端 {username or client_address} 连接异常断开: {e}")
@@ -352,13 +2018,36 @@ class ChatServer:
             if "远程主机强迫关闭了一个现有的连接" not in error_str and "[WinError 10053]" not in error_str:
                 print(f"处理客户端 {client_address} 错误：{e}")
         finally:
-            # 客户端断开连接
-            if username and username in self.clients:
-                with self.clients_lock:
+            self.connections.pop(client_socket, None)
+            self.connection_stats.pop(client_socket, None)
+            # 客户端断开连接；若该用户已被新连接接管或已被踢出，则不再处理
+            suspended = False
+            owned = False
+            left_room = None
+            with self.clients_lock:
+                # 已移交给新进程时会话由新进程接管，这里不再处理
+                owned = username is not None and self.clients.get(username) is client_socket and not self.handed_off
+                if owned:
+                    capabilities = self.client_capabilities.pop(username, set())
                     del self.clients[username]
-                    if username in self.user_ips:
-                        del self.user_ips[username]
-                
+                    client_ip_address = self.user_ips.pop(username, client_ip)
+                    if session_token and not explicit_disconnect and 'resume' in capabilities and self.running:
+                        # 意外断开：保留昵称一段时间，等待客户端凭令牌恢复，暂不广播离开消息
+                        timer = threading.Timer(self.session_resume_grace, self._expire_session,
+                                                args=(username, session_token))
+                        timer.daemon = True
+                        self.suspended_sessions[username] = {
+                            'token': session_token,
+                            'ip': client_ip_address,
+                            'timer': timer
+                        }
+                        timer.start()
+                        suspended = True
+                    else:
+                        self.sessions.pop(session_token, None)
+                        left_room = self._remove_from_room(username)
+            
+            if owned:
                 # 安全关闭socket
                 try:
                     client_socket.shutdown(socket.SHUT_RDWR)
@@ -370,61 +2059,232 @@ class ChatServer:
                 except Exception:
                     pass
                 
-                self.broadcast_system_message(f"{username} 离开了聊天室")
-                self.send_user_list()
+                if suspended:
+                    print(f"用户 {username} 连接中断，会话保留 {self.session_resume_grace} 秒等待恢复")
+                elif left_room is not None:
+                    self.broadcast_system_message(f"{username} 离开了聊天室", left_room)
+                    self.send_user_list(room=left_room)
+    
+    def _send_encoded(self, client_socket, data, msg_type):
+        """一次发送编码好的多个帧（确认消息和之后补发的消息记录），返回是否成功
+        
+        调用方需持有客户端锁，这些帧和实时广播之间不会交错；统计按第一条消息的类型计入。
+        """
+        try:
+            client_socket.sendall(data)
+        except Exception as e:
+            self.metric_send_failures.inc(type=msg_type)
+            print(f"发送 {msg_type} 失败: {e}")
+            return False
+        self.metric_frames_out.inc(type=msg_type)
+        self.metric_bytes_out.inc(len(data), type=msg_type)
+        stats = self.connection_stats.get(client_socket)
+        if stats is not None:
+            stats.bytes_out += len(data)
+        return True
+    
+    def _history_frames(self, room, codec=None, last_seq=None):
+        """编码要补发的消息，前后用 history / history_end 标记包围；没有可补发的消息时返回空字节串（调用方需持有客户端锁）"""
+        history = self.room_histories.get(room)
+        if history is None:
+            return b''
+        frames, truncated = history.since(last_seq)
+        if not frames:
+            return b''
+        begin = {
+            'type': 'history',
+            'room': room,
+            'count': len(frames),
+            'resumed': last_seq is not None,
+            'truncated': truncated
+        }
+        end = {'type': 'history_end', 'room': room}
+        return (transport.Frame.from_message(begin).get(codec) +
+                b''.join(frame.get(codec) for frame in frames) +
+                transport.Frame.from_message(end).get(codec))
+    
+    def _normalize_room_name(self, room):
+        """校验房间名，无效时返回None"""
+        if not isinstance(room, str):
+            return None
+        room = room.strip().lstrip('#')
+        if not room or len(room) > self.MAX_ROOM_NAME_LENGTH or any(ch.isspace() for ch in room):
+            return None
+        return room
+    
+    def _add_to_room(self, username, room):
+        """把用户加入房间（调用方需持有客户端锁）"""
+        self.rooms.setdefault(room, set()).add(username)
+        self.user_rooms[username] = room
+    
+    def _remove_from_room(self, username):
+        """把用户移出所在房间，返回原房间名；房间空了就删除（调用方需持有客户端锁）"""
+        room = self.user_rooms.pop(username, None)
+        members = self.rooms.get(room)
+        if members is not None:
+            members.discard(username)
+            if not members and room != self.DEFAULT_ROOM:
+                del self.rooms[room]
+                self.room_seqs.pop(room, None)
+                self.room_histories.pop(room, None)
+        return room
+    
+    def _change_room(self, username, client_socket, room_name):
+        """处理用户切换房间的请求"""
+        room = self._normalize_room_name(room_name)
+        if room is None:
+            # 与广播共用锁，避免与广播数据交错写入同一个socket
+            with self.clients_lock:
+                self.send_message_to_client(client_socket, {
+                    'type': 'room_error',
+                    'content': f'房间名无效（不能为空、不能包含空格，最多{self.MAX_ROOM_NAME_LENGTH}个字符）'
+                })
+            return
+        
+        with self.clients_lock:
+            old_room = self.user_rooms.get(username)
+            if old_room == room:
+                return
+            self._remove_from_room(username)
+            self._add_to_room(username, room)
+            # 切换确认和新房间的消息记录一起发送，中间不会插入其他广播
+            codec = self.connections[client_socket].codec
+            data = (transport.Frame.from_message({'type': 'room_joined', 'room': room}).get(codec) +
+                    self._history_frames(room, codec))
+            self._send_encoded(client_socket, data, 'room_joined')
+        
+        print(f"用户 {username} 从房间 {old_room} 进入房间 {room}")
+        if old_room is not None:
+            self.broadcast_system_message(f"{username} 离开了房间", old_room)
+            self.send_user_list(room=old_room)
+        self.broadcast_system_message(f"{username} 进入了房间 #{room}", room)
+        self.send_user_list(room=room)
+    
+    def _expire_session(self, username, session_token):
+        """会话保留时间结束仍未恢复，按离开处理"""
+        with self.clients_lock:
+            suspended = self.suspended_sessions.get(username)
+            if not suspended or suspended['token'] != session_token:
+                return
+            del self.suspended_sessions[username]
+            self.sessions.pop(session_token, None)
+            room = self._remove_from_room(username)
+        print(f"用户 {username} 的会话已过期")
+        self.broadcast_system_message(f"{username} 离开了聊天室", room)
+        self.send_user_list(room=room)
     
     def recv_all(self, sock, n):
-        data = b''
-        while len(data) < n:
-            try:
-                packet = sock.recv(n - len(data))
-                if not packet:
-                    # 连接正常关闭，不需要打印错误信息
-                    return None
-                data += packet
-            except ConnectionResetError:
-                # 连接被客户端重置，这是正常的断开连接情况
-                return None
-            except socket.error as e:
-                # 只在非正常关闭的情况下打印错误信息
-                error_msg = str(e)
-                if "Bad file descriptor" not in error_msg and "[Errno 9]" not in error_msg:
-                    print(f"recv_all: Socket错误 - {e}，已接收 {len(data)}/{n} 字节")
-                return None
-            except Exception as e:
-                print(f"recv_all: 未知错误 - {e}，已接收 {len(data)}/{n} 字节")
-                return None
-        return data
+        """接收恰好 n 字节，连接关闭或出错时返回None（调用方需先检查 n 不超过当前允许的大小上限）"""
+        try:
+            return transport.recv_exact(sock, n)
+        except ConnectionResetError:
+            # 连接被客户端重置，这是正常的断开连接情况
+            return None
+        except socket.error as e:
+            # 只在非正常关闭的情况下打印错误信息
+            error_msg = str(e)
+            if "Bad file descriptor" not in error_msg and "[Errno 9]" not in error_msg:
+                print(f"recv_all: Socket错误 - {e}（需要 {n} 字节）")
+            return None
+        except Exception as e:
+            print(f"recv_all: 未知错误 - {e}（需要 {n} 字节）")
+            return None
     
-    def send_message_to_client(self, client_socket, message):
-        message['timestamp'] = int(time.time() * 1000)  # 转换为毫秒时间戳整数
+    def send_message_to_client(self, client_socket, message, compressible=True):
+        message['timestamp'] = self._now_ms()
         
-        msg_json = json.dumps(message)
-        msg_bytes = msg_json.encode('utf-8')
-        header = struct.pack('!I', len(msg_bytes))
+        frame = transport.Frame.from_message(message, compressible)
         
         try:
-            client_socket.sendall(header + msg_bytes)
-            print(f"消息发送成功: {message.get('type', 'unknown')} - {len(msg_bytes)} bytes")
+            self._send_frame(client_socket, frame)
+            self._log_debug(f"消息发送成功: {message.get('type', 'unknown')} - {len(frame.payload)} bytes")
         except Exception as e:
             print(f"发送消息失败: {e}")
             return False
         return True
             
     def broadcast_message(self, message, sender):
-        message['sender'] = sender
-        message['timestamp'] = int(time.time() * 1000)  # 转换为毫秒时间戳整数
-        
-        msg_json = json.dumps(message)
-        msg_bytes = msg_json.encode('utf-8')
-        header = struct.pack('!I', len(msg_bytes))
+        """广播文字消息（protocol.Text），只发给发送者所在房间的成员"""
+        message = {'type': 'text', 'content': message.content, 'sender': sender}
         
-        with self.clients_lock:
-            for username, client in self.clients.items():
+        with self._broadcast_lock('text'):
+            timing = self.stage_timing
+            if timing:
+                stage_started = time.perf_counter()
+            room = self.user_rooms.get(sender, self.DEFAULT_ROOM)
+            frame = self._encode_broadcast(message, room)
+            recipients = self._room_sockets(room)
+            self.metric_broadcast_fanout.observe(len(recipients), kind='text')
+            if timing:
+                stage_started = self._stage_done('encode', stage_started)
+            for client in recipients:
                 try:
-                    client.sendall(header + msg_bytes)
+                    self._send_frame(client, frame)
                 except:
                     pass
+            if timing:
+                self._stage_done('fanout', stage_started)
+    
+    def _send_frame(self, client_socket, frame):
+        """按该连接协商的压缩算法发送编码好的消息（transport.Frame），并计入发送统计
+        
+        没有登记 Connection 的socket（如被封禁的连接）不压缩。
+        """
+        connection = self.connections.get(client_socket)
+        data = frame.get(connection.codec if connection is not None else None)
+        stats = self.connection_stats.get(client_socket)
+        if stats is not None:
+            stats.send_started = time.monotonic()
+        try:
+            client_socket.sendall(data)
+        except Exception:
+            self.metric_send_failures.inc(type=frame.msg_type)
+            raise
+        finally:
+            if stats is not None:
+                stats.send_started = 0
+        self.metric_frames_out.inc(type=frame.msg_type)
+        self.metric_bytes_out.inc(len(data), type=frame.msg_type)
+        if stats is not None:
+            stats.frames_out += 1
+            stats.bytes_out += len(data)
+    
+    def _room_sockets(self, room):
+        """返回房间中在线成员的socket列表（调用方需持有客户端锁）"""
+        return [self.clients[username] for username in self.rooms.get(room, ()) if username in self.clients]
+    
+    def _now_ms(self):
+        """当前毫秒时间戳，基于单调时钟，不受系统时间调整影响"""
+        return int((time.monotonic() + self._clock_offset) * 1000)
+    
+    def _stamp_message(self, message, room=None):
+        """为聊天消息分配消息ID和时间戳，房间消息还会分配房间内序号（私聊消息不属于任何房间，没有序号）
+        
+        所有聊天消息只在这里盖戳。调用方需持有客户端锁，保证序号顺序与发送顺序一致。
+        """
+        self._seq += 1
+        if room is not None:
+            seq = self.room_seqs.get(room, 0) + 1
+            self.room_seqs[room] = seq
+            message['room'] = room
+            message['seq'] = seq
+        message['id'] = f"{self.server_epoch}-{self._seq}"
+        message['timestamp'] = self._now_ms()
+    
+    def _encode_broadcast(self, message, room):
+        """为要在房间内广播的文字或系统消息盖戳并编码，启用消息记录时同时存入该房间的缓冲区（调用方需持有客户端锁）"""
+        self._stamp_message(message, room)
+        frame = transport.Frame.from_message(message)
+        self._append_history(room, message['seq'], frame)
+        return frame
+    
+    def _append_history(self, room, seq, frame):
+        """启用消息记录时把已盖戳的帧存入房间的缓冲区（调用方需持有客户端锁）"""
+        if self.history_size > 0:
+            history = self.room_histories.get(room)
+            if history is None:
+                history = self.room_histories[room] = MessageHistory(self.history_size, self.history_bytes)
+            history.append(seq, frame)
     
     def _signal_handler(self, signum, frame):
         """信号处理器"""
@@ -457,6 +2317,13 @@ class ChatServer:
                 self.advertise_stop_event.set()
                 self.advertise_thread.join(timeout=2)
             
+            # 停止指标接口，关闭控制套接字
+            self._stop_control_endpoints()
+            
+            # 停止图片预览进程池
+            if self.preview_executor is not None:
+                self.preview_executor.shutdown(wait=False, cancel_futures=True)
+            
             # 向所有客户端发送服务器关闭消息
             try:
                 shutdown_message = {
@@ -486,6 +2353,7 @@ class ChatServer:
                         pass
                 self.clients.clear()
                 self.user_ips.clear()
+                self.client_capabilities.clear()
             
             # 关闭服务器套接字
             try:
@@ -503,195 +2371,368 @@ class ChatServer:
                 os._exit(0)
     
     def broadcast_file(self, message, sender):
+        """广播文件消息（protocol.File），只发给发送者所在房间的成员"""
+        file_data_b64 = message.file_data
+        file_bytes = None
+        if file_data_b64:
+            # 由服务器自行计算内容哈希，避免客户端用错误的哈希污染缓存
+            try:
+                file_bytes = base64.b64decode(file_data_b64)
+                file_hash = hashlib.sha256(file_bytes).hexdigest()
+            except (binascii.Error, ValueError, TypeError) as e:
+                print(f"用户 {sender} 发送的文件数据无法解码，已丢弃: {e}")
+                return
+            self.file_cache.put(file_hash, file_data_b64)
+        else:
+            # 上传者认为服务器已缓存该内容，只发送了哈希
+            file_hash = message.file_hash
+            file_data_b64 = self.file_cache.get(file_hash)
+            if file_data_b64 is None:
+                # 缓存中没有（或已被淘汰），请上传者重新发送完整数据
+                with self.clients_lock:
+                    sender_socket = self.clients.get(sender)
+                    if sender_socket:
+                        self.send_message_to_client(sender_socket, {'type': 'file_want', 'file_hash': file_hash})
+                return
+        
+        # 文件数据单独保存，只在发给旧版客户端的完整消息中带上
+        file_type = message.file_type
+        message = message.to_dict()
+        message.pop('file_data', None)
         message['sender'] = sender
-        message['timestamp'] = int(time.time() * 1000)  # 转换为毫秒时间戳整数
+        message['file_hash'] = file_hash
+        
+        # 支持预览的客户端随通告收到缩略图，原图在点击时再按需获取
+        preview_b64 = None
+        preview_pending = False
+        if self.previews_enabled and file_type == 'images':
+            with self.clients_lock:
+                room = self.user_rooms.get(sender, self.DEFAULT_ROOM)
+                wants_preview = any('file_preview' in self.client_capabilities.get(username, ())
+                                    for username in self.rooms.get(room, ()))
+            if wants_preview:
+                preview_b64 = self.preview_cache.get(file_hash)
+                # base64编码后约为原始大小的4/3，较小的图片不生成预览
+                preview_pending = preview_b64 is None and len(file_data_b64) * 3 // 4 >= self.PREVIEW_MIN_BYTES
+        # 通告立即广播，在房间中的位置与上传顺序一致
+        room = self._broadcast_file_frames(message, sender, file_hash, file_data_b64, preview_b64, preview_pending)
+        if preview_pending:
+            # 预览生成后（或失败、超时后）单独发给支持预览的成员，不阻塞上传者的接收线程
+            self._submit_image_preview(file_hash, file_data_b64, file_bytes,
+                                       lambda preview_b64: self._send_file_preview(room, file_hash, preview_b64))
+    
+    def _broadcast_file_frames(self, message, sender, file_hash, file_data_b64, preview_b64, preview_pending=False):
+        """把文件消息发给发送者所在房间的成员，返回房间名
         
-        msg_json = json.dumps(message)
-        msg_bytes = msg_json.encode('utf-8')
-        header = struct.pack('!I', len(msg_bytes))
+        preview_pending 为True时支持预览的客户端收到标记了 preview_pending 的通告，预览随后由 file_preview 消息送达。
+        """
+        with self._broadcast_lock('file'):
+            timing = self.stage_timing
+            if timing:
+                stage_started = time.perf_counter()
+            # 盖戳后再生成各个版本，各种帧共享同一个序号和消息ID
+            room = self.user_rooms.get(sender, self.DEFAULT_ROOM)
+            self._stamp_message(message, room)
+            # 支持去重的客户端只收到不含文件数据的通告（文件ID即内容哈希），需要显示时再通过 file_get 获取
+            announce = dict(message, type='file_announce', file_id=file_hash)
+            frames = {}
+            
+            def encode(kind):
+                if kind not in frames:
+                    # 带有图片数据（预览图或原图）的帧不压缩，只有通告可以压缩
+                    if kind == 'preview':
+                        frames[kind] = transport.Frame.from_message(dict(announce, preview_data=preview_b64, preview_type='webp'), False)
+                    elif kind == 'pending':
+                        frames[kind] = transport.Frame.from_message(dict(announce, preview_pending=True))
+                    elif kind == 'announce':
+                        frames[kind] = transport.Frame.from_message(announce)
+                    else:
+                        frames[kind] = transport.Frame.from_message(dict(message, file_data=file_data_b64), False)
+                return frames[kind]
+            
+            # 消息记录中保存不含文件数据的通告，补看时按文件ID获取内容，房间序号不会出现空缺
+            self._append_history(room, message['seq'], encode('announce'))
+            self.metric_broadcast_fanout.observe(len(self.rooms.get(room, ())), kind='file')
+            if timing:
+                # 各版本的帧在第一次发送时才编码，计入 fanout
+                stage_started = self._stage_done('encode', stage_started)
+            for username in self.rooms.get(room, ()):
+                client = self.clients.get(username)
+                if client is None:
+                    continue
+                try:
+                    capabilities = self.client_capabilities.get(username, ())
+                    if preview_b64 and 'file_preview' in capabilities:
+                        self._send_frame(client, encode('preview'))
+                    elif preview_pending and 'file_preview' in capabilities:
+                        self._send_frame(client, encode('pending'))
+                    elif 'file_dedup' in capabilities:
+                        self._send_frame(client, encode('announce'))
+                    else:
+                        self._send_frame(client, encode('full'))
+                except:
+                    pass
+        return room
+    
+    def _send_file_preview(self, room, file_hash, preview_b64):
+        """把生成的预览发给房间中支持预览的成员；生成失败或超时时不带预览数据，客户端改为按需获取原图
         
+        file_preview 不分配序号，也不写入消息记录（记录中保存的是不带预览的通告）。
+        """
+        message = {'type': 'file_preview', 'file_id': file_hash}
+        if preview_b64:
+            message.update(preview_data=preview_b64, preview_type='webp')
+        frame = transport.Frame.from_message(message, not preview_b64)
         with self.clients_lock:
-            for username, client in self.clients.items():
+            for username in self.rooms.get(room, ()):
+                client = self.clients.get(username)
+                if client is None or 'file_preview' not in self.client_capabilities.get(username, ()):
+                    continue
                 try:
-                    client.sendall(header + msg_bytes)
+                    self._send_frame(client, frame)
                 except:
                     pass
     
-    def broadcast_system_message(self, message_text):
-        message = {
-            'type': 'system',
-            'content': message_text,
-            'timestamp': int(time.time() * 1000)  # 转换为毫秒时间戳整数
+    def send_direct_message(self, sender, sender_socket, message):
+        """私聊消息（protocol.Direct，文字或文件）：按用户名直接找到接收者的连接，只发给这一个人，并向发送者回复送达状态"""
+        recipient = message.to
+        direct = {
+            'type': 'direct',
+            'sender': sender,
+            'to': recipient
         }
         
-        msg_json = json.dumps(message)
-        msg_bytes = msg_json.encode('utf-8')
-        header = struct.pack('!I', len(msg_bytes))
+        file_data_b64 = None
+        if message.file_type is not None:
+            file_data_b64 = message.file_data
+            if file_data_b64:
+                # 与群发文件相同，由服务器计算内容哈希并放入缓存，接收者可以通过 file_get 获取
+                try:
+                    file_hash = hashlib.sha256(base64.b64decode(file_data_b64)).hexdigest()
+                except (binascii.Error, ValueError, TypeError) as e:
+                    print(f"用户 {sender} 发送的私聊文件数据无法解码，已丢弃: {e}")
+                    return
+                self.file_cache.put(file_hash, file_data_b64)
+            else:
+                file_hash = message.file_hash
+                file_data_b64 = self.file_cache.get(file_hash)
+                if file_data_b64 is None:
+                    # 缓存中没有，请发送者重新上传完整数据
+                    with self.clients_lock:
+                        self.send_message_to_client(sender_socket, {'type': 'file_want', 'file_hash': file_hash})
+                    return
+            for key in ('file_type', 'file_name', 'original_file_name', 'width', 'height'):
+                value = getattr(message, key)
+                if value is not None:
+                    direct[key] = value
+            direct['file_hash'] = file_hash
+        else:
+            if not message.content:
+                return
+            direct['content'] = message.content
+        
+        ack = {
+            'type': 'direct_ack',
+            'to': recipient,
+            'client_msg_id': message.client_msg_id
+        }
+        if 'file_hash' in direct:
+            ack['file_hash'] = direct['file_hash']
         
         with self.clients_lock:
-            for username, client in self.clients.items():
+            self._stamp_message(direct)
+            recipient_socket = self.clients.get(recipient) if recipient != sender else None
+            if recipient_socket is None:
+                # 不在线（包括等待重连的用户）或接收者无效
+                status = 'offline' if recipient != sender else 'invalid'
+            elif 'direct' not in self.client_capabilities.get(recipient, ()):
+                # 旧版客户端无法显示私聊消息
+                status = 'unsupported'
+            else:
+                frame = transport.Frame.from_message(direct)
+                if file_data_b64 is not None:
+                    if 'file_dedup' in self.client_capabilities.get(recipient, ()):
+                        frame = transport.Frame.from_message(dict(direct, file_id=direct['file_hash']))
+                    else:
+                        frame = transport.Frame.from_message(dict(direct, file_data=file_data_b64), False)
                 try:
-                    client.sendall(header + msg_bytes)
-                except:
-                    pass
+                    self._send_frame(recipient_socket, frame)
+                    status = 'delivered'
+                except Exception:
+                    status = 'offline'
+            ack['status'] = status
+            ack['id'] = direct['id']
+            self.send_message_to_client(sender_socket, ack)
+    
+    def _submit_image_preview(self, file_hash, file_data_b64, file_bytes, callback):
+        """在进程池中生成图片预览
+        
+        callback 恰好被调用一次（在新线程中）：参数为预览（base64），生成失败或超时时为None。
+        """
+        with self.preview_executor_lock:
+            if self.preview_executor is None:
+                self.preview_executor = ProcessPoolExecutor(max_workers=self.preview_workers)
+        
+        called = threading.Lock()
+        
+        def finish(preview_b64):
+            # 预览完成和超时只有先到的一方生效
+            if called.acquire(blocking=False):
+                timer.cancel()
+                threading.Thread(target=callback, args=(preview_b64,), daemon=True).start()
+        
+        def on_done(future):
+            self.metric_preview_queue.dec()
+            try:
+                preview = future.result()
+            except Exception as e:
+                print(f"生成图片预览失败: {e}")
+                preview = None
+            if not preview:
+                finish(None)
+                return
+            preview_b64 = base64.b64encode(preview).decode('utf-8')
+            self.preview_cache.put(file_hash, preview_b64)
+            print(f"图片预览已生成: {len(file_bytes)} -> {len(preview)} bytes")
+            finish(preview_b64)
+        
+        try:
+            if file_bytes is None:
+                file_bytes = base64.b64decode(file_data_b64)
+            future = self.preview_executor.submit(_make_image_preview, file_bytes,
+                                                  self.preview_max_side, self.preview_quality)
+        except Exception as e:
+            print(f"生成图片预览失败: {e}")
+            threading.Thread(target=callback, args=(None,), daemon=True).start()
+            return
+        self.metric_preview_queue.inc()
+        timer = threading.Timer(self.PREVIEW_TIMEOUT, finish, args=(None,))
+        timer.daemon = True
+        timer.start()
+        future.add_done_callback(on_done)
+    
+    def _send_cached_file(self, client_socket, file_id):
+        """响应客户端的 file_get 请求，发送缓存中的文件数据"""
+        file_data_b64 = self.file_cache.get(file_id)
+        if file_data_b64 is None:
+            message = {'type': 'file_unavailable', 'file_id': file_id, 'file_hash': file_id}
+        else:
+            message = {'type': 'file_data', 'file_id': file_id, 'file_hash': file_id, 'file_data': file_data_b64}
+        # 与广播共用锁，避免与广播数据交错写入同一个socket；文件数据不压缩
+        with self.clients_lock:
+            self.send_message_to_client(client_socket, message, compressible=file_data_b64 is None)
+    
+    def broadcast_system_message(self, message_text, room=None):
+        """发送系统消息，指定房间时只发给该房间，否则发给所有房间"""
+        with self._broadcast_lock('system'):
+            timing = self.stage_timing
+            rooms = [room] if room is not None else list(self.rooms)
+            for room_name in rooms:
+                if room_name not in self.rooms:
+                    # 房间已经没有成员
+                    continue
+                if timing:
+                    stage_started = time.perf_counter()
+                message = {
+                    'type': 'system',
+                    'content': message_text
+                }
+                frame = self._encode_broadcast(message, room_name)
+                recipients = self._room_sockets(room_name)
+                self.metric_broadcast_fanout.observe(len(recipients), kind='system')
+                if timing:
+                    stage_started = self._stage_done('encode', stage_started)
+                for client in recipients:
+                    try:
+                        self._send_frame(client, frame)
+                    except:
+                        pass
+                if timing:
+                    self._stage_done('fanout', stage_started)
     
     def _send_popup_message_to_ip(self, target_ip, message_content):
-        """向指定IP发送弹窗消息"""
+        """向指定IP发送弹窗消息，返回是否发送给了该IP的所有在线用户"""
         message = {
             'type': 'popup_message',
             'content': message_content,
-            'timestamp': int(time.time() * 1000)
+            'timestamp': self._now_ms()
         }
         
-        msg_json = json.dumps(message)
-        msg_bytes = msg_json.encode('utf-8')
-        header = struct.pack('!I', len(msg_bytes))
+        frame = transport.Frame.from_message(message)
         
         sent = False
+        failed = False
         with self.clients_lock:
             for username, client_socket in self.clients.items():
                 if self.user_ips.get(username) == target_ip:
                     try:
-                        client_socket.sendall(header + msg_bytes)
+                        self._send_frame(client_socket, frame)
                         print(f"✅ 弹窗消息已发送给 {target_ip} (用户: {username}): {message_content}")
                         sent = True
                     except Exception as e:
                         print(f"❌ 发送弹窗消息失败 {target_ip}: {e}")
+                        failed = True
         
-        if not sent:
+        if not sent and not failed:
             print(f"❌ 未找到IP地址为 {target_ip} 的在线用户")
+        return sent and not failed
     
     def _send_popup_announcement(self, announcement_content):
-        """发送弹窗公告给所有用户"""
+        """发送弹窗公告给所有用户，返回是否全部发送成功"""
         message = {
             'type': 'popup_announcement',
             'content': announcement_content,
-            'timestamp': int(time.time() * 1000)
+            'timestamp': self._now_ms()
         }
         
-        msg_json = json.dumps(message)
-        msg_bytes = msg_json.encode('utf-8')
-        header = struct.pack('!I', len(msg_bytes))
+        frame = transport.Frame.from_message(message)
         
         sent_count = 0
+        failed = False
         with self.clients_lock:
             for username, client_socket in self.clients.items():
                 try:
-                    client_socket.sendall(header + msg_bytes)
+                    self._send_frame(client_socket, frame)
                     sent_count += 1
                 except Exception as e:
                     print(f"❌ 发送弹窗公告失败给用户 {username}: {e}")
+                    failed = True
         
         print(f"✅ 弹窗公告已发送给 {sent_count} 个用户: {announcement_content}")
+        return not failed
     
     def _command_input_worker(self):
-        """服务器端命令输入工作线程"""
-        stdin_error_count = 0  # 记录连续错误次数
-        last_stdin_check = time.time()
+        """服务器端命令输入工作线程：逐行读取标准输入并执行
         
+        标准输入关闭（如以守护进程或后台方式运行）后线程结束，之后可以通过控制套接字管理服务器
+        """
         while self.command_running and self.running:
             try:
-                # 在Linux环境下，使用非阻塞输入检查
-                if os.name == 'posix':
-                    import select
-                    import sys
-                    
-                    # 定期检查stdin状态（每10秒）
-                    current_time = time.time()
-                    if current_time - last_stdin_check > 10:
-                        try:
-                            # 尝试刷新stdin缓冲区
-                            sys.stdin.flush()
-                            # 重置错误计数
-                            if stdin_error_count > 0:
-                                print("stdin状态已恢复正常")
-                                stdin_error_count = 0
-                        except:
-                            pass
-                        last_stdin_check = current_time
-                    
-                    try:
-                        # 检查stdin是否可用
-                        if not sys.stdin.closed and sys.stdin.readable():
-                            # 检查是否有输入可用（超时0.5秒）
-                            ready, _, _ = select.select([sys.stdin], [], [], 0.5)
-                            if ready:
-                                try:
-                                    command = input().strip()
-                                    if command:
-                                        self._handle_server_command(command)
-                                        stdin_error_count = 0  # 成功处理命令，重置错误计数
-                                except EOFError:
-                                    # stdin被关闭，尝试重新打开
-                                    stdin_error_count += 1
-                                    print(f"检测到stdin异常（第{stdin_error_count}次），正在尝试恢复...")
-                                    time.sleep(0.5)
-                                    continue
-                            else:
-                                continue  # 没有输入，继续循环
-                        else:
-                            # stdin不可用，等待一段时间后重试
-                            stdin_error_count += 1
-                            if stdin_error_count <= 3:  # 只在前几次错误时打印
-                                print(f"stdin不可用（第{stdin_error_count}次），等待恢复...")
-                            time.sleep(0.5)
-                            continue
-                    except (KeyboardInterrupt):
-                        # 重新抛出这些异常，让外层处理
-                        raise
-                    except Exception as select_error:
-                        # Linux下的select或input错误，记录但继续运行
-                        stdin_error_count += 1
-                        if stdin_error_count <= 3:  # 只在前几次错误时打印详细信息
-                            print(f"Linux输入处理错误（第{stdin_error_count}次）: {select_error}")
-                            print("正在重置输入状态，请重新输入命令...")
-                        
-                        # 尝试刷新stdin缓冲区
-                        try:
-                            sys.stdin.flush()
-                        except:
-                            pass
-                        
-                        # 根据错误次数调整延迟时间
-                        delay = min(0.5 + (stdin_error_count * 0.1), 2.0)
-                        time.sleep(delay)
-                        continue
-                else:
-                    # Windows环境下使用改进的输入处理
-                    try:
-                        command = input().strip()
-                        if command:
-                            self._handle_server_command(command)
-                    except (EOFError, KeyboardInterrupt):
-                        # 重新抛出这些异常，让外层处理
-                        raise
-                    except Exception as input_error:
-                        # Windows下的输入错误，记录但继续运行
-                        print(f"输入处理错误: {input_error}")
-                        print("请重新输入命令...")
-                        continue
-            except (EOFError, KeyboardInterrupt):
-                print("\n收到中断信号，正在关闭服务器...")
-                self.graceful_shutdown()
+                line = sys.stdin.readline()
+            except (OSError, ValueError):
+                break
+            if not line:
                 break
+            command = line.strip()
+            if not command:
+                continue
+            try:
+                self._handle_server_command(command)
             except Exception as e:
-                # 改进异常处理，避免因为单次错误就退出命令循环
-                if self.running and self.command_running:
-                    print(f"命令输入错误: {e}")
-                    print("命令输入线程将继续运行，请重新输入命令...")
-                    # 短暂延迟后继续，避免快速循环
-                    time.sleep(0.1)
-                    continue
-                else:
-                    break
+                print(f"❌ 执行命令出错: {e}")
     
     def _handle_server_command(self, command):
-        """处理服务器端命令"""
+        """处理服务器端命令，返回命令是否执行成功
+        
+        各命令的处理函数在失败时返回 False，返回 None 或 True 都表示成功；
+        控制套接字据此给出每条命令的结果，不依赖输出的文字。
+        """
         parts = command.strip().split()
         if not parts:
-            return
+            return True
             
         cmd = parts[0].lower()
+        ok = True
         
         if cmd == 'help':
             self._show_help()
@@ -699,16 +2740,48 @@ class ChatServer:
             self._show_version()
         elif cmd == 'users':
             self._show_users()
+        elif cmd == 'top':
+            ok = self._show_top(parts[1:])
+        elif cmd == 'kick':
+            if len(parts) >= 2 and parts[1] != '-f':
+                # 用户名中可能有空格
+                ok = self._kick_user(' '.join(parts[1:]))
+            else:
+                usernames = self._read_entries(parts[1:], "kick <用户名> 或 kick -f <文件>")
+                ok = usernames is not None and self._kick_users(usernames)
+        elif cmd == 'stats':
+            self._show_stats()
+        elif cmd == 'reload':
+            ok = self.reload_config()
+        elif cmd == 'rooms':
+            self._show_rooms()
+        elif cmd == 'profile':
+            ok = self._handle_profile_command(parts[1:])
+        elif cmd == 'timing':
+            ok = self._handle_timing_command(parts[1:])
         elif cmd == 'announce':
-            if len(parts) > 1:
+            if len(parts) > 2 and parts[1].startswith('#'):
+                # 只向指定房间发送公告
+                room = self._normalize_room_name(parts[1])
+                announcement = ' '.join(parts[2:])
+                with self.clients_lock:
+                    room_exists = room in self.rooms
+                if not room_exists:
+                    print(f"❌ 房间不存在: {parts[1]}")
+                    ok = False
+                else:
+                    self.broadcast_system_message(f"📢 公告: {announcement}", room)
+                    print(f"✅ 公告已发送到房间 #{room}: {announcement}")
+            elif len(parts) > 1 and not parts[1].startswith('#'):
                 announcement = ' '.join(parts[1:])
                 self.broadcast_system_message(f"📢 公告: {announcement}")
                 print(f"✅ 公告已发送: {announcement}")
             else:
-                print("❌ 用法: announce <消息内容>")
+                print("❌ 用法: announce [#房间] <消息内容>")
+                ok = False
         elif cmd == 'advertise':
             if len(parts) >= 2 and parts[1] == '--stop':
-                self._stop_advertisement()
+                ok = self._stop_advertisement()
             elif len(parts) >= 3:
                 try:
                     interval = int(parts[1])
@@ -716,37 +2789,37 @@ class ChatServer:
                     self._start_advertisement(interval, ad_content)
                 except ValueError:
                     print("❌ 错误: 时间间隔必须是数字")
+                    ok = False
             else:
                 print("❌ 用法: advertise <时间间隔(秒)> <广告内容> 或 advertise --stop")
+                ok = False
         elif cmd == 'ban':
-            if len(parts) >= 2:
-                ip_to_ban = parts[1]
-                self._ban_ip(ip_to_ban)
-            else:
-                print("❌ 用法: ban <IP地址>")
+            entries = self._read_entries(parts[1:], "ban <IP地址或网段>... 或 ban -f <文件>")
+            ok = entries is not None and self._ban_entries(entries)
         elif cmd == 'unban':
-            if len(parts) >= 2:
-                ip_to_unban = parts[1]
-                self._unban_ip(ip_to_unban)
-            else:
-                print("❌ 用法: unban <IP地址>")
+            entries = self._read_entries(parts[1:], "unban <IP地址或网段>... 或 unban -f <文件>")
+            ok = entries is not None and self._unban_entries(entries)
         elif cmd == 'wmassage':
             if len(parts) >= 3:
                 target_ip = parts[1]
                 message_content = ' '.join(parts[2:])
-                self._send_popup_message_to_ip(target_ip, message_content)
+                ok = self._send_popup_message_to_ip(target_ip, message_content)
             else:
                 print("❌ 用法: wmassage <IP地址> <消息内容>")
+                ok = False
         elif cmd == 'wannounce':
             if len(parts) > 1:
                 announcement_content = ' '.join(parts[1:])
-                self._send_popup_announcement(announcement_content)
+                ok = self._send_popup_announcement(announcement_content)
             else:
                 print("❌ 用法: wannounce <公告内容>")
+                ok = False
         elif cmd == 'shutdown':
             self._handle_server_shutdown()
         else:
             print(f"❌ 未知命令: {cmd}。输入 'help' 查看可用命令")
+            ok = False
+        return ok is not False
     
     def _show_help(self):
         """显示帮助信息"""
@@ -754,20 +2827,31 @@ class ChatServer:
         print("  help                    - 显示此帮助信息")
         print("  version                 - 显示服务器版本")
         print("  users                   - 显示当前在线用户")
+        print("  top [排序] [行数]       - 按连接显示收发流量、积压和延迟（排序: out/in/queue/stall/rtt/idle/age）")
+        print("  kick <用户名>           - 断开指定用户（不封禁IP）")
+        print("  kick -f <文件>          - 批量断开文件中列出的用户（每行一个）")
+        print("  rooms                   - 显示所有房间及人数")
+        print("  stats                   - 显示服务器运行指标")
+        print("  reload                  - 重新加载配置文件和黑名单（也可以发送 SIGHUP 信号）")
+        print("  profile start [秒数] [间隔毫秒] - 对所有线程采样，结束后输出火焰图数据")
+        print("  profile stop            - 提前结束采样")
+        print("  timing on|off|show      - 开关/查看消息处理各阶段的耗时")
         print("  announce <消息>         - 发送系统公告")
+        print("  announce #<房间> <消息> - 向指定房间发送系统公告")
         print("  advertise <间隔（秒）> <内容> - 循环发送广告")
         print("  advertise --stop        - 停止当前广告")
         print("  wmassage <IP> <内容>    - 向指定IP发送弹窗消息")
         print("  wannounce <内容>        - 发送弹窗公告给所有用户")
-        print("  ban <IP地址>            - 禁止指定IP地址访问")
-        print("  unban <IP地址>          - 解除指定IP地址的封禁")
+        print("  ban <IP地址或网段>...   - 禁止指定IP地址或网段（如 10.0.0.0/8）访问")
+        print("  ban -f <文件>           - 批量禁止文件中列出的地址或网段（每行一个）")
+        print("  unban <IP地址或网段>... - 解除封禁，同样支持 -f <文件>")
         print("  shutdown                - 关闭服务器")
         print()
     
     def _show_version(self):
         """显示版本信息"""
         print(f"\n🔧 服务器版本: {self.SERVER_VERSION}")
-        print(f"支持的客户端版本: {', '.join(self.SUPPORTED_CLIENT_VERSIONS)}\n")
+        print(f"支持的客户端版本: {', '.join(self.supported_client_versions)}\n")
     
     def _show_users(self):
         """显示当前在线用户列表"""
@@ -778,9 +2862,233 @@ class ChatServer:
                 print(f"\n👥 当前在线用户 ({len(self.clients)} 人):")
                 for i, username in enumerate(self.clients.keys(), 1):
                     ip_address = self.user_ips.get(username, '未知')
-                    print(f"  {i}. {username} ({ip_address})")
+                    room = self.user_rooms.get(username, self.DEFAULT_ROOM)
+                    print(f"  {i}. {username} ({ip_address}) #{room}")
                 print()
     
+    TOP_SORT_KEYS = {
+        'out': lambda row: row['bytes_out'],
+        'in': lambda row: row['bytes_in'],
+        'queue': lambda row: row['queue'] or 0,
+        'stall': lambda row: row['stall'],
+        'rtt': lambda row: row['rtt'] if row['rtt'] is not None else -1,
+        'idle': lambda row: row['idle'],
+        'age': lambda row: row['age'],
+    }
+    
+    def _show_top(self, args):
+        """按连接显示收发统计，默认按发送字节数排序，找出拖慢广播的客户端"""
+        sort_key = 'out'
+        limit = 20
+        for arg in args:
+            if arg.isdigit():
+                limit = int(arg)
+            elif arg.lower() in self.TOP_SORT_KEYS:
+                sort_key = arg.lower()
+            else:
+                print(f"❌ 用法: top [{'/'.join(self.TOP_SORT_KEYS)}] [行数]")
+                return False
+        
+        now = time.monotonic()
+        with self.clients_lock:
+            connections = [(username, client_socket, self.connection_stats.get(client_socket))
+                           for username, client_socket in self.clients.items()]
+        rows = []
+        for username, client_socket, stats in connections:
+            if stats is None:
+                continue
+            rows.append({
+                'username': username,
+                'ip': stats.ip,
+                'age': now - stats.connected_at,
+                'idle': now - stats.last_active,
+                'frames_in': stats.frames_in,
+                'bytes_in': stats.bytes_in,
+                'frames_out': stats.frames_out,
+                'bytes_out': stats.bytes_out,
+                'queue': socket_unsent_bytes(client_socket),
+                'stall': now - stats.send_started if stats.send_started else 0,
+                'rtt': stats.rtt,
+            })
+        if not rows:
+            print("\n👥 当前没有在线用户\n")
+            return
+        rows.sort(key=self.TOP_SORT_KEYS[sort_key], reverse=True)
+        
+        def fmt_bytes(n):
+            for unit in ('B', 'K', 'M', 'G'):
+                if n < 1024 or unit == 'G':
+                    return f"{n:.0f}{unit}" if unit == 'B' else f"{n:.1f}{unit}"
+                n /= 1024
+        
+        def fmt_duration(seconds):
+            seconds = int(seconds)
+            if seconds >= 3600:
+                return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+            return f"{seconds // 60}m{seconds % 60:02d}s"
+        
+        print(f"\n📈 连接统计（{len(rows)} 个连接，按 {sort_key} 排序）:")
+        # 表头中的中文字符占两列，宽度相应减少
+        print(f"  {'用户':<14}{'IP':<16}{'在线':>5}{'空闲':>5}{'收/条':>6}{'收':>7}{'发/条':>6}{'发':>7}"
+              f"{'待发':>6}{'阻塞':>6}{'RTT':>8}")
+        for row in rows[:limit]:
+            queue = fmt_bytes(row['queue']) if row['queue'] is not None else '-'
+            stall = f"{row['stall'] * 1000:.0f}ms" if row['stall'] else '-'
+            rtt = f"{row['rtt'] * 1000:.1f}ms" if row['rtt'] is not None else '-'
+            print(f"  {row['username'][:15]:<16}{row['ip']:<16}{fmt_duration(row['age']):>7}{fmt_duration(row['idle']):>7}"
+                  f"{row['frames_in']:>8}{fmt_bytes(row['bytes_in']):>8}{row['frames_out']:>8}{fmt_bytes(row['bytes_out']):>8}"
+                  f"{queue:>8}{stall:>8}{rtt:>8}")
+        if len(rows) > limit:
+            print(f"  ……另有 {len(rows) - limit} 个连接")
+        print("  待发: 内核发送缓冲区中对方尚未确认的字节；阻塞: 当前这次发送已等待的时间；"
+              "RTT: 服务器心跳的往返时间（旧版客户端为 -）")
+        print()
+    
+    def _kick_user(self, username):
+        """断开指定用户的连接（不封禁IP），返回用户是否在线"""
+        return self._kick_users([username])
+    
+    def _kick_users(self, usernames):
+        """断开一批用户的连接（不封禁IP），会话令牌作废，客户端收到通知后不再自动重连；有用户不在线时返回False"""
+        started = time.perf_counter()
+        with self.clients_lock:
+            online = [username for username in dict.fromkeys(usernames) if username in self.clients]
+            left_rooms = self._disconnect_users(online, "您已被管理员移出聊天室")
+        
+        missing = [username for username in usernames if username not in left_rooms]
+        verbose = len(usernames) <= 10
+        if verbose:
+            for username in missing:
+                print(f"❌ 用户不在线: {username}")
+            for username in online:
+                print(f"✅ 已断开用户 {username} 的连接")
+        else:
+            if missing:
+                print(f"⚠️  {len(missing)} 个用户不在线")
+            print(f"✅ 已断开 {len(online)} 个用户的连接")
+        self._announce_departures(left_rooms, "被管理员移出")
+        if not verbose:
+            print(f"⏱️ 用时 {(time.perf_counter() - started) * 1000:.1f}ms")
+        return not missing
+    
+    def _show_rooms(self):
+        """显示所有房间及成员人数"""
+        with self.clients_lock:
+            print(f"\n🏠 当前房间 ({len(self.rooms)} 个):")
+            for room, members in sorted(self.rooms.items(), key=lambda item: -len(item[1])):
+                online = sum(1 for username in members if username in self.clients)
+                print(f"  #{room}: {online} 人在线" + (f"，{len(members) - online} 人等待重连" if len(members) > online else ""))
+            print()
+    
+    def _show_stats(self):
+        """显示运行指标摘要（完整指标见 --metrics-port 的HTTP接口）"""
+        def fmt_bytes(n):
+            for unit in ('B', 'KB', 'MB', 'GB'):
+                if n < 1024 or unit == 'GB':
+                    return f"{n:.1f}{unit}" if unit != 'B' else f"{n}B"
+                n /= 1024
+        
+        def fmt_quantiles(histogram, key):
+            p50 = histogram.quantile(0.5, key)
+            p99 = histogram.quantile(0.99, key)
+            if p50 is None:
+                return "无数据"
+            return f"p50 ≤ {p50 * 1000:g}ms，p99 ≤ {p99 * 1000:g}ms"
+        
+        uptime = int(time.monotonic() - self.started_at)
+        print(f"\n📊 服务器运行指标（已运行 {uptime // 3600}小时{uptime % 3600 // 60}分{uptime % 60}秒）:")
+        print(f"  在线用户: {len(self.clients)}，等待恢复的会话: {len(self.suspended_sessions)}，房间: {len(self.rooms)}")
+        print(f"  连接总数: {self.metric_connections.value()}，握手失败: "
+              + ("，".join(f"{key[0]} {value}" for key, value in self.metric_handshake_failures.items()) or "0"))
+        print(f"  握手耗时: {fmt_quantiles(self.metric_handshake_seconds, ())}")
+        print(f"  收到: {self.metric_frames_in.value()} 条 / {fmt_bytes(self.metric_bytes_in.value())}，"
+              f"发送: {self.metric_frames_out.value()} 条 / {fmt_bytes(self.metric_bytes_out.value())}，"
+              f"发送失败: {self.metric_send_failures.value()}")
+        top_types = sorted(self.metric_bytes_out.items(), key=lambda item: -item[1])[:5]
+        if top_types:
+            print("  发送流量最多的消息类型: " + "，".join(f"{key[0]} {fmt_bytes(value)}" for key, value in top_types))
+        print(f"  等待客户端锁: {fmt_quantiles(self.metric_lock_wait, ())}")
+        for key, _ in self.metric_broadcast_seconds.items():
+            print(f"  广播耗时 [{key[0]}]: {fmt_quantiles(self.metric_broadcast_seconds, key)}")
+        print(f"  文件缓存: {fmt_bytes(self.file_cache.total_bytes)}，等待生成的预览: {self.metric_preview_queue.value()}，"
+              f"黑名单: {len(self.banned_ips)}")
+        if self.metrics_httpd is not None:
+            print(f"  完整指标: http://{self.metrics_host}:{self.metrics_port}/metrics")
+        print()
+    
+    def _handle_profile_command(self, args):
+        """profile start [秒数] [间隔毫秒] / profile stop / profile"""
+        action = args[0].lower() if args else ''
+        if action == 'start':
+            if self.profiler.running:
+                print(f"❌ 采样正在进行中，结果将写入 {self.profiler.output_path}")
+                return False
+            try:
+                duration = float(args[1]) if len(args) > 1 else 30
+                interval_ms = float(args[2]) if len(args) > 2 else 5
+            except ValueError:
+                print("❌ 错误: 秒数和间隔必须是数字")
+                return False
+            if duration <= 0 or interval_ms <= 0:
+                print("❌ 错误: 秒数和间隔必须大于0")
+                return False
+            output_path = os.path.join(self.profiles_dir, time.strftime('profile-%Y%m%d-%H%M%S.folded'))
+            self.profiler.start(duration, interval_ms / 1000, output_path, on_finish=self._profile_finished)
+            print(f"🔬 开始采样 {duration:g} 秒（每 {interval_ms:g}ms 一次），输入 'profile stop' 可提前结束")
+        elif action == 'stop':
+            if not self.profiler.running:
+                print("❌ 当前没有进行中的采样")
+                return False
+            self.profiler.stop()
+        elif not action:
+            if self.profiler.running:
+                print(f"🔬 正在采样，已采集 {self.profiler.samples} 次")
+            else:
+                print("🔬 当前没有进行中的采样")
+        else:
+            print("❌ 用法: profile start [秒数] [间隔毫秒] 或 profile stop")
+            return False
+    
+    def _profile_finished(self, profiler):
+        """采样结束（在采样线程中调用）：输出结果位置和自身耗时最多的函数"""
+        print(f"\n🔬 采样结束，共 {profiler.samples} 次，{len(profiler.stacks)} 种调用栈")
+        print(f"  折叠栈已写入: {profiler.output_path}")
+        print(f"  生成火焰图: flamegraph.pl {os.path.basename(profiler.output_path)} > profile.svg（或拖入 speedscope.app）")
+        top = profiler.top_functions()
+        if top:
+            total = sum(profiler.stacks.values())
+            print("  位于栈顶次数最多的函数（包含阻塞等待）:")
+            for function, count in top:
+                print(f"    {count / total * 100:5.1f}%  {function}")
+        print()
+    
+    def _handle_timing_command(self, args):
+        """timing on / timing off / timing show"""
+        action = args[0].lower() if args else 'show'
+        if action == 'on':
+            self.stage_timing = True
+            print("⏱️ 已开启分阶段计时，输入 'timing show' 查看结果")
+        elif action == 'off':
+            self.stage_timing = False
+            print("⏱️ 已关闭分阶段计时（已收集的数据保留）")
+        elif action == 'show':
+            print(f"\n⏱️ 消息处理各阶段耗时（计时{'开启' if self.stage_timing else '关闭'}）:")
+            has_data = False
+            for stage in ('read', 'decode', 'dispatch', 'encode', 'fanout'):
+                count, mean = self.metric_stage_seconds.summary((stage,))
+                if not count:
+                    continue
+                has_data = True
+                p50 = self.metric_stage_seconds.quantile(0.5, (stage,))
+                p99 = self.metric_stage_seconds.quantile(0.99, (stage,))
+                print(f"  {stage:<9}{count:>9} 次，平均 {mean * 1e6:9.1f}µs，p50 ≤ {p50 * 1e6:g}µs，p99 ≤ {p99 * 1e6:g}µs")
+            if not has_data:
+                print("  暂无数据，使用 'timing on' 开启")
+            print()
+        else:
+            print("❌ 用法: timing on|off|show")
+            return False
+    
     def _start_advertisement(self, interval, content):
         """开始广告循环"""
         # 停止之前的广告
@@ -809,117 +3117,207 @@ class ChatServer:
             print("✅ 广告已停止")
         else:
             print("❌ 当前没有运行中的广告")
+            return False
+    
+    def _read_entries(self, args, usage):
+        """解析批量命令的参数：-f <文件> 从文件读取（每行一项，# 之后为注释），否则使用参数本身"""
+        if args and args[0] == '-f':
+            if len(args) != 2:
+                print(f"❌ 用法: {usage}")
+                return None
+            try:
+                with open(args[1], 'r', encoding='utf-8') as f:
+                    lines = [line.split('#', 1)[0].strip() for line in f]
+            except OSError as e:
+                print(f"❌ 读取文件失败: {e}")
+                return None
+            return [line for line in lines if line]
+        if not args:
+            print(f"❌ 用法: {usage}")
+            return None
+        return args
     
     def _ban_ip(self, ip_address):
-        """禁止指定IP地址"""
-        # 验证IP地址格式
-        import ipaddress
-        try:
-            ipaddress.ip_address(ip_address)
-        except ValueError:
-            print(f"❌ 无效的IP地址格式: {ip_address}")
-            return
+        """禁止指定IP地址或网段"""
+        return self._ban_entries([ip_address])
+    
+    def _ban_entries(self, entries):
+        """一次性禁止一批IP地址或CIDR网段：只写一次黑名单文件，只扫描一次在线用户，每个房间只广播一次离开消息
+        
+        有无效条目或保存黑名单失败时返回False（已在黑名单中的条目不算失败）
+        """
+        started = time.perf_counter()
+        added = []
+        invalid = []
+        existing = 0
+        for entry in entries:
+            try:
+                normalized = self.banned_ips.add(entry)
+            except ValueError:
+                invalid.append(entry)
+                continue
+            if normalized is None:
+                existing += 1
+            else:
+                added.append(normalized)
+        
+        verbose = len(entries) <= 10
+        for entry in invalid[:10]:
+            print(f"❌ 无效的IP地址或网段格式: {entry}")
+        if len(invalid) > 10:
+            print(f"❌ 另有 {len(invalid) - 10} 个无效条目")
+        if not added:
+            if existing:
+                print(f"⚠️  {existing} 个地址或网段已在黑名单中")
+            return not invalid
         
-        # 检查是否为本地回环地址
-        if ip_address in ['127.0.0.1', '::1', 'localhost']:
-            print(f"⚠️  警告: 正在禁止本地回环地址 {ip_address}")
+        if any(ipaddress.ip_network(entry).overlaps(LOOPBACK_NETWORKS[ipaddress.ip_network(entry).version])
+               for entry in added):
+            print("⚠️  警告: 正在禁止本地回环地址")
             print("   这可能会影响本地连接，但服务器命令功能不受影响")
         
-        # 添加到黑名单
-        self.banned_ips.add(ip_address)
-        self._save_banned_ips()  # 保存到文件
-        print(f"✅ IP地址 {ip_address} 已被禁止")
+        save_started = time.perf_counter()
+        saved = self._save_banned_ips()  # 整批只保存一次
+        save_elapsed = time.perf_counter() - save_started
+        self.metric_bans.inc(len(added))
+        if verbose:
+            for entry in added:
+                print(f"✅ {'网段' if '/' in entry else 'IP地址'} {entry} 已被禁止")
+        else:
+            print(f"✅ 已禁止 {len(added)} 个地址或网段" + (f"，{existing} 个已在黑名单中" if existing else ""))
         
-        # 断开该IP的所有现有连接
+        sweep_started = time.perf_counter()
+        targets = self._disconnect_banned(added)
+        sweep_elapsed = time.perf_counter() - sweep_started
+        if verbose:
+            for username in targets:
+                print(f"✅ 已断开用户 {username} 的连接")
+        elif targets:
+            print(f"✅ 已断开 {len(targets)} 个用户的连接")
+        if not verbose:
+            print(f"⏱️ 用时 {(time.perf_counter() - started) * 1000:.1f}ms"
+                  f"（保存黑名单 {save_elapsed * 1000:.1f}ms，断开连接 {sweep_elapsed * 1000:.1f}ms）")
+        return saved and not invalid
+    
+    def _disconnect_banned(self, entries):
+        """断开命中新封禁条目的所有现有连接（包括等待恢复的会话），整批只扫描一次，返回被断开的用户名"""
+        new_bans = BanList(entries)
         with self.clients_lock:
-            users_to_disconnect = []
-            for username, client_info in self.clients.items():
-                if username in self.user_ips and self.user_ips[username] == ip_address:
-                    users_to_disconnect.append(username)
-            
-            for username in users_to_disconnect:
-                try:
-                    client_socket = self.clients[username]
-                    
-                    # 发送被禁止消息
-                    ban_message = {
-                        "type": "banned",
-                        "content": "您的IP地址已被管理员禁止访问",
-                        "timestamp": int(time.time())
-                    }
-                    
-                    try:
-                        self.send_message_to_client(client_socket, ban_message)
-                        # 给客户端一点时间接收消息
-                        time.sleep(0.1)
-                    except Exception as send_error:
-                        print(f"⚠️  向用户 {username} 发送封禁消息失败: {send_error}")
-                    
-                    # 安全关闭连接
-                    try:
-                        client_socket.shutdown(socket.SHUT_RDWR)
-                    except Exception:
-                        pass  # 忽略shutdown错误
-                    
-                    try:
-                        client_socket.close()
-                    except Exception:
-                        pass  # 忽略close错误
-                    
-                    # 从客户端列表中移除
-                    if username in self.clients:
-                        del self.clients[username]
-                    if username in self.user_ips:
-                        del self.user_ips[username]
-                    
-                    print(f"✅ 已断开用户 {username} 的连接 (IP: {ip_address})")
-                except Exception as e:
-                    print(f"❌ 断开用户 {username} 连接时出错: {e}")
-                    # 确保即使出错也要清理用户信息
-                    try:
-                        if username in self.clients:
-                            del self.clients[username]
-                        if username in self.user_ips:
-                            del self.user_ips[username]
-                    except Exception:
-                        pass
-            
-            if users_to_disconnect:
-                # 广播用户离开消息
-                for username in users_to_disconnect:
-                    leave_message = f"👋 {username} 已离开聊天室 (被管理员禁止)"
-                    self.broadcast_system_message(leave_message)
-                
-                # 发送更新的用户列表
-                self.send_user_list()
-                
-                # 在Linux环境下，刷新stdin缓冲区以确保命令输入正常
-                if os.name == 'posix':
-                    try:
-                        import sys
-                        sys.stdin.flush()
-                    except Exception:
-                        pass  # 忽略刷新错误
+            targets = [username for username in self.clients if self.user_ips.get(username) in new_bans]
+            targets += [username for username, suspended in self.suspended_sessions.items()
+                        if suspended['ip'] in new_bans]
+            left_rooms = self._disconnect_users(targets, "您的IP地址已被管理员禁止访问")
+        self.metric_ban_disconnects.inc(len(targets))
+        # 广播需要获取客户端锁，必须在释放锁之后进行
+        self._announce_departures(left_rooms, "被管理员禁止")
+        return targets
     
     def _unban_ip(self, ip_address):
-        """解除指定IP地址的封禁"""
-        # 验证IP地址格式
-        import ipaddress
-        try:
-            ipaddress.ip_address(ip_address)
-        except ValueError:
-            print(f"❌ 无效的IP地址格式: {ip_address}")
-            return
+        """解除指定IP地址或网段的封禁"""
+        return self._unban_entries([ip_address])
+    
+    def _unban_entries(self, entries):
+        """一次性解除一批IP地址或网段的封禁，只写一次黑名单文件；有无效条目、不在黑名单中的条目或保存失败时返回False"""
+        started = time.perf_counter()
+        removed = []
+        missing = []
+        invalid = []
+        for entry in entries:
+            try:
+                normalized = self.banned_ips.discard(entry)
+            except ValueError:
+                invalid.append(entry)
+                continue
+            if normalized is None:
+                missing.append(entry)
+            else:
+                removed.append(normalized)
         
-        # 检查IP是否在黑名单中
-        if ip_address not in self.banned_ips:
-            print(f"❌ IP地址 {ip_address} 不在黑名单中")
-            return
+        verbose = len(entries) <= 10
+        for entry in invalid[:10]:
+            print(f"❌ 无效的IP地址或网段格式: {entry}")
+        if len(invalid) > 10:
+            print(f"❌ 另有 {len(invalid) - 10} 个无效条目")
+        if verbose:
+            for entry in missing:
+                print(f"❌ {entry} 不在黑名单中")
+        elif missing:
+            print(f"⚠️  {len(missing)} 个地址或网段不在黑名单中")
+        if not removed:
+            return False
+        
+        saved = self._save_banned_ips()  # 整批只保存一次
+        if verbose:
+            for entry in removed:
+                print(f"✅ {'网段' if '/' in entry else 'IP地址'} {entry} 已解除封禁")
+        else:
+            print(f"✅ 已解除 {len(removed)} 个地址或网段的封禁")
+            print(f"⏱️ 用时 {(time.perf_counter() - started) * 1000:.1f}ms")
+        return saved and not invalid and not missing
+    
+    def _disconnect_users(self, usernames, notice):
+        """断开一批用户并作废其会话（调用方需持有客户端锁），返回 {用户名: 原来所在的房间}
+        
+        先给所有在线的用户发送通知，整批只等待一次再关闭连接；通知使用 banned 类型，
+        所有版本的客户端收到后都会显示提示并停止自动重连
+        """
+        targets = set(usernames)
+        if not targets:
+            return {}
+        for token in [token for token, username in self.sessions.items() if username in targets]:
+            del self.sessions[token]
+        
+        notice_frame = transport.Frame.from_message({
+            'type': 'banned',
+            'content': notice,
+            'timestamp': int(time.time())
+        })
+        left_rooms = {}
+        sockets = []
+        for username in targets:
+            suspended = self.suspended_sessions.pop(username, None)
+            if suspended:
+                suspended['timer'].cancel()
+            left_rooms[username] = self._remove_from_room(username)
+            self.user_ips.pop(username, None)
+            self.client_capabilities.pop(username, None)
+            client_socket = self.clients.pop(username, None)
+            if client_socket is None:
+                continue
+            try:
+                self._send_frame(client_socket, notice_frame)
+            except Exception as e:
+                print(f"⚠️  向用户 {username} 发送通知失败: {e}")
+            sockets.append(client_socket)
         
-        # 从黑名单中移除
-        self.banned_ips.remove(ip_address)
-        self._save_banned_ips()  # 保存到文件
-        print(f"✅ IP地址 {ip_address} 已解除封禁")
+        if sockets:
+            # 给客户端一点时间接收通知
+            time.sleep(0.1)
+        for client_socket in sockets:
+            try:
+                client_socket.shutdown(socket.SHUT_RDWR)
+            except Exception:
+                pass
+            try:
+                client_socket.close()
+            except Exception:
+                pass
+        return left_rooms
+    
+    def _announce_departures(self, left_rooms, reason):
+        """按房间合并离开消息：每个房间只广播一次系统消息和一次用户列表"""
+        by_room = {}
+        for username, room in left_rooms.items():
+            if room is not None:
+                by_room.setdefault(room, []).append(username)
+        for room, usernames in by_room.items():
+            if len(usernames) == 1:
+                text = f"👋 {usernames[0]} 已离开聊天室 ({reason})"
+            else:
+                names = '、'.join(sorted(usernames)[:10]) + (' 等' if len(usernames) > 10 else '')
+                text = f"👋 {len(usernames)} 位用户已离开聊天室 ({reason}): {names}"
+            self.broadcast_system_message(text, room)
+            self.send_user_list(room=room)
     
     def _advertise_worker(self, interval, content):
         """广告工作线程"""
@@ -954,32 +3352,49 @@ class ChatServer:
         print("\n✅ 服务器已关闭")
         sys.exit(0)
 
-    def send_user_list(self):
-        with self.clients_lock:
-            # 构建包含IP地址的用户信息列表
-            users_with_ip = []
-            for username in self.clients.keys():
-                users_with_ip.append({
-                    'username': username,
-                    'ip': self.user_ips.get(username, '未知')
-                })
-            
-        message = {
-            'type': 'user_list',
-            'users': users_with_ip,
-            'timestamp': int(time.time() * 1000)  # 转换为毫秒时间戳整数
-        }
-        
-        msg_json = json.dumps(message)
-        msg_bytes = msg_json.encode('utf-8')
-        header = struct.pack('!I', len(msg_bytes))
-        
-        with self.clients_lock:
-            for username, client in self.clients.items():
-                try:
-                    client.sendall(header + msg_bytes)
-                except:
-                    pass
+    def send_user_list(self, target_socket=None, room=None):
+        """发送房间的在线用户列表，不指定房间时更新所有房间；指定 target_socket 时只发送给该连接"""
+        with self._broadcast_lock('user_list'):
+            timing = self.stage_timing
+            rooms = [room] if room is not None else list(self.rooms)
+            for room_name in rooms:
+                if timing:
+                    stage_started = time.perf_counter()
+                # 构建包含IP地址的用户信息列表（等待恢复会话的用户仍显示为在线）
+                users_with_ip = []
+                for username in self.rooms.get(room_name, ()):
+                    if username in self.clients:
+                        ip_address = self.user_ips.get(username, '未知')
+                    elif username in self.suspended_sessions:
+                        ip_address = self.suspended_sessions[username]['ip']
+                    else:
+                        continue
+                    users_with_ip.append({
+                        'username': username,
+                        'ip': ip_address
+                    })
+                
+                message = {
+                    'type': 'user_list',
+                    'room': room_name,
+                    'users': users_with_ip,
+                    'timestamp': self._now_ms()
+                }
+                
+                # 用户列表中每个用户都重复 username/ip 键，人数多时压缩效果明显
+                frame = transport.Frame.from_message(message)
+                
+                targets = [target_socket] if target_socket is not None else self._room_sockets(room_name)
+                self.metric_broadcast_fanout.observe(len(targets), kind='user_list')
+                if timing:
+                    stage_started = self._stage_done('encode', stage_started)
+                for client in targets:
+                    try:
+                        self._send_frame(client, frame)
+                    except:
+                        pass
+                if timing:
+                    self._stage_done('fanout', stage_started)
 
 def run_as_daemon():
     """以守护进程模式运行服务器"""
@@ -1011,10 +3426,11 @@ def run_as_daemon():
     # 改变工作目录到根目录
     os.chdir('/')
     
-    # 重定向标准输入输出
-    sys.stdin.close()
-    sys.stdout.close()
-    sys.stderr.close()
+    # 重定向标准输入输出到 /dev/null（直接关闭会让之后的 print 出错），之后通过控制套接字管理服务器
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+    os.close(devnull)
 
 if __name__ == "__main__":
     # 创建命令行参数解析器
@@ -1023,9 +3439,36 @@ if __name__ == "__main__":
     parser.add_argument('--port', type=int, default=7995, help='服务器绑定的端口号 (默认: 7995)')
     parser.add_argument('--daemon', '-d', action='store_true', help='以守护进程模式运行服务器（仅限Linux/Unix）')
     parser.add_argument('--background', '-b', action='store_true', help='在后台运行服务器（跨平台）')
+    parser.add_argument('--file-cache-mb', type=int, default=64, help='最近广播文件的内存缓存上限，单位MB (默认: 64)')
+    parser.add_argument('--file-ttl', type=int, default=1800, help='文件内容在内存缓存中的保留时间，单位秒 (默认: 1800)')
+    parser.add_argument('--previews', action='store_true', help='为图片生成WebP预览图，原图按需发送（需要Pillow）')
+    parser.add_argument('--preview-workers', type=int, default=2, help='生成图片预览的进程数 (默认: 2)')
+    parser.add_argument('--history', type=int, default=0, help='每个房间在内存中保留最近N条文字、系统消息和文件通告，新加入或重连的用户可以补看 (默认: 0，不保留)')
+    parser.add_argument('--history-mb', type=int, default=1, help='每个房间的最近消息记录占用内存的上限，单位MB (默认: 1)')
+    parser.add_argument('--certfile', type=str, default=None, help='TLS证书文件（PEM格式），指定后所有连接都使用TLS')
+    parser.add_argument('--keyfile', type=str, default=None, help='TLS私钥文件（PEM格式），私钥与证书在同一文件中时可省略')
+    parser.add_argument('--metrics-port', type=int, default=None, help='以 Prometheus 格式提供运行指标的HTTP端口 (默认: 不启用)')
+    parser.add_argument('--metrics-host', type=str, default='127.0.0.1', help='指标接口绑定的地址 (默认: 127.0.0.1，只允许本机访问)')
+    parser.add_argument('--control-socket', type=str, default=DEFAULT_CONTROL_SOCKET,
+                        help='接受管理命令的Unix域套接字路径，配合 admin_ctl.py 使用 (默认: 服务器目录下的 control.sock)')
+    parser.add_argument('--no-control-socket', action='store_true', help='不启用控制套接字')
+    parser.add_argument('--takeover', type=str, nargs='?', const=DEFAULT_CONTROL_SOCKET, default=None,
+                        help='零停机重启：通过正在运行的服务器的控制套接字接管其监听端口和在线会话，'
+                             '旧进程随后退出，客户端自动重连并恢复会话 (默认: 服务器目录下的 control.sock，仅限Linux/Unix)')
+    parser.add_argument('--config', type=str, default=DEFAULT_CONFIG_FILE,
+                        help='配置文件路径，其中的设置优先于内置默认值，但不覆盖命令行中明确给出的参数，'
+                             '可通过 reload 命令或 SIGHUP 重新加载 '
+                             '(默认: 服务器目录下的 server_config.json，不存在时不使用)')
     
     # 解析命令行参数
     args = parser.parse_args()
+    if args.keyfile and not args.certfile:
+        parser.error('--keyfile 需要与 --certfile 一起使用')
+    # 守护进程模式会切换工作目录，相对路径需要先解析
+    args.control_socket = os.path.abspath(args.control_socket)
+    args.config = os.path.abspath(args.config)
+    if args.takeover:
+        args.takeover = os.path.abspath(args.takeover)
     
     # 检查是否以守护进程模式运行
     if args.daemon:
@@ -1036,7 +3479,14 @@ if __name__ == "__main__":
         run_as_daemon()
     
     # 启动服务器，使用解析的主机和端口
-    server = ChatServer(host=args.host, port=args.port)
+    server = ChatServer(host=args.host, port=args.port, file_cache_mb=args.file_cache_mb, file_ttl=args.file_ttl,
+                        enable_previews=args.previews, preview_workers=args.preview_workers,
+                        history_size=args.history, history_mb=args.history_mb,
+                        certfile=args.certfile, keyfile=args.keyfile,
+                        metrics_host=args.metrics_host, metrics_port=args.metrics_port,
+                        control_socket=None if args.no_control_socket else args.control_socket,
+                        config_file=args.config, takeover=args.takeover,
+                        cli_options=explicit_cli_options(parser))
     
     if args.background:
         print(f"服务器正在后台运行，监听 {args.host}:{args.port}")
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""服务器IP黑名单（BanList）和黑名单文件读写的测试"""
+import os
+import sys
+import json
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'server'))
+from server import BanList, ChatServer
+
+
+class BanListTest(unittest.TestCase):
+
+    def test_single_addresses(self):
+        bans = BanList(['10.0.0.8', '2001:db8::1'])
+        self.assertIn('10.0.0.8', bans)
+        self.assertIn('2001:db8::1', bans)
+        self.assertNotIn('10.0.0.9', bans)
+        self.assertNotIn('2001:db8::2', bans)
+
+    def test_ipv4_network(self):
+        bans = BanList(['192.168.0.0/16'])
+        self.assertIn('192.168.0.1', bans)
+        self.assertIn('192.168.255.255', bans)
+        self.assertNotIn('192.169.0.1', bans)
+        self.assertNotIn('10.0.0.1', bans)
+
+    def test_ipv6_network(self):
+        bans = BanList(['2001:db8::/32'])
+        self.assertIn('2001:db8:ffff::1', bans)
+        self.assertNotIn('2001:db9::1', bans)
+        # 不同IP版本的地址不会匹配
+        self.assertNotIn('32.1.13.184', bans)
+
+    def test_networks_of_different_lengths(self):
+        bans = BanList(['10.0.0.0/8', '172.16.5.0/24', '0.0.0.0/0'])
+        self.assertIn('8.8.8.8', bans)  # 0.0.0.0/0 匹配所有IPv4地址
+        self.assertNotIn('::1', bans)
+        bans.discard('0.0.0.0/0')
+        self.assertIn('10.20.30.40', bans)
+        self.assertIn('172.16.5.9', bans)
+        self.assertNotIn('172.16.6.9', bans)
+
+    def test_normalize(self):
+        self.assertEqual(BanList.normalize(' 10.1.2.3 '), '10.1.2.3')
+        # 主机位不为0的网段按网络地址保存
+        self.assertEqual(BanList.normalize('10.1.2.3/8'), '10.0.0.0/8')
+        # 前缀长度等于地址长度的网段就是单个地址
+        self.assertEqual(BanList.normalize('10.1.2.3/32'), '10.1.2.3')
+        self.assertEqual(BanList.normalize('2001:DB8::1/128'), '2001:db8::1')
+        self.assertEqual(BanList.normalize('2001:db8::1/64'), '2001:db8::/64')
+
+    def test_add_returns_normalized_entry_or_none(self):
+        bans = BanList()
+        self.assertEqual(bans.add('10.1.2.3/8'), '10.0.0.0/8')
+        self.assertIsNone(bans.add('10.0.0.0/8'))
+        self.assertEqual(bans.add('10.0.0.1/32'), '10.0.0.1')
+        self.assertIsNone(bans.add('10.0.0.1'))
+        self.assertEqual(len(bans), 2)
+
+    def test_discard(self):
+        bans = BanList(['10.0.0.0/8', '10.0.0.1'])
+        self.assertEqual(bans.discard('10.0.0.0/8'), '10.0.0.0/8')
+        self.assertIsNone(bans.discard('10.0.0.0/8'))
+        self.assertNotIn('10.9.9.9', bans)
+        self.assertIn('10.0.0.1', bans)
+        self.assertEqual(bans.discard('10.0.0.1'), '10.0.0.1')
+        self.assertIsNone(bans.discard('10.0.0.1'))
+        self.assertEqual(len(bans), 0)
+        self.assertEqual(bans.networks, {})
+
+    def test_invalid_entries(self):
+        bans = BanList()
+        for entry in ('not-an-ip', '10.0.0.256', '10.0.0.0/33', '2001:db8::/129', ''):
+            with self.assertRaises(ValueError, msg=entry):
+                bans.add(entry)
+            with self.assertRaises(ValueError, msg=entry):
+                bans.discard(entry)
+        self.assertEqual(len(bans), 0)
+
+    def test_lookup_of_invalid_address(self):
+        bans = BanList(['10.0.0.0/8'])
+        self.assertNotIn('not-an-ip', bans)
+        self.assertNotIn('', bans)
+
+    def test_iteration_order(self):
+        bans = BanList(['2001:db8::/32', '10.0.0.2', '10.0.0.0/8', '10.0.0.1', '192.168.0.0/16'])
+        self.assertEqual(list(bans), ['10.0.0.1', '10.0.0.2', '10.0.0.0/8', '192.168.0.0/16', '2001:db8::/32'])
+
+
+class BanListFileTest(unittest.TestCase):
+    """黑名单文件的保存和读取（不启动服务器，只使用相关的方法）"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.server = ChatServer.__new__(ChatServer)
+        self.server.banned_ips_file = os.path.join(self.directory.name, 'banned_ips.json')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_save_and_read(self):
+        self.server.banned_ips = BanList(['10.0.0.1', '10.0.0.0/8', '2001:db8::/32'])
+        self.assertTrue(self.server._save_banned_ips())
+        with open(self.server.banned_ips_file, encoding='utf-8') as f:
+            self.assertEqual(json.load(f), ['10.0.0.1', '10.0.0.0/8', '2001:db8::/32'])
+        banned_ips, invalid = self.server._read_banned_ips()
+        self.assertEqual(invalid, 0)
+        self.assertEqual(list(banned_ips), list(self.server.banned_ips))
+        self.assertIn('10.200.0.1', banned_ips)
+
+    def test_read_skips_invalid_entries(self):
+        with open(self.server.banned_ips_file, 'w', encoding='utf-8') as f:
+            json.dump(['10.0.0.1', 'bogus', 42, '192.168.0.0/16'], f)
+        banned_ips, invalid = self.server._read_banned_ips()
+        self.assertEqual(invalid, 2)
+        self.assertEqual(list(banned_ips), ['10.0.0.1', '192.168.0.0/16'])
+
+    def test_save_failure(self):
+        self.server.banned_ips = BanList(['10.0.0.1'])
+        self.server.banned_ips_file = os.path.join(self.directory.name, 'missing', 'banned_ips.json')
+        self.assertFalse(self.server._save_banned_ips())
+
+
+if __name__ == '__main__':
+    unittest.main()
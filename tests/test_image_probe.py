@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""客户端图片预检（client/image_probe.py）的测试"""
+import os
+import sys
+import struct
+import hashlib
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'client'))
+import image_probe
+from image_probe import ImageProbeError, image_extension, prepare_image, probe_image
+
+
+def make_png(width, height):
+    return b'\x89PNG\r\n\x1a\n' + struct.pack('>I', 13) + b'IHDR' + struct.pack('>II', width, height) + b'\x08\x02\x00\x00\x00'
+
+
+def make_gif(width, height):
+    return b'GIF89a' + struct.pack('<HH', width, height) + b'\x00\x00\x00'
+
+
+def make_bmp(width, height, header_size=40):
+    header = b'BM' + b'\x00' * 12 + struct.pack('<I', header_size)
+    if header_size == 12:
+        return header + struct.pack('<HH', width, height) + b'\x00' * 4
+    return header + struct.pack('<ii', width, height) + b'\x00' * 28
+
+
+def make_jpeg(width, height):
+    # SOI、一个APP0段、一个填充字节，然后是SOF0帧头
+    app0 = b'\xff\xe0' + struct.pack('>H', 16) + b'JFIF\x00' + b'\x00' * 9
+    sof0 = b'\xff\xc0' + struct.pack('>HBHH', 17, 8, height, width) + b'\x03' + b'\x00' * 9
+    return b'\xff\xd8' + app0 + b'\xff' + sof0
+
+
+def make_webp(chunk, width, height):
+    header = b'RIFF' + b'\x00' * 4 + b'WEBP' + chunk
+    if chunk == b'VP8 ':
+        return header + b'\x00' * 10 + struct.pack('<HH', width, height)
+    if chunk == b'VP8L':
+        bits = (width - 1) | ((height - 1) << 14)
+        return header + b'\x00' * 5 + struct.pack('<I', bits)
+    return header + b'\x00' * 8 + (width - 1).to_bytes(3, 'little') + (height - 1).to_bytes(3, 'little')
+
+
+class ProbeImageTest(unittest.TestCase):
+
+    def test_png(self):
+        self.assertEqual(probe_image(make_png(640, 480)), ('PNG', 640, 480))
+
+    def test_gif(self):
+        self.assertEqual(probe_image(make_gif(32, 16)), ('GIF', 32, 16))
+        self.assertEqual(probe_image(b'GIF87a' + make_gif(1, 2)[6:]), ('GIF', 1, 2))
+
+    def test_bmp(self):
+        self.assertEqual(probe_image(make_bmp(100, 50)), ('BMP', 100, 50))
+        # 高度为负数表示自上而下存储
+        self.assertEqual(probe_image(make_bmp(100, -50)), ('BMP', 100, 50))
+        self.assertEqual(probe_image(make_bmp(7, 9, header_size=12)), ('BMP', 7, 9))
+
+    def test_jpeg(self):
+        self.assertEqual(probe_image(make_jpeg(1920, 1080)), ('JPEG', 1920, 1080))
+
+    def test_webp(self):
+        for chunk in (b'VP8 ', b'VP8L', b'VP8X'):
+            self.assertEqual(probe_image(make_webp(chunk, 300, 200)), ('WEBP', 300, 200), chunk)
+
+    def test_unknown_header(self):
+        for data in (b'', b'MZ\x90\x00', b'<html>', b'RIFF\x00\x00\x00\x00WAVE'):
+            with self.assertRaises(ImageProbeError, msg=repr(data)):
+                probe_image(data)
+
+    def test_truncated_header(self):
+        for data in (make_png(1, 1)[:20], make_gif(1, 1)[:8], make_bmp(1, 1)[:20], b'\xff\xd8\xff'):
+            with self.assertRaises(ImageProbeError, msg=repr(data)):
+                probe_image(data)
+
+    def test_png_without_ihdr(self):
+        data = bytearray(make_png(1, 1))
+        data[12:16] = b'IDAT'
+        with self.assertRaises(ImageProbeError):
+            probe_image(bytes(data))
+
+    def test_jpeg_bad_marker(self):
+        with self.assertRaises(ImageProbeError):
+            probe_image(b'\xff\xd8\xff\xe0' + b'\x00' * 2 + b'\x12' * 20)
+
+    def test_zero_size(self):
+        with self.assertRaises(ImageProbeError):
+            probe_image(make_png(0, 10))
+
+    def test_image_extension(self):
+        self.assertEqual(image_extension(make_png(1, 1)), '.png')
+        self.assertEqual(image_extension(make_jpeg(1, 1)), '.jpg')
+        self.assertEqual(image_extension(make_webp(b'VP8X', 1, 1)), '.webp')
+        # 图片后面附加的其他内容不影响识别，扩展名只取决于文件头
+        self.assertEqual(image_extension(make_gif(1, 1) + b'<script>'), '.gif')
+        for ext in image_probe.FORMAT_EXTENSIONS.values():
+            self.assertIn(ext, image_probe.VALID_EXTENSIONS)
+        with self.assertRaises(ImageProbeError):
+            image_extension(b'@echo off')
+
+
+class PrepareImageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, name, data):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_prepare(self):
+        data = make_png(64, 32)
+        prepared = prepare_image(self.write('Photo.PNG', data))
+        self.assertEqual(prepared['data'], data)
+        self.assertEqual((prepared['format'], prepared['width'], prepared['height']), ('PNG', 64, 32))
+        self.assertEqual(prepared['file_hash'], hashlib.sha256(data).hexdigest())
+        self.assertEqual(prepared['original_file_name'], 'Photo.PNG')
+        self.assertEqual(prepared['file_ext'], '.png')
+
+    def test_invalid_extension(self):
+        with self.assertRaises(ImageProbeError):
+            prepare_image(self.write('image.exe', make_png(1, 1)))
+
+    def test_content_is_not_an_image(self):
+        with self.assertRaises(ImageProbeError):
+            prepare_image(self.write('image.png', b'not an image'))
+
+    def test_too_large(self):
+        path = self.write('big.png', make_png(1, 1))
+        with open(path, 'r+b') as f:
+            f.truncate(image_probe.MAX_IMAGE_BYTES + 1)
+        with self.assertRaises(ImageProbeError):
+            prepare_image(path)
+
+    def test_dimensions_too_large(self):
+        with self.assertRaises(ImageProbeError):
+            prepare_image(self.write('wide.png', make_png(image_probe.MAX_IMAGE_DIMENSION + 1, 1)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""服务器最近消息记录（MessageHistory）的测试"""
+import os
+import sys
+import json
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'server'))
+from server import MessageHistory
+from common import transport
+
+
+def make_frame(seq, size=0):
+    return transport.Frame.from_message({'type': 'text', 'seq': seq, 'content': 'x' * size})
+
+
+def seqs(frames):
+    return [json.loads(frame.payload)['seq'] for frame in frames]
+
+
+class MessageHistoryTest(unittest.TestCase):
+
+    def test_since_without_last_seq_returns_everything(self):
+        history = MessageHistory(10)
+        for seq in range(1, 4):
+            history.append(seq, make_frame(seq))
+        frames, truncated = history.since()
+        self.assertEqual(seqs(frames), [1, 2, 3])
+        self.assertFalse(truncated)
+
+    def test_since_last_seq(self):
+        history = MessageHistory(10)
+        for seq in range(1, 6):
+            history.append(seq, make_frame(seq))
+        frames, truncated = history.since(3)
+        self.assertEqual(seqs(frames), [4, 5])
+        self.assertFalse(truncated)
+        self.assertEqual(history.since(5), ([], False))
+
+    def test_empty(self):
+        self.assertEqual(MessageHistory().since(), ([], False))
+        self.assertEqual(MessageHistory().since(7), ([], False))
+
+    def test_count_eviction(self):
+        history = MessageHistory(max_count=3)
+        for seq in range(1, 6):
+            history.append(seq, make_frame(seq))
+        frames, truncated = history.since()
+        self.assertEqual(seqs(frames), [3, 4, 5])
+        # 不指定 last_seq 时是新加入的客户端，不算丢失
+        self.assertFalse(truncated)
+
+    def test_byte_eviction(self):
+        frame_size = len(make_frame(1, 100))
+        history = MessageHistory(max_count=100, max_bytes=frame_size * 2)
+        for seq in range(1, 5):
+            history.append(seq, make_frame(seq, 100))
+        self.assertEqual(seqs(history.since()[0]), [3, 4])
+
+    def test_oversized_frame_is_not_kept(self):
+        history = MessageHistory(max_count=100, max_bytes=50)
+        history.append(1, make_frame(1, 100))
+        self.assertEqual(history.since(), ([], False))
+        self.assertEqual(history.since(0), ([], True))
+
+    def test_truncated_when_missed_messages_were_evicted(self):
+        history = MessageHistory(max_count=2)
+        for seq in range(1, 6):
+            history.append(seq, make_frame(seq))
+        # 最早保留的是4，客户端收到的最后一条是2，3已被淘汰
+        frames, truncated = history.since(2)
+        self.assertEqual(seqs(frames), [4, 5])
+        self.assertTrue(truncated)
+        # 客户端收到过3，没有遗漏
+        frames, truncated = history.since(3)
+        self.assertEqual(seqs(frames), [4, 5])
+        self.assertFalse(truncated)
+
+    def test_shrinking_limits_applies_on_next_append(self):
+        history = MessageHistory(max_count=10)
+        for seq in range(1, 6):
+            history.append(seq, make_frame(seq))
+        history.max_count = 2
+        history.append(6, make_frame(6))
+        self.assertEqual(seqs(history.since()[0]), [5, 6])
+
+    def test_export_and_restore(self):
+        history = MessageHistory(max_count=3)
+        for seq in range(1, 6):
+            history.append(seq, make_frame(seq, 10))
+        state = json.loads(json.dumps(history.export()))
+        restored = MessageHistory(max_count=3)
+        restored.restore(state)
+        frames, truncated = restored.since(1)
+        self.assertEqual(seqs(frames), [3, 4, 5])
+        self.assertTrue(truncated)
+        self.assertEqual([frame.payload for frame in frames], [frame.payload for frame in history.since(1)[0]])
+        self.assertEqual(frames[0].msg_type, 'text')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""客户端消息解析（common.protocol.parse_client_message）的测试"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import protocol
+from common.protocol import ProtocolError, parse_client_message
+
+
+class ParseValidMessagesTest(unittest.TestCase):
+
+    def test_text(self):
+        message = parse_client_message({'type': 'text', 'content': '你好'})
+        self.assertIsInstance(message, protocol.Text)
+        self.assertEqual(message.content, '你好')
+        self.assertEqual(message.to_dict(), {'type': 'text', 'content': '你好'})
+
+    def test_file_with_optional_fields(self):
+        message = parse_client_message({'type': 'file', 'file_type': 'images', 'file_name': 'a.png',
+                                        'file_hash': 'abc', 'width': 640, 'height': 480})
+        self.assertIsInstance(message, protocol.File)
+        self.assertEqual((message.width, message.height), (640, 480))
+        self.assertIsNone(message.file_data)
+        # 省略的可选字段不会出现在转发的字典中
+        self.assertEqual(message.to_dict(), {'type': 'file', 'file_type': 'images', 'file_name': 'a.png',
+                                             'file_hash': 'abc', 'width': 640, 'height': 480})
+
+    def test_direct(self):
+        message = parse_client_message({'type': 'direct', 'to': 'bob', 'content': 'hi', 'client_msg_id': '7'})
+        self.assertIsInstance(message, protocol.Direct)
+        self.assertEqual((message.to, message.content, message.client_msg_id), ('bob', 'hi', '7'))
+
+    def test_messages_without_fields(self):
+        for msg_type, cls in (('room_leave', protocol.RoomLeave), ('heartbeat', protocol.Heartbeat),
+                              ('pong', protocol.Pong), ('disconnect', protocol.Disconnect)):
+            message = parse_client_message({'type': msg_type})
+            self.assertIsInstance(message, cls)
+            self.assertEqual(message.to_dict(), {'type': msg_type})
+
+    def test_room_and_file_get(self):
+        self.assertEqual(parse_client_message({'type': 'room_join', 'room': 'dev'}).room, 'dev')
+        self.assertEqual(parse_client_message({'type': 'file_get', 'file_id': 'f1'}).file_id, 'f1')
+        self.assertEqual(parse_client_message({'type': 'hello', 'username': 'bob', 'capabilities': []}).capabilities, [])
+
+    def test_hello(self):
+        message = parse_client_message({'type': 'hello', 'version': 'djEuMC4y', 'username': 'alice',
+                                        'compression': ['zlib'], 'capabilities': ['file_dedup', 'resume'],
+                                        'resume_token': 't', 'last_seq': 12, 'server_epoch': 'e1', 'room': 'dev'})
+        self.assertIsInstance(message, protocol.Hello)
+        self.assertEqual((message.username, message.capabilities, message.last_seq), ('alice', ['file_dedup', 'resume'], 12))
+        # 旧版客户端的昵称消息只有昵称
+        self.assertEqual(parse_client_message({'type': 'hello', 'username': 'bob'}).to_dict(),
+                         {'type': 'hello', 'username': 'bob'})
+
+    def test_pong_timestamp(self):
+        message = parse_client_message({'type': 'pong', 'timestamp': 1700000000000})
+        self.assertEqual(message.timestamp, 1700000000000)
+
+    def test_null_optional_field_is_omitted(self):
+        message = parse_client_message({'type': 'disconnect', 'username': None})
+        self.assertIsNone(message.username)
+
+    def test_limits_are_inclusive(self):
+        text = 'a' * protocol.MAX_TEXT_LENGTH
+        self.assertEqual(parse_client_message({'type': 'text', 'content': text}).content, text)
+        message = parse_client_message({'type': 'file', 'file_type': 'images',
+                                        'width': protocol.MAX_DIMENSION, 'height': 0})
+        self.assertEqual((message.width, message.height), (protocol.MAX_DIMENSION, 0))
+
+    def test_every_registered_type_has_a_class(self):
+        self.assertEqual(set(protocol.CLIENT_MESSAGES),
+                         {'hello', 'text', 'file', 'direct', 'room_join', 'room_leave', 'file_get',
+                          'heartbeat', 'pong', 'disconnect'})
+        for name, cls in protocol.CLIENT_MESSAGES.items():
+            self.assertEqual(cls.TYPE, name)
+
+
+class ParseUnknownInputTest(unittest.TestCase):
+
+    def test_unknown_type_returns_none(self):
+        self.assertIsNone(parse_client_message({'type': 'no_such_type', 'content': 'x'}))
+        self.assertIsNone(parse_client_message({'content': 'x'}))
+        self.assertIsNone(parse_client_message({'type': 5}))
+
+    def test_unknown_fields_are_dropped(self):
+        message = parse_client_message({'type': 'text', 'content': 'hi', 'sender': 'admin', 'seq': 1})
+        self.assertEqual(message.to_dict(), {'type': 'text', 'content': 'hi'})
+        self.assertFalse(hasattr(message, 'sender'))
+
+    def test_non_object(self):
+        for message in (None, [], 'text', 42):
+            with self.assertRaises(ProtocolError, msg=repr(message)):
+                parse_client_message(message)
+
+
+class ParseErrorsTest(unittest.TestCase):
+
+    def assertRejected(self, message):
+        with self.assertRaises(ProtocolError, msg=repr(message)):
+            parse_client_message(message)
+
+    def test_missing_required_field(self):
+        self.assertRejected({'type': 'text'})
+        self.assertRejected({'type': 'text', 'content': None})
+        self.assertRejected({'type': 'file', 'file_name': 'a.png'})
+        self.assertRejected({'type': 'direct', 'content': 'hi'})
+        self.assertRejected({'type': 'room_join'})
+        self.assertRejected({'type': 'file_get'})
+        self.assertRejected({'type': 'hello', 'version': 'djEuMC4y'})
+
+    def test_wrong_type(self):
+        self.assertRejected({'type': 'text', 'content': 42})
+        self.assertRejected({'type': 'text', 'content': ['hi']})
+        self.assertRejected({'type': 'file', 'file_type': 'images', 'width': '640'})
+        self.assertRejected({'type': 'file', 'file_type': 'images', 'width': 640.0})
+        self.assertRejected({'type': 'direct', 'to': {'name': 'bob'}})
+        self.assertRejected({'type': 'hello', 'username': ['alice']})
+        self.assertRejected({'type': 'hello', 'username': 'alice', 'capabilities': 'resume'})
+        self.assertRejected({'type': 'hello', 'username': 'alice', 'last_seq': '3'})
+
+    def test_list_items_must_be_strings(self):
+        self.assertRejected({'type': 'hello', 'username': 'alice', 'capabilities': [['resume']]})
+        self.assertRejected({'type': 'hello', 'username': 'alice', 'compression': [1]})
+        self.assertRejected({'type': 'hello', 'username': 'alice',
+                             'capabilities': ['c' * (protocol.MAX_FIELD_LENGTH + 1)]})
+
+    def test_bool_is_not_an_int(self):
+        self.assertRejected({'type': 'pong', 'timestamp': True})
+        self.assertRejected({'type': 'file', 'file_type': 'images', 'height': False})
+
+    def test_string_too_long(self):
+        self.assertRejected({'type': 'text', 'content': 'a' * (protocol.MAX_TEXT_LENGTH + 1)})
+        self.assertRejected({'type': 'room_join', 'room': 'r' * (protocol.MAX_FIELD_LENGTH + 1)})
+        self.assertRejected({'type': 'direct', 'to': 'u' * (protocol.MAX_FIELD_LENGTH + 1), 'content': 'hi'})
+        self.assertRejected({'type': 'hello', 'username': 'u' * (protocol.MAX_FIELD_LENGTH + 1)})
+        self.assertRejected({'type': 'hello', 'username': 'alice',
+                             'capabilities': ['c'] * (protocol.MAX_LIST_LENGTH + 1)})
+
+    def test_int_out_of_range(self):
+        self.assertRejected({'type': 'file', 'file_type': 'images', 'width': protocol.MAX_DIMENSION + 1})
+        self.assertRejected({'type': 'file', 'file_type': 'images', 'height': -1})
+        self.assertRejected({'type': 'pong', 'timestamp': 2 ** 63})
+        self.assertRejected({'type': 'pong', 'timestamp': -1})
+
+    def test_error_is_a_value_error(self):
+        # 服务器的其他代码按 ValueError 处理格式错误
+        with self.assertRaises(ValueError):
+            parse_client_message({'type': 'text'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""消息帧传输（common.transport）的测试"""
+import os
+import sys
+import json
+import socket
+import zlib
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import transport
+from common.transport import Connection, FrameTooLarge
+
+
+class ConnectionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.local, self.remote = socket.socketpair()
+        self.local.settimeout(5)
+        self.remote.settimeout(5)
+        self.sender = Connection(self.local, 'zlib')
+        self.receiver = Connection(self.remote, 'zlib', max_frame_size=4096)
+
+    def tearDown(self):
+        self.local.close()
+        self.remote.close()
+
+    def test_round_trip(self):
+        self.sender.send_message({'type': 'text', 'content': 'hi'})
+        self.assertEqual(self.receiver.read_message(), {'type': 'text', 'content': 'hi'})
+
+    def test_large_payload_is_compressed(self):
+        message = {'type': 'text', 'content': 'a' * 2000}
+        self.sender.send_message(message)
+        data, compressed = self.receiver.read_frame()
+        self.assertTrue(compressed)
+        self.assertLess(len(data), 2000)
+        self.assertEqual(json.loads(self.receiver.decompress(data)), message)
+
+    def test_small_or_incompressible_payload_is_not_compressed(self):
+        self.sender.send_payload(b'{}')
+        self.assertEqual(self.receiver.read_frame(), (bytearray(b'{}'), False))
+        payload = b'x' * 1000
+        self.sender.send_payload(payload, compressible=False)
+        self.assertEqual(self.receiver.read_frame(), (bytearray(payload), False))
+
+    def test_send_frame_uses_connection_codec(self):
+        frame = transport.Frame.from_message({'type': 'text', 'content': 'b' * 2000})
+        self.assertEqual(self.sender.send_frame(frame), len(frame.get('zlib')))
+        self.assertTrue(self.receiver.read_frame()[1])
+        Connection(self.local).send_frame(frame)
+        self.assertFalse(self.receiver.read_frame()[1])
+
+    def test_frame_too_large_is_discarded(self):
+        self.local.sendall(transport.encode_frame(b'x' * 5000))
+        self.sender.send_message({'type': 'text', 'content': 'next'})
+        with self.assertRaises(FrameTooLarge) as cm:
+            self.receiver.read_frame()
+        self.assertEqual((cm.exception.size, cm.exception.limit), (5000, 4096))
+        # 超大的消息体已被读出，连接可以继续使用
+        self.assertEqual(self.receiver.read_message(), {'type': 'text', 'content': 'next'})
+
+    def test_frame_too_large_without_discard(self):
+        self.local.sendall(transport.encode_frame(b'x' * 5000))
+        with self.assertRaises(FrameTooLarge):
+            self.receiver.read_frame(discard=False)
+        # 消息体没有被读出
+        self.assertEqual(self.remote.recv(1), b'x')
+
+    def test_limit_is_inclusive(self):
+        self.local.sendall(transport.encode_frame(b'y' * 4096))
+        self.assertEqual(len(self.receiver.read_frame()[0]), 4096)
+
+    def test_closed_connection(self):
+        self.local.sendall(transport.HEADER.pack(10) + b'short')
+        self.local.close()
+        self.assertIsNone(self.receiver.read_frame())
+        self.assertIsNone(self.receiver.read_message())
+
+    def test_closed_while_discarding(self):
+        self.local.sendall(transport.HEADER.pack(5000) + b'x' * 100)
+        self.local.close()
+        self.assertIsNone(self.receiver.read_frame())
+
+    def test_compression_bomb(self):
+        bomb = zlib.compress(b'a' * 100000)
+        self.local.sendall(transport.pack_header(len(bomb), True) + bomb)
+        data, compressed = self.receiver.read_frame()
+        self.assertTrue(compressed)
+        with self.assertRaises(ValueError):
+            self.receiver.decompress(data)
+
+    def test_read_payload_decompresses(self):
+        payload = b'z' * 3000
+        self.sender.send_payload(payload)
+        self.assertEqual(self.receiver.read_payload(), payload)
+
+    def test_compressed_frame_without_codec(self):
+        self.sender.send_payload(b'c' * 3000)
+        self.receiver.codec = None
+        with self.assertRaises(ValueError):
+            self.receiver.read_payload()
+
+    def test_corrupt_compressed_payload(self):
+        self.local.sendall(transport.pack_header(4, True) + b'junk')
+        with self.assertRaises(ValueError):
+            self.receiver.read_payload()
+
+
+class CodecTest(unittest.TestCase):
+
+    def test_header(self):
+        self.assertEqual(transport.unpack_header(transport.pack_header(1234, True)), (1234, True))
+        self.assertEqual(transport.unpack_header(transport.pack_header(1234)), (1234, False))
+
+    def test_choose_codec(self):
+        self.assertEqual(transport.choose_codec(['zlib']), 'zlib')
+        self.assertEqual(transport.choose_codec(transport.supported_codecs()), transport.supported_codecs()[0])
+        self.assertIsNone(transport.choose_codec(['brotli']))
+        self.assertIsNone(transport.choose_codec([]))
+        self.assertIsNone(transport.choose_codec('zlib'))
+        self.assertIsNone(transport.choose_codec(None))
+
+    def test_decompress_limit(self):
+        data = zlib.compress(b'a' * 1000)
+        self.assertEqual(transport.decompress_payload('zlib', data, 1000), b'a' * 1000)
+        with self.assertRaises(ValueError):
+            transport.decompress_payload('zlib', data, 999)
+        with self.assertRaises(ValueError):
+            transport.decompress_payload('unknown', data)
+
+    def test_frame_is_encoded_once_per_codec(self):
+        frame = transport.Frame.from_message({'type': 'text', 'content': 'd' * 2000})
+        self.assertIs(frame.get('zlib'), frame.get('zlib'))
+        self.assertEqual(frame.get(), transport.encode_frame(frame.payload))
+        self.assertEqual(frame.msg_type, 'text')
+        # 标记为不可压缩的消息（如图片）总是发送未压缩的帧
+        image = transport.Frame.from_message({'type': 'file', 'file_data': 'e' * 2000}, compressible=False)
+        self.assertIs(image.get('zlib'), image.get())
+
+
+if __name__ == '__main__':
+    unittest.main()
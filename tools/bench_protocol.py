@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+协议消息解析性能测试
+比较服务器收到消息后的两种处理方式：
+  - dict: json.loads 后直接使用字典（以前的做法，未知字段原样保留）
+  - protocol: json.loads 后用 common.protocol.parse_client_message 解析为带 __slots__ 的消息对象
+分别测量每秒能处理的消息数，以及保留这些消息时每条消息占用的内存（tracemalloc）。
+测试消息按典型比例混合文字、私聊、文件通告（只带哈希）、房间切换和心跳回复，
+部分消息带有协议中没有的字段。
+
+用法:
+    python tools/bench_protocol.py
+    python tools/bench_protocol.py -n 200000 --repeat 5
+"""
+import os
+import sys
+import gc
+import json
+import time
+import random
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import protocol
+
+
+def make_messages(count, seed=1):
+    """生成 count 条编码好的客户端消息"""
+    rng = random.Random(seed)
+    messages = []
+    for i in range(count):
+        kind = rng.random()
+        if kind < 0.7:
+            message = {'type': 'text', 'content': f'消息 {i} ' + 'x' * rng.randint(5, 120)}
+        elif kind < 0.8:
+            message = {'type': 'direct', 'to': f'user{rng.randint(0, 999)}', 'content': 'hello',
+                       'client_msg_id': str(i)}
+        elif kind < 0.9:
+            message = {'type': 'file', 'file_type': 'images', 'file_name': f'{i}.png',
+                       'original_file_name': 'photo.png', 'file_hash': '%064x' % rng.getrandbits(256),
+                       'width': 1920, 'height': 1080}
+        elif kind < 0.95:
+            message = {'type': 'room_join', 'room': f'room{rng.randint(0, 20)}'}
+        else:
+            message = {'type': 'pong', 'timestamp': 1700000000000 + i}
+        if rng.random() < 0.1:
+            # 协议中没有的字段，解析后会被丢弃
+            message['extra'] = 'y' * 200
+        messages.append(json.dumps(message).encode('utf-8'))
+    return messages
+
+
+def decode_dict(data):
+    message = json.loads(data)
+    # 与以前的处理方式一致：按类型用 .get() 读取需要的字段
+    msg_type = message.get('type')
+    if msg_type == 'text':
+        return message.get('content')
+    if msg_type == 'room_join':
+        return message.get('room')
+    return message
+
+
+def decode_protocol(data):
+    message = protocol.parse_client_message(json.loads(data))
+    if message.TYPE == 'text':
+        return message.content
+    if message.TYPE == 'room_join':
+        return message.room
+    return message
+
+
+def measure_rate(decode, messages, repeat):
+    """返回多次运行中最快的一次的每秒消息数"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for data in messages:
+            decode(data)
+        best = min(best, time.perf_counter() - start)
+    return len(messages) / best
+
+
+def measure_memory(parse, messages):
+    """返回保留所有解析结果时每条消息平均占用的字节数"""
+    gc.collect()
+    tracemalloc.start()
+    kept = [parse(data) for data in messages]
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    return current / len(messages)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='intPlatinum 协议消息解析性能测试')
+    parser.add_argument('-n', '--count', type=int, default=100000, help='测试消息数 (默认: 100000)')
+    parser.add_argument('--repeat', type=int, default=3, help='重复运行次数，取最快的一次 (默认: 3)')
+    args = parser.parse_args()
+
+    messages = make_messages(args.count)
+    print(f"{args.count} 条消息，平均 {sum(map(len, messages)) / len(messages):.0f} 字节")
+
+    dict_rate = measure_rate(decode_dict, messages, args.repeat)
+    protocol_rate = measure_rate(decode_protocol, messages, args.repeat)
+    print(f"dict:     {dict_rate:10.0f} 条/秒")
+    print(f"protocol: {protocol_rate:10.0f} 条/秒（{protocol_rate / dict_rate:.2f} 倍）")
+
+    dict_memory = measure_memory(json.loads, messages)
+    protocol_memory = measure_memory(lambda data: protocol.parse_client_message(json.loads(data)), messages)
+    print(f"每条消息占用内存: dict {dict_memory:.0f} 字节，protocol {protocol_memory:.0f} 字节"
+          f"（{protocol_memory / dict_memory:.2f} 倍）")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+TLS握手性能测试
+分别测量完整握手和恢复会话的握手每秒能完成多少次。每次连接都会发送版本信息并等待响应，
+与真实客户端的连接过程一致（TLS 1.3 的会话票据在收到第一条数据时才到达）。
+
+不指定 --port 时在本进程中启动一个使用服务器TLS配置的测试监听端口；
+没有提供证书时用 openssl 命令生成临时的自签名证书。
+
+用法:
+    python tools/bench_tls.py -n 500
+    python tools/bench_tls.py --host 127.0.0.1 --port 7995 --cafile cert.pem -c 8
+"""
+import os
+import sys
+import ssl
+import json
+import time
+import base64
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'server'))
+from common import transport
+from server import create_server_ssl_context, ChatServer
+
+
+def make_self_signed_cert(directory):
+    """用 openssl 命令生成 localhost 的自签名证书，返回证书和私钥路径"""
+    certfile = os.path.join(directory, 'cert.pem')
+    keyfile = os.path.join(directory, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1',
+                    '-nodes', '-days', '1', '-subj', '/CN=localhost',
+                    '-addext', 'subjectAltName=DNS:localhost,IP:127.0.0.1',
+                    '-keyout', keyfile, '-out', certfile],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return certfile, keyfile
+
+
+def start_local_listener(context):
+    """启动只做握手和版本应答的测试监听端口，返回端口号"""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(128)
+    reply = json.dumps({'type': 'version_accepted'}).encode('utf-8')
+
+    def handle(sock):
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with context.wrap_socket(sock, server_side=True) as tls_socket:
+                connection = transport.Connection(tls_socket)
+                if connection.read_payload() is not None:
+                    connection.send_payload(reply)
+        except (ssl.SSLError, OSError):
+            pass
+
+    def serve():
+        while True:
+            sock, _ = listener.accept()
+            threading.Thread(target=handle, args=(sock,), daemon=True).start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return listener.getsockname()[1]
+
+
+def connect_once(context, host, port, session=None):
+    """完成一次TLS连接和版本交换，返回 (会话, 是否恢复了会话)"""
+    version = base64.b64encode(ChatServer.SERVER_VERSION.encode('utf-8')).decode('utf-8')
+    payload = json.dumps({'version': version}).encode('utf-8')
+    with socket.create_connection((host, port), timeout=10) as sock:
+        # 与客户端和服务器一致：关闭Nagle算法，避免握手后的第一次写入等待延迟确认
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with context.wrap_socket(sock, server_hostname=host, session=session) as tls_socket:
+            connection = transport.Connection(tls_socket)
+            connection.send_payload(payload)
+            if connection.read_frame() is None:
+                raise ConnectionError('服务器未响应版本验证')
+            return tls_socket.session, tls_socket.session_reused
+
+
+def run(context, host, port, count, concurrency, resume):
+    """并发执行 count 次连接，返回 (每秒握手次数, 恢复会话的次数)"""
+    per_worker = [count // concurrency + (1 if i < count % concurrency else 0) for i in range(concurrency)]
+    reused = [0] * concurrency
+    errors = []
+
+    def worker(index):
+        session = None
+        if resume:
+            # 预热：先完成一次完整握手拿到会话票据，不计入结果
+            session, _ = connect_once(context, host, port)
+        for _ in range(per_worker[index]):
+            try:
+                new_session, was_reused = connect_once(context, host, port, session if resume else None)
+            except (OSError, ConnectionError) as e:
+                errors.append(e)
+                continue
+            reused[index] += was_reused
+            if resume:
+                session = new_session
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    if errors:
+        print(f"  {len(errors)} 次连接失败，例如: {errors[0]}")
+    return (count - len(errors)) / elapsed, sum(reused)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='intPlatinum TLS握手性能测试')
+    parser.add_argument('--host', type=str, default='localhost', help='服务器地址，需与证书中的名称一致 (默认: localhost)')
+    parser.add_argument('--port', type=int, default=None, help='已启动TLS的服务器端口，不指定时在本进程中启动测试监听端口')
+    parser.add_argument('--cafile', type=str, default=None, help='验证服务器证书的CA文件（自签名证书即证书本身）')
+    parser.add_argument('--certfile', type=str, default=None, help='本地测试监听端口使用的证书，不指定时自动生成')
+    parser.add_argument('--keyfile', type=str, default=None, help='本地测试监听端口使用的私钥')
+    parser.add_argument('-n', '--count', type=int, default=200, help='每种握手方式的连接次数 (默认: 200)')
+    parser.add_argument('-c', '--concurrency', type=int, default=1, help='并发连接数 (默认: 1)')
+    parser.add_argument('--tls12', action='store_true', help='限制为TLS 1.2（默认使用双方支持的最高版本）')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cafile = args.cafile
+        port = args.port
+        if port is None:
+            certfile, keyfile = args.certfile, args.keyfile
+            if not certfile:
+                certfile, keyfile = make_self_signed_cert(tmpdir)
+            cafile = cafile or certfile
+            port = start_local_listener(create_server_ssl_context(certfile, keyfile))
+
+        context = ssl.create_default_context(cafile=cafile)
+        if args.tls12:
+            context.maximum_version = ssl.TLSVersion.TLSv1_2
+
+        print(f"目标 {args.host}:{port}，每种方式 {args.count} 次连接，并发 {args.concurrency}")
+        full_rate, _ = run(context, args.host, port, args.count, args.concurrency, resume=False)
+        print(f"完整握手:   {full_rate:8.1f} 次/秒")
+        resumed_rate, reused = run(context, args.host, port, args.count, args.concurrency, resume=True)
+        print(f"恢复会话:   {resumed_rate:8.1f} 次/秒（{reused}/{args.count} 次成功恢复）")
+        if full_rate:
+            print(f"恢复会话的速度是完整握手的 {resumed_rate / full_rate:.2f} 倍")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+消息帧传输性能测试
+对 common.transport 中登记的每种压缩算法（以及不压缩）测量：
+  - 编码：把消息编码为帧（Frame.get，包含压缩）的速度和压缩后的大小
+  - 收发：通过本地 socketpair 用 Connection 发送并读取、解压同样的消息，每秒往返的消息数
+测试消息为典型的服务器下发消息（带发送者、房间、序号等字段的文字消息和用户列表），
+新增或调整压缩算法、修改帧的读写方式后，用它比较前后的差异。
+
+用法:
+    python tools/bench_transport.py
+    python tools/bench_transport.py -n 50000 --repeat 5
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import transport
+
+
+def make_payloads(count, seed=1):
+    """生成 count 条编码好的服务器消息（JSON字节串）"""
+    rng = random.Random(seed)
+    payloads = []
+    for i in range(count):
+        if rng.random() < 0.9:
+            message = {'type': 'text', 'content': f'消息 {i} ' + 'hello world ' * rng.randint(1, 80),
+                       'sender': f'user{rng.randint(0, 999)}', 'room': 'lobby', 'seq': i,
+                       'id': f'1700000000-{i}', 'timestamp': 1700000000000 + i}
+        else:
+            message = {'type': 'user_list', 'room': 'lobby',
+                       'users': [f'user{n}' for n in range(rng.randint(10, 300))]}
+        payloads.append(json.dumps(message).encode('utf-8'))
+    return payloads
+
+
+def measure_encode(codec, payloads, repeat):
+    """返回 (每秒编码的消息数, 编码后的总字节数)，每次都新建 Frame，不使用缓存的帧"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        size = 0
+        for payload in payloads:
+            size += len(transport.Frame(payload).get(codec))
+        best = min(best, time.perf_counter() - start)
+    return len(payloads) / best, size
+
+
+def measure_roundtrip(codec, payloads):
+    """通过 socketpair 发送全部消息并在另一端读取解压，返回每秒的消息数"""
+    left, right = socket.socketpair()
+    sender = transport.Connection(left, codec)
+    receiver = transport.Connection(right, codec)
+    frames = [transport.Frame(payload).get(codec) for payload in payloads]
+
+    def send_all():
+        for frame in frames:
+            sender.sock.sendall(frame)
+
+    start = time.perf_counter()
+    thread = threading.Thread(target=send_all)
+    thread.start()
+    for _ in frames:
+        receiver.read_payload()
+    elapsed = time.perf_counter() - start
+    thread.join()
+    left.close()
+    right.close()
+    return len(frames) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='intPlatinum 消息帧传输性能测试')
+    parser.add_argument('-n', '--count', type=int, default=20000, help='测试消息数 (默认: 20000)')
+    parser.add_argument('--repeat', type=int, default=3, help='编码测试重复次数，取最快的一次 (默认: 3)')
+    args = parser.parse_args()
+
+    payloads = make_payloads(args.count)
+    raw_size = sum(map(len, payloads))
+    print(f"{args.count} 条消息，平均 {raw_size / len(payloads):.0f} 字节，"
+          f"已登记的压缩算法: {', '.join(transport.supported_codecs())}")
+
+    for codec in [None] + transport.supported_codecs():
+        encode_rate, size = measure_encode(codec, payloads, args.repeat)
+        roundtrip_rate = measure_roundtrip(codec, payloads)
+        print(f"{codec or 'none':6} 编码 {encode_rate:10.0f} 条/秒  收发 {roundtrip_rate:10.0f} 条/秒  "
+              f"大小 {size / raw_size * 100:5.1f}%")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,539 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+ChatServer 压力测试工具
+用 asyncio 模拟大量客户端（不依赖Qt），使用真实的消息帧协议连接服务器，
+按设定的比例混合发送文字、文件、心跳并模拟断线重连（churn），统计：
+  - 端到端延迟（发送到房间内其他客户端收到）的 p50/p90/p99/p999
+  - 连接握手耗时、心跳往返时间
+  - 发送和投递吞吐量
+  - 服务器进程的内存（RSS）和CPU占用（读取 /proc，仅限Linux）
+结果以JSON输出，便于比较不同的服务器实现和发现性能回退。
+
+用法:
+    # 自动启动一个服务器进程并测试
+    python tools/loadgen.py --spawn --clients 200 --duration 30 --output result.json
+    # 测试已启动的服务器，同时采样其资源占用
+    python tools/loadgen.py --port 7995 --server-pid 12345 --clients 1000 --rate 0.2
+"""
+import os
+import sys
+import ssl
+import json
+import time
+import base64
+import random
+import asyncio
+import argparse
+import platform
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import transport
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'server')
+
+CLIENT_VERSION = 'v1.0.2a'
+# 消息内容以该前缀开头时，接收方从中解析发送者编号和发送时间
+MARKER = 'LG'
+MARKER_BYTES = b'"LG '
+PONG_BYTES = b'"pong"'
+SERVER_PING_BYTES = b'"heartbeat"'
+DEFAULT_MIX = 'text=80,file=2,heartbeat=15,churn=3'
+
+
+class Reservoir:
+    """固定容量的均匀抽样，样本数很大时只保留一部分用于计算百分位数"""
+
+    def __init__(self, capacity=200000):
+        self.capacity = capacity
+        self.samples = []
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+        if len(self.samples) < self.capacity:
+            self.samples.append(value)
+        else:
+            index = random.randrange(self.count)
+            if index < self.capacity:
+                self.samples[index] = value
+
+    def summary(self):
+        """返回样本数和常用百分位数（毫秒）"""
+        if not self.samples:
+            return {'count': self.count}
+        ordered = sorted(self.samples)
+
+        def percentile(p):
+            return round(ordered[min(len(ordered) - 1, int(p / 100.0 * len(ordered)))], 3)
+
+        return {
+            'count': self.count,
+            'mean': round(sum(ordered) / len(ordered), 3),
+            'p50': percentile(50),
+            'p90': percentile(90),
+            'p99': percentile(99),
+            'p999': percentile(99.9),
+            'max': round(ordered[-1], 3),
+        }
+
+
+class Stats:
+    """所有模拟客户端共用的统计数据（asyncio 单线程，无需加锁）"""
+
+    def __init__(self):
+        self.measuring = False
+        self.latency = Reservoir()
+        self.file_latency = Reservoir()
+        self.connect_latency = Reservoir()
+        self.heartbeat_rtt = Reservoir()
+        self.sent = {'text': 0, 'file': 0, 'heartbeat': 0, 'churn': 0}
+        self.delivered = 0
+        self.bytes_received = 0
+        self.connect_ok = 0
+        self.connect_failed = 0
+        self.disconnects = 0
+        self.errors = {}
+
+    def error(self, kind):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+
+class ServerSampler:
+    """定期读取 /proc/<pid> 采样服务器进程的RSS和CPU时间"""
+
+    def __init__(self, pid, interval=1.0):
+        self.pid = pid
+        self.interval = interval
+        self.rss_samples = []
+        self.cpu_start = None
+        self.cpu_end = None
+        self.wall_start = None
+        self.wall_end = None
+        self.clock_ticks = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+    def _cpu_seconds(self):
+        with open(f'/proc/{self.pid}/stat') as f:
+            # comm 字段可能包含空格，从最后一个右括号之后开始解析
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / self.clock_ticks
+
+    def _rss_kb(self):
+        with open(f'/proc/{self.pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+        return 0
+
+    def begin(self):
+        self.cpu_start = self._cpu_seconds()
+        self.wall_start = time.monotonic()
+
+    def finish(self):
+        self.cpu_end = self._cpu_seconds()
+        self.wall_end = time.monotonic()
+
+    async def run(self):
+        while True:
+            try:
+                self.rss_samples.append(self._rss_kb())
+            except OSError:
+                return
+            await asyncio.sleep(self.interval)
+
+    def summary(self):
+        if not self.rss_samples or self.cpu_end is None:
+            return None
+        return {
+            'pid': self.pid,
+            'rss_kb_max': max(self.rss_samples),
+            'rss_kb_end': self.rss_samples[-1],
+            'cpu_seconds': round(self.cpu_end - self.cpu_start, 3),
+            'cpu_percent': round(100.0 * (self.cpu_end - self.cpu_start) / (self.wall_end - self.wall_start), 1),
+        }
+
+
+class SimulatedClient:
+    """一个模拟客户端：负责握手、接收并统计消息，以及按比例发送各类消息"""
+
+    def __init__(self, index, args, stats, ssl_context):
+        self.index = index
+        self.args = args
+        self.stats = stats
+        self.ssl_context = ssl_context
+        self.generation = 0
+        self.reader = None
+        self.writer = None
+        self.codec = None
+        self.receive_task = None
+        self.heartbeats = []  # 未收到回复的心跳的发送时间，服务器按顺序回复
+        self.counter = 0
+
+    @property
+    def username(self):
+        # 每次重连使用新昵称，避免服务器尚未处理完上一次断开时昵称冲突
+        return f'lg{self.index}-{self.generation}'
+
+    def _encode(self, message):
+        return transport.encode_frame(json.dumps(message).encode('utf-8'))
+
+    async def _read_raw(self):
+        length, compressed = transport.unpack_header(await self.reader.readexactly(transport.HEADER_SIZE))
+        data = await self.reader.readexactly(length)
+        self.stats.bytes_received += transport.HEADER_SIZE + len(data)
+        if compressed:
+            data = transport.decompress_payload(self.codec, data)
+        return data
+
+    async def _read(self):
+        return json.loads((await self._read_raw()).decode('utf-8'))
+
+    async def connect(self):
+        """建立连接并完成 hello 握手（旧版服务器回退为两步握手），返回是否成功"""
+        args = self.args
+        start = time.perf_counter()
+        try:
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(args.host, args.port, ssl=self.ssl_context,
+                                        server_hostname=args.host if self.ssl_context else None),
+                timeout=args.connect_timeout)
+            login = {'username': self.username, 'capabilities': args.capabilities}
+            version = base64.b64encode(CLIENT_VERSION.encode('utf-8')).decode('utf-8')
+            hello = dict(login, type='hello', version=version)
+            if args.compression:
+                hello['compression'] = ['zlib']
+            self.writer.write(self._encode(hello))
+            reply = await asyncio.wait_for(self._read(), timeout=args.connect_timeout)
+            if reply.get('type') == 'version_accepted':
+                self.codec = reply.get('compression')
+                self.writer.write(self._encode(login))
+                reply = await asyncio.wait_for(self._read(), timeout=args.connect_timeout)
+            if reply.get('type') != 'connected':
+                raise ConnectionError(f"握手失败: {reply.get('type')}")
+            self.codec = reply.get('compression', self.codec)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            self.stats.connect_failed += 1
+            self.stats.error('connect')
+            await self.close()
+            return False
+        self.stats.connect_ok += 1
+        self.stats.connect_latency.add((time.perf_counter() - start) * 1000)
+        self.heartbeats.clear()
+        self.receive_task = asyncio.ensure_future(self._receive_loop())
+        return True
+
+    async def close(self, explicit=False):
+        if self.receive_task is not None:
+            self.receive_task.cancel()
+            self.receive_task = None
+        if self.writer is not None:
+            try:
+                if explicit:
+                    self.writer.write(self._encode({'type': 'disconnect', 'username': self.username}))
+                    await self.writer.drain()
+                self.writer.close()
+            except (OSError, RuntimeError):
+                pass
+            self.writer = None
+
+    async def _receive_loop(self):
+        stats = self.stats
+        try:
+            while True:
+                data = await self._read_raw()
+                now = time.perf_counter_ns()
+                # 只解析带测试标记的消息和心跳回复：用户列表等消息随连接数平方增长，
+                # 全部解析会让压测工具本身先成为瓶颈
+                if MARKER_BYTES not in data and PONG_BYTES not in data and SERVER_PING_BYTES not in data:
+                    continue
+                message = json.loads(data.decode('utf-8'))
+                msg_type = message.get('type')
+                if msg_type == 'heartbeat':
+                    # 声明了 server_ping 能力时服务器会定期发送心跳，与客户端一样原样带回时间戳
+                    self.writer.write(self._encode({'type': 'pong', 'timestamp': message.get('timestamp')}))
+                    continue
+                if msg_type == 'pong':
+                    if self.heartbeats:
+                        sent_at = self.heartbeats.pop(0)
+                        if stats.measuring:
+                            stats.heartbeat_rtt.add((now - sent_at) / 1e6)
+                    continue
+                if msg_type == 'text':
+                    marker = message.get('content') or ''
+                    reservoir = stats.latency
+                elif msg_type in ('file', 'file_announce'):
+                    marker = message.get('original_file_name') or ''
+                    reservoir = stats.file_latency
+                else:
+                    continue
+                if not marker.startswith(MARKER):
+                    continue
+                parts = marker.split(' ', 4)
+                if int(parts[1]) == self.index:
+                    # 自己发出的消息的回显不计入端到端延迟
+                    continue
+                if stats.measuring:
+                    stats.delivered += 1
+                    reservoir.add((now - int(parts[3])) / 1e6)
+        except asyncio.CancelledError:
+            raise
+        except (OSError, asyncio.IncompleteReadError, ValueError):
+            stats.disconnects += 1
+
+    def _marker(self):
+        self.counter += 1
+        return f'{MARKER} {self.index} {self.counter} {time.perf_counter_ns()}'
+
+    async def send(self, action):
+        """执行一次动作，连接已断开时尝试重连"""
+        stats = self.stats
+        if self.writer is None or self.receive_task is None or self.receive_task.done():
+            await self.close()
+            self.generation += 1
+            if not await self.connect():
+                return
+        if action == 'text':
+            content = self._marker() + ' '
+            content += 'x' * max(0, self.args.text_size - len(content))
+            self.writer.write(self._encode({'type': 'text', 'content': content}))
+        elif action == 'file':
+            data = base64.b64encode(os.urandom(self.args.file_size)).decode('ascii')
+            self.writer.write(self._encode({
+                'type': 'file', 'file_type': 'images', 'file_name': f'lg_{self.index}_{self.counter}.png',
+                'original_file_name': self._marker(), 'file_data': data, 'width': 1, 'height': 1,
+            }))
+        elif action == 'heartbeat':
+            self.heartbeats.append(time.perf_counter_ns())
+            self.writer.write(self._encode({'type': 'heartbeat'}))
+        elif action == 'churn':
+            await self.close(explicit=True)
+            self.generation += 1
+            if stats.measuring:
+                stats.sent['churn'] += 1
+            await self.connect()
+            return
+        try:
+            await self.writer.drain()
+        except (OSError, RuntimeError):
+            stats.error('send')
+            await self.close()
+            return
+        if stats.measuring:
+            stats.sent[action] += 1
+
+    async def run(self, stop_at, actions, weights):
+        """按泊松过程发送消息，直到测试结束"""
+        rate = self.args.rate
+        while True:
+            delay = random.expovariate(rate) if rate > 0 else 3600
+            if time.monotonic() + delay >= stop_at:
+                return
+            await asyncio.sleep(delay)
+            await self.send(random.choices(actions, weights)[0])
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip()
+        if name not in ('text', 'file', 'heartbeat', 'churn'):
+            raise argparse.ArgumentTypeError(f'未知的消息类型: {name}')
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def raise_fd_limit(needed):
+    """打开大量连接前提高进程的文件描述符上限"""
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft >= needed:
+        return
+    if hard != resource.RLIM_INFINITY:
+        needed = min(needed, hard)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (needed, hard))
+
+
+def spawn_server(args):
+    """启动一个服务器子进程用于测试，日志输出到 --server-log 指定的文件"""
+    command = [sys.executable, os.path.join(SERVER_DIR, 'server.py'), '--host', args.host, '--port', str(args.port)]
+    command += args.server_args
+    log = open(args.server_log, 'wb') if args.server_log else subprocess.DEVNULL
+    process = subprocess.Popen(command, cwd=SERVER_DIR, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT)
+    return process
+
+
+async def wait_for_port(host, port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection(host, port)
+            writer.close()
+            return True
+        except OSError:
+            await asyncio.sleep(0.1)
+    return False
+
+
+async def run_load(args):
+    stats = Stats()
+    ssl_context = None
+    if args.tls:
+        ssl_context = ssl.create_default_context(cafile=args.cafile)
+
+    server_process = None
+    server_pid = args.server_pid
+    if args.spawn:
+        server_process = spawn_server(args)
+        server_pid = server_process.pid
+        # 探测连接会被服务器当作一次失败的握手，只影响服务器日志
+        if not await wait_for_port(args.host, args.port):
+            server_process.kill()
+            raise SystemExit('服务器启动超时')
+
+    sampler = None
+    sampler_task = None
+    if server_pid and os.path.exists(f'/proc/{server_pid}'):
+        sampler = ServerSampler(server_pid)
+        sampler_task = asyncio.ensure_future(sampler.run())
+
+    try:
+        # 按设定的速度逐步建立连接，避免瞬间涌入的连接超出服务器的监听队列
+        clients = [SimulatedClient(i, args, stats, ssl_context) for i in range(args.clients)]
+        ramp_start = time.monotonic()
+        pending = []
+        for i, client in enumerate(clients):
+            pending.append(asyncio.ensure_future(client.connect()))
+            if args.ramp > 0:
+                delay = ramp_start + (i + 1) / args.ramp - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+        await asyncio.gather(*pending)
+        ramp_seconds = time.monotonic() - ramp_start
+        print(f'已建立 {stats.connect_ok}/{args.clients} 个连接，用时 {ramp_seconds:.1f} 秒', file=sys.stderr)
+
+        actions = list(args.mix)
+        weights = [args.mix[name] for name in actions]
+        stats.measuring = True
+        if sampler:
+            sampler.begin()
+        start = time.monotonic()
+        cpu_start = time.process_time()
+        stop_at = start + args.duration
+        await asyncio.gather(*(client.run(stop_at, actions, weights) for client in clients))
+        send_seconds = time.monotonic() - start
+        # 等待在途消息到达
+        await asyncio.sleep(args.drain)
+        elapsed = time.monotonic() - start
+        generator_cpu = time.process_time() - cpu_start
+        stats.measuring = False
+        if sampler:
+            sampler.finish()
+
+        await asyncio.gather(*(client.close(explicit=True) for client in clients))
+    finally:
+        if sampler_task:
+            sampler_task.cancel()
+        if server_process is not None:
+            server_process.terminate()
+            try:
+                server_process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                server_process.kill()
+
+    sent_total = sum(stats.sent.values())
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'config': {
+            'target': f'{args.host}:{args.port}',
+            'clients': args.clients,
+            'duration': args.duration,
+            'rate_per_client': args.rate,
+            'mix': args.mix,
+            'text_size': args.text_size,
+            'file_size': args.file_size,
+            'capabilities': args.capabilities,
+            'tls': args.tls,
+            'compression': args.compression,
+            'server_args': args.server_args if args.spawn else None,
+            'label': args.label,
+        },
+        'connections': {
+            'established': stats.connect_ok,
+            'failed': stats.connect_failed,
+            'dropped': stats.disconnects,
+            'ramp_seconds': round(ramp_seconds, 3),
+            'handshake_ms': stats.connect_latency.summary(),
+        },
+        'throughput': {
+            'elapsed_seconds': round(elapsed, 3),
+            'sent': stats.sent,
+            'sent_per_second': round(sent_total / send_seconds, 1),
+            'delivered': stats.delivered,
+            'delivered_per_second': round(stats.delivered / elapsed, 1),
+            'bytes_received': stats.bytes_received,
+        },
+        'latency_ms': {
+            'text': stats.latency.summary(),
+            'file': stats.file_latency.summary(),
+            'heartbeat_rtt': stats.heartbeat_rtt.summary(),
+        },
+        'server': sampler.summary() if sampler else None,
+        # 压测工具本身接近100%时结果受工具限制，应减少客户端数量或分多个进程运行
+        'generator_cpu_percent': round(100.0 * generator_cpu / elapsed, 1),
+        'errors': stats.errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='intPlatinum 服务器压力测试')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='服务器地址 (默认: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=7995, help='服务器端口 (默认: 7995)')
+    parser.add_argument('--clients', '-c', type=int, default=100, help='模拟客户端数量 (默认: 100)')
+    parser.add_argument('--duration', '-t', type=float, default=30, help='测量时长，单位秒 (默认: 30)')
+    parser.add_argument('--ramp', type=float, default=200, help='每秒新建的连接数，0表示同时建立 (默认: 200)')
+    parser.add_argument('--rate', type=float, default=0.5, help='每个客户端每秒执行的动作数 (默认: 0.5)')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f'各类动作的比例 (默认: {DEFAULT_MIX})')
+    parser.add_argument('--text-size', type=int, default=64, help='文字消息的字节数 (默认: 64)')
+    parser.add_argument('--file-size', type=int, default=32 * 1024, help='文件消息的原始字节数 (默认: 32768)')
+    parser.add_argument('--capabilities', type=lambda s: [c for c in s.split(',') if c], default=['file_dedup', 'server_ping'],
+                        help='模拟客户端声明的能力，逗号分隔，空字符串表示旧版客户端 (默认: file_dedup,server_ping)')
+    parser.add_argument('--compression', action='store_true', help='协商zlib压缩')
+    parser.add_argument('--tls', action='store_true', help='使用TLS连接')
+    parser.add_argument('--cafile', type=str, default=None, help='验证服务器证书的CA文件')
+    parser.add_argument('--connect-timeout', type=float, default=10, help='连接和握手的超时时间，单位秒 (默认: 10)')
+    parser.add_argument('--drain', type=float, default=2, help='发送结束后等待在途消息的时间，单位秒 (默认: 2)')
+    parser.add_argument('--server-pid', type=int, default=None, help='服务器进程ID，用于采样内存和CPU')
+    parser.add_argument('--spawn', action='store_true', help='自动启动服务器子进程进行测试')
+    parser.add_argument('--server-log', type=str, default=None, help='--spawn 时服务器日志的输出文件（默认丢弃）')
+    parser.add_argument('--label', type=str, default=None, help='写入结果的标签，例如服务器实现的名称')
+    parser.add_argument('--output', '-o', type=str, default=None, help='结果JSON的输出文件（默认输出到标准输出）')
+    parser.add_argument('--seed', type=int, default=None, help='随机数种子，便于重复测试')
+    parser.add_argument('server_args', nargs=argparse.REMAINDER,
+                        help='--spawn 时传给服务器的其他参数，写在 -- 之后，例如 -- --history 100')
+    args = parser.parse_args()
+    if args.server_args and args.server_args[0] == '--':
+        args.server_args = args.server_args[1:]
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    raise_fd_limit(args.clients + 64)
+    result = asyncio.run(run_load(args))
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+        print(f'结果已写入 {args.output}', file=sys.stderr)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()